@@ -17,6 +17,8 @@
 #define MAX_NOTES 596
 #define BUILTIN_MUSIC_NUM 3
 #define BUILTIN_MUSIC_TRACKS 4
+#define ACK_SLOT_MS 2 // Response slot of a node in a multicast upload
+#define TEMPO_UNIT 64 // Tempo scale of the original tempo (event 0xD4)
 
 // Define the bit-addressable variables
 sbit beep = P3 ^ 4;    // Buzzer
@@ -45,6 +47,7 @@ extern uint16 uartPos;     // Position in the UART buffer
 extern bit uartDtSzH;      // High byte of data size flag
 extern bit uartDtSzL;      // Low byte of data size flag
 extern uint8 nodeid;       // Node ID for data transmission
+extern uint8 responseSlot; // Response delay in ACK_SLOT_MS (multicast)
 // Music related
 extern uint8 xdata note[];
 extern uint16 xdata duration[];
@@ -54,6 +57,14 @@ extern uint8 loadSongId;
 extern bit isMusicPlaying;   // Flag indicating music is playing
 extern bit isWaitingForSync; // Flag for waiting for sync signal
 extern uint16 pos;           // Current position in music playback
+extern bit beaconMode;       // Markers are released by beacons instead of 0x80
+extern bit catchUp;          // Skipping to the marker of a beacon
+extern uint8 markerCount;    // Markers reached since the start of playback
+extern uint8 beaconTarget;   // Marker of the beacon being caught up with
+extern uint8 loopStart;      // Marker playback starts after (event 0xD3)
+extern uint8 loopEnd;        // Marker to jump back to loopStart at, 0 for none
+extern uint8 tempoScale;     // Duration multiplier in 1/TEMPO_UNIT (event 0xD4)
+extern int16 transpose;      // Semitones added to every note (event 0xD4)
 
 /// @brief Digital tube decode table.
 extern uint8 code dtDecode[];
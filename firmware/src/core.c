@@ -17,6 +17,21 @@ bit uartDtSzH = 0;      // High byte of data size flag
 bit uartDtSzL = 0;      // Low byte of data size flag
 bit loadFromCode = 0;   // Flag to load music from built-in code
 uint8 loadSongId = 0;   // ID of the song to load from built-in code
+bit uploadTarget = 0;   // Flag indicating the music data is for this node
+uint8 maskPos = 0;      // Number of node mask bytes received (multicast)
+uint16 nodeMask = 0;    // Node mask of a multicast upload
+uint8 responseSlot = 0; // Response delay in ACK_SLOT_MS (multicast)
+uint8 offsetPos = 0;    // Number of offset bytes received (patch)
+uint16 noteOffset = 0;  // First entry written by the music data
+uint8 bulkCount = 0;    // Number of segments in a bulk frame
+uint16 bulkTablePos = 0; // Number of bulk frame bytes received up to the segments
+uint8 bulkNode = 0;     // Node of the segment table entry being received
+uint16 bulkSize = 0;    // Size of the segment table entry being received
+uint16 bulkStart = 0;   // Position of the segment of this node
+uint16 bulkEnd = 0;     // Total size of all segments
+uint16 bulkPos = 0;     // Number of segment bytes received
+bit seekPos = 0;        // Start marker of a seek received
+bit modifierPos = 0;    // Tempo scale of a modifier received
 
 // Music related
 uint8 xdata note[MAX_NOTES];
@@ -47,6 +62,13 @@ uint8 code tl0_table[128] = {
 
 // Function prototypes
 void event1(uint8 dt);
+void eventA(uint8 dt);
+void eventC(uint8 dt);
+void eventD0(uint8 dt);
+void eventD1(uint8 dt);
+void eventD2(uint8 dt);
+void eventD3(uint8 dt);
+void eventD4(uint8 dt);
 
 void sysInit() {
     // Display init.
@@ -115,6 +137,9 @@ void fetchData() {
             notePos = 0;
             uartCheckSum = 0;
             dataReady = 0;
+            noteOffset = 0;
+            uploadTarget = (param == nodeid);
+            responseSlot = 0;
             break;
         case 2:
             // For host, ignore it
@@ -123,6 +148,13 @@ void fetchData() {
             break;
         case 3:
             pos = 0; // Reset playback position
+            TR0 = 0; // A live note must not sound through the first rest
+            beep = 0;
+            markerCount = 0;
+            beaconMode = 0;
+            catchUp = 0;
+            loopStart = 0;
+            loopEnd = 0;
             isMusicPlaying = 1;
             isWaitingForSync = 0;
             event = 0;
@@ -131,12 +163,21 @@ void fetchData() {
         case 4:
             isMusicPlaying = 0;
             isWaitingForSync = 0;
+            TR0 = 0; // Silence a live note as well
+            beep = 0;
             event = 0;
             param = 0;
             break;
         case 5:
             if (param == nodeid) {
                 pos = 0;
+                TR0 = 0;
+                beep = 0;
+                markerCount = 0;
+                beaconMode = 0;
+                catchUp = 0;
+                loopStart = 0;
+                loopEnd = 0;
                 isMusicPlaying = 1;
                 isWaitingForSync = 0;
             }
@@ -147,6 +188,8 @@ void fetchData() {
             if (param == nodeid) {
                 isMusicPlaying = 0;
                 isWaitingForSync = 0;
+                TR0 = 0; // Mute at once instead of after the current note
+                beep = 0;
             }
             event = 0;
             param = 0;
@@ -161,6 +204,7 @@ void fetchData() {
             isWaitingForSync = 0;
             event = 0;
             param = 0;
+            break;
         case 9:
             // Load from code
             if (param < BUILTIN_MUSIC_NUM) {
@@ -170,6 +214,65 @@ void fetchData() {
             event = 0;
             param = 0;
             break;
+        case 0xb:
+            // Presence probe
+            if (param == nodeid) {
+                responseData = 0xe1;
+                responseSlot = 0;
+                sendResponse = 1;
+            }
+            event = 0;
+            param = 0;
+            break;
+        case 0xa:
+            // Patch music data, the entry offset comes first
+            uartDtSzH = 0;
+            uartDtSzL = 0;
+            uartPos = 0;
+            uartCheckSum = 0;
+            offsetPos = 0;
+            uploadTarget = (param == nodeid);
+            responseSlot = 0;
+            break;
+        case 0xc:
+            // Live note, the note byte comes next
+            break;
+        case 0xd:
+            if (param == 0) {
+                // Multicast music data, the node mask comes first
+                uartDtSzH = 0;
+                uartDtSzL = 0;
+                uartPos = 0;
+                notePos = 0;
+                uartCheckSum = 0;
+                noteOffset = 0;
+                maskPos = 0;
+                nodeMask = 0;
+                uploadTarget = 0;
+            } else if (param == 1) {
+                // Bulk music data, the segment table comes first
+                uartPos = 0;
+                notePos = 0;
+                uartCheckSum = 0;
+                noteOffset = 0;
+                bulkTablePos = 0;
+                bulkEnd = 0;
+                bulkPos = 0;
+                uploadTarget = 0;
+                responseSlot = 0;
+            } else if (param == 2) {
+                // Beacon, the marker index comes next
+            } else if (param == 3) {
+                // Seek, the start and loop end markers come next
+                seekPos = 0;
+            } else if (param == 4) {
+                // Modifier, the tempo scale and transposition come next
+                modifierPos = 0;
+            } else {
+                event = 0;
+                param = 0;
+            }
+            break;
         case 0xe:
         case 0xf:
         default:
@@ -180,6 +283,20 @@ void fetchData() {
     } else {
         if (event == 1) {
             event1(dt);
+        } else if (event == 0xa) {
+            eventA(dt);
+        } else if (event == 0xc) {
+            eventC(dt);
+        } else if (event == 0xd && param == 0) {
+            eventD0(dt);
+        } else if (event == 0xd && param == 1) {
+            eventD1(dt);
+        } else if (event == 0xd && param == 2) {
+            eventD2(dt);
+        } else if (event == 0xd && param == 3) {
+            eventD3(dt);
+        } else if (event == 0xd) {
+            eventD4(dt);
         }
     }
 }
@@ -197,8 +314,8 @@ void event1(uint8 dt) {
     } else if (!uartDtSzL) {
         uartDtSz |= dt;
         uartDtSzL = 1; // Low byte received
-    } else if (nodeid == param) {
-        if (uartDtSz / 3 > MAX_NOTES) {
+    } else if (uploadTarget) {
+        if (noteOffset > MAX_NOTES || uartDtSz / 3 > MAX_NOTES - noteOffset) {
             // Data size exceeds maximum note capacity
             // Ignore all data
             uartPos++;
@@ -234,7 +351,7 @@ void event1(uint8 dt) {
         if (uartPos > uartDtSz) {
             event = 0;
             param = 0;
-            if (uartDtSz / 3 > MAX_NOTES) {
+            if (noteOffset > MAX_NOTES || uartDtSz / 3 > MAX_NOTES - noteOffset) {
                 responseData = 0xf1; // Data size error
                 sendResponse = 1;
                 dataReady = 0;
@@ -252,6 +369,231 @@ void event1(uint8 dt) {
     }
 }
 
+/**
+ * @brief Handle event A: Patch music data
+ *
+ * Two bytes of entry offset (high byte first) are followed by the same
+ * data as event 1, which overwrites the entries from the offset on. The
+ * offset bytes are part of the checksum.
+ *
+ * @param dt The received byte
+ */
+void eventA(uint8 dt) {
+    if (offsetPos == 0) {
+        noteOffset = (dt << 8);
+        offsetPos = 1;
+        uartCheckSum ^= dt;
+    } else if (offsetPos == 1) {
+        noteOffset |= dt;
+        offsetPos = 2;
+        uartCheckSum ^= dt;
+        notePos = noteOffset;
+    } else {
+        event1(dt);
+    }
+}
+
+/**
+ * @brief Handle event C: Play a live note
+ *
+ * The note byte is a MIDI note number to sound from now on, or 255 to
+ * silence the buzzer. The timer is set right here in the interrupt, so the
+ * note starts as soon as its byte has been received. Nodes playing music
+ * ignore live notes.
+ *
+ * @param dt The received byte
+ */
+void eventC(uint8 dt) {
+    if (param == nodeid && !isMusicPlaying) {
+        if (dt <= 127) {
+            TH0 = th0_table[dt];
+            TL0 = tl0_table[dt];
+            TR0 = 1;
+        } else {
+            TR0 = 0;
+            beep = 0;
+        }
+    }
+    event = 0;
+    param = 0;
+}
+
+/**
+ * @brief Handle event 0xD0: Receive multicast music data
+ *
+ * Two bytes of node mask (high byte first, bit n for node n) are followed
+ * by the same data as event 1. Nodes in the mask respond one after another
+ * in node order, `ACK_SLOT_MS` apart, so their responses do not collide.
+ *
+ * @param dt The received byte
+ */
+void eventD0(uint8 dt) {
+    uint8 i;
+    if (maskPos == 0) {
+        nodeMask = (dt << 8);
+        maskPos = 1;
+    } else if (maskPos == 1) {
+        nodeMask |= dt;
+        maskPos = 2;
+        uploadTarget = (nodeMask >> nodeid) & 1;
+        if (uploadTarget) {
+            dataReady = 0;
+            // Count the nodes in the mask that respond before this node
+            responseSlot = 0;
+            for (i = 0; i < nodeid; i++) {
+                if ((nodeMask >> i) & 1) {
+                    responseSlot++;
+                }
+            }
+        }
+    } else {
+        event1(dt);
+    }
+}
+
+/**
+ * @brief Handle event 0xD1: Receive bulk music data
+ *
+ * The number of segments and a segment table (node, size high byte, size
+ * low byte per segment) are followed by the segments back to back. Every
+ * segment has the data and checksum of event 1. Nodes only store their own
+ * segment and respond after the whole frame, in node order `ACK_SLOT_MS`
+ * apart.
+ *
+ * @param dt The received byte
+ */
+void eventD1(uint8 dt) {
+    if (bulkTablePos == 0) {
+        bulkCount = dt;
+        bulkTablePos = 1;
+        if (bulkCount == 0) {
+            event = 0;
+            param = 0;
+        }
+    } else if (bulkTablePos <= bulkCount * 3) {
+        switch ((bulkTablePos - 1) % 3) {
+        case 0:
+            bulkNode = dt;
+            break;
+        case 1:
+            bulkSize = (dt << 8);
+            break;
+        case 2:
+            bulkSize |= dt;
+            if (bulkNode == nodeid) {
+                uploadTarget = 1;
+                dataReady = 0;
+                bulkStart = bulkEnd;
+                uartDtSz = bulkSize;
+                uartDtSzH = 1;
+                uartDtSzL = 1;
+            } else if (bulkNode < nodeid) {
+                responseSlot++;
+            }
+            bulkEnd += bulkSize + 1; // Data and check byte
+            break;
+        }
+        bulkTablePos++;
+    } else {
+        if (uploadTarget && bulkPos >= bulkStart && bulkPos <= bulkStart + uartDtSz) {
+            event1(dt);
+            // Keep receiving the frame, respond after it
+            sendResponse = 0;
+            event = 0xd;
+            param = 1;
+        }
+        bulkPos++;
+        if (bulkPos >= bulkEnd) {
+            sendResponse = uploadTarget;
+            event = 0;
+            param = 0;
+        }
+    }
+}
+
+/**
+ * @brief Handle event 0xD2: Beacon
+ *
+ * The byte is the index of the marker the host expects every node at now,
+ * modulo 256. A node waiting at that marker resumes, a node that has not
+ * reached it yet cuts its current note short and skips to it. The first
+ * beacon switches the node to beacon mode, in which node 0 sends no sync
+ * requests.
+ *
+ * @param dt The received byte
+ */
+void eventD2(uint8 dt) {
+    uint8 behind = dt - markerCount;
+    event = 0;
+    param = 0;
+    if (!isMusicPlaying) {
+        return;
+    }
+    beaconMode = 1;
+    if (behind < 128) {
+        beaconTarget = dt;
+        catchUp = 1;
+        isWaitingForSync = 0;
+    } else if (behind == 0xff) {
+        // Waiting at the marker of the beacon
+        isWaitingForSync = 0;
+    }
+}
+
+/**
+ * @brief Handle event 0xD3: Seek and loop
+ *
+ * Two bytes follow: the marker to start playing after and the marker to
+ * jump back to the start marker at. Marker 0 is the beginning of the music,
+ * a loop end of 0 or not after the start marker plays to the end. Playback
+ * starts like with event 3, the music up to the start marker is skipped
+ * the way a node catches up with a beacon, as every track holds the same
+ * markers.
+ *
+ * @param dt The received byte
+ */
+void eventD3(uint8 dt) {
+    if (!seekPos) {
+        loopStart = dt;
+        seekPos = 1;
+        return;
+    }
+    loopEnd = (dt > loopStart) ? dt : 0;
+    event = 0;
+    param = 0;
+    pos = 0;
+    TR0 = 0;
+    beep = 0;
+    markerCount = 0;
+    beaconMode = 0;
+    beaconTarget = loopStart - 1;
+    catchUp = (loopStart != 0);
+    isMusicPlaying = 1;
+    isWaitingForSync = 0;
+}
+
+/**
+ * @brief Handle event 0xD4: Tempo and key modifier
+ *
+ * Two bytes follow: the duration multiplier in 1/TEMPO_UNIT, TEMPO_UNIT
+ * for the original tempo, and the semitones to transpose by as a signed
+ * byte. A scale of 0 keeps the current one. Both apply from the next note
+ * on, also while playing, and are kept until the next modifier.
+ *
+ * @param dt The received byte
+ */
+void eventD4(uint8 dt) {
+    if (!modifierPos) {
+        if (dt != 0)
+            tempoScale = dt;
+        modifierPos = 1;
+        return;
+    }
+    transpose = (dt < 128) ? dt : (int16)dt - 256;
+    event = 0;
+    param = 0;
+}
+
 void t0InterruptHandler() INTERRUPT(1) { beep = ~beep; }
 
 void uartInterruptHandler() INTERRUPT(8) USING(1) {
@@ -52,6 +52,8 @@ PREPARE:
 
         // Check if we need to send response from interrupt
         if (sendResponse) {
+            // Wait for the nodes before this one in a multicast upload
+            delay(responseSlot * ACK_SLOT_MS);
             sendData(responseData);
             sendResponse = 0;
         }
@@ -3,32 +3,99 @@
 #include "delay.h"
 
 bit isWaitingForSync = 0;
+bit beaconMode = 0;      // Markers are released by beacons (event 0xD2)
+bit catchUp = 0;         // Behind a beacon, skip to its marker
+uint8 markerCount = 0;   // Markers reached since the start of playback
+uint8 beaconTarget = 0;  // Marker of the beacon being caught up with
+uint8 loopStart = 0;     // Marker playback starts after, 0 for the beginning
+uint8 loopEnd = 0;       // Marker to jump back to loopStart at, 0 for none
+uint8 tempoScale = TEMPO_UNIT; // Duration multiplier in 1/TEMPO_UNIT
+int16 transpose = 0;     // Semitones added to every note
+
+/**
+ * @brief Same as `delay`, but returns early once the node has to catch up
+ * or has been stopped.
+ *
+ * @param t Time to delay in the unit of milliseconds.
+ */
+void entry_delay(uint16 t) {
+    unsigned int j;
+    for (; t > 0 && !catchUp && isMusicPlaying; t--)
+        for (j = 800; j > 0; j--);
+}
+
+/**
+ * @brief Scale a duration by the tempo of event 0xD4.
+ *
+ * @param t Duration in the unit of milliseconds.
+ * @return The scaled duration, at most 65535 ms.
+ */
+uint16 scale_duration(uint16 t) {
+    uint32 scaled;
+    if (tempoScale == TEMPO_UNIT)
+        return t;
+    scaled = ((uint32)t * tempoScale) / TEMPO_UNIT;
+    return (scaled > 0xffff) ? 0xffff : (uint16)scaled;
+}
 
 void play_music_note() {
     uint8 current_note = note[pos];
+    uint8 request = 0;
+    int16 pitch;
     P0 = (pos & 0xff);
+    if (catchUp && current_note != 253 && current_note != 254) {
+        // Behind a beacon, skip the music up to its marker
+        pos++;
+        return;
+    }
     if (current_note <= 127) {
-        TH0 = th0_table[current_note];
-        TL0 = tl0_table[current_note];
-        TR0 = 1;
-        delay(duration[pos]);
+        // Notes transposed out of the table are rests. The UART interrupt
+        // must not change the offset half read
+        EA = 0;
+        pitch = current_note + transpose;
+        EA = 1;
+        if (pitch >= 0 && pitch <= 127) {
+            TH0 = th0_table[pitch];
+            TL0 = tl0_table[pitch];
+            TR0 = 1;
+        }
+        entry_delay(scale_duration(duration[pos]));
         TR0 = 0;
         beep = 0;
         pos++;
     } else if (current_note == 255) {
-        delay(duration[pos]);
+        entry_delay(scale_duration(duration[pos]));
         pos++;
     } else if (current_note == 254) {
         pos = 0;
         isMusicPlaying = 0;
         isWaitingForSync = 0;
+        catchUp = 0;
         if (nodeid == 0)
             sendData(0x20);
     } else if (current_note == 253) {
-        // Sync signal
-        if (nodeid == 0)
+        // Sync signal, the UART interrupt must not see the count and the
+        // flags half updated
+        EA = 0;
+        markerCount++;
+        if (!catchUp) {
+            isWaitingForSync = 1;
+            request = (nodeid == 0 && !beaconMode);
+        } else if ((uint8)(markerCount - 1) == beaconTarget) {
+            catchUp = 0; // Its beacon has released this marker already
+        }
+        if (markerCount == loopEnd && !catchUp) {
+            // Back to the loop start once this marker has been synced,
+            // skipping the music up to it like after a seek (event 0xD3)
+            pos = 0;
+            markerCount = 0;
+            beaconTarget = loopStart - 1;
+            catchUp = (loopStart != 0);
+        } else {
+            pos++;
+        }
+        EA = 1;
+        if (request)
             sendData(0x70);
-        isWaitingForSync = 1;
-        pos++;
     }
 }
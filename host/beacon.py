@@ -0,0 +1,218 @@
+"""
+Sync by timing beacons from the host, without pausing at markers.
+
+With the stop-and-wait sync every marker is an audible gap: the nodes stop
+there until node 0 has asked for a sync (0x70) and the host has released
+them (0x80) after `sync_waiting_time`. In beacon mode the host broadcasts a
+beacon (0xD2 and the index of the marker, see protocol.md) at the time each
+marker is due by its own clock instead. A node that gets there early waits
+only as long as it is ahead, a node that is behind cuts its current note
+short and skips to the marker. Node 0 sends no sync requests in this mode.
+
+`beacon_times` plans the beacons from the track data packets and
+`send_beacons` sends them on time. `compare` plays a song in both modes on
+the simulator with drifting node clocks:
+
+    python beacon.py song.mid [--drift 3000] [--sync-wait 0.1] [--seed 1]
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable
+
+import host_serial as hs
+import metrics
+import parse_midi as pm
+from sync_tuner import marker_times
+
+# The simulator is only needed by `compare`, the GUI imports this module
+if TYPE_CHECKING:
+    from simulator import SimulatedSerial
+
+BEACON_MODE = 0xFF  # Marker index of the beacon sent right after the start
+# Longest sleep between two polls of keep_running while waiting for a beacon
+POLL_INTERVAL = 0.01
+
+
+def beacon_times(packets: list[bytes]) -> list[float]:
+    """Seconds from the start at which every marker is due.
+
+    Every segment takes as long as in the slowest track, so a node with an
+    exact clock never has to skip music.
+
+    Args:
+        packets (list[bytes]): Packets of the assigned tracks.
+    """
+    times = []
+    t = 0.0
+    for segment in zip(*map(marker_times, packets)):
+        t += max(segment)
+        times.append(t)
+    return times
+
+
+def send_beacons(
+    send: Callable[[bytes], None],
+    times: list[float],
+    keep_running: Callable[[], bool],
+    *,
+    baudrate: int = hs.BAUDRATE,
+    clock: Callable[[], float] = time.perf_counter,
+    sleep: Callable[[float], None] = time.sleep,
+) -> bool:
+    """Send the beacons of a song, starting right after the start command.
+
+    Args:
+        send (Callable[[bytes], None]): Writes a beacon to the bus, e.g.
+            `send_command` of a port or `MultiBusController.broadcast`.
+        times (list[float]): Due times from `beacon_times`.
+        keep_running (Callable[[], bool]): Polled while waiting, sending stops
+            as soon as it reports False.
+        baudrate (int): Baud rate of the bus, beacons are sent ahead by their
+            wire time. Defaults to BAUDRATE.
+        clock, sleep: Time functions, replaceable for simulated buses.
+
+    Returns:
+        bool: True if all beacons have been sent. Node 0 reports the end of
+            the music (0x20) afterwards, e.g. to `serve_sync_requests`.
+    """
+    start = clock()
+    send(bytes([0xD2, BEACON_MODE]))
+    lead = 2 * 10 / baudrate
+    for marker, due in enumerate(times):
+        while (remaining := start + due - lead - clock()) > 0:
+            if not keep_running():
+                return False
+            sleep(min(remaining, POLL_INTERVAL))
+        send(bytes([0xD2, marker & 0xFF]))
+        metrics.inc("stc_beacons_total")
+    return True
+
+
+@dataclass
+class SyncStats:
+    """How the nodes fared at the markers of one simulated run"""
+
+    duration: float = 0.0  # Seconds until node 0 reported the end
+    pauses: list[float] = field(default_factory=list)  # Seconds waited at markers
+    cuts: list[float] = field(default_factory=list)  # Seconds of music skipped
+    drift: float = 0.0  # Largest spread of the nodes arriving at a marker
+    spread: float = 0.0  # Largest spread of the nodes leaving a marker
+    missed: int = 0  # Markers a node never left
+
+    def format_row(self, name: str) -> str:
+        def ms(values: list[float]) -> str:
+            if not values:
+                return "-"
+            return f"{sum(values) / len(values) * 1e3:.1f}/{max(values) * 1e3:.1f}"
+
+        return (
+            f"{name:14} {self.duration:9.3f} {ms(self.pauses):>13} "
+            f"{ms(self.cuts):>13} {self.drift * 1e3:9.2f} {self.spread * 1e3:9.2f} "
+            f"{self.missed:6}"
+        )
+
+
+def _sync_stats(sim: SimulatedSerial, markers: int, duration: float) -> SyncStats:
+    stats = SyncStats(duration)
+    # (would have arrived, left) per node and marker, in time order
+    passes = {}
+    for node_id, node in sim.nodes.items():
+        stats.pauses += [resumed - reached for reached, resumed in node.sync_log]
+        stats.cuts += [cut for _, cut in node.cut_log]
+        passes[node_id] = sorted(
+            node.sync_log + [(t + cut, t) for t, cut in node.cut_log],
+            key=lambda p: p[1],
+        )
+        stats.missed += max(markers - len(passes[node_id]), 0)
+    for marker in range(markers):
+        at_marker = [p[marker] for p in passes.values() if len(p) > marker]
+        if len(at_marker) > 1:
+            arrived, left = zip(*at_marker)
+            stats.drift = max(stats.drift, max(arrived) - min(arrived))
+            stats.spread = max(stats.spread, max(left) - min(left))
+    return stats
+
+
+def compare(
+    byte_list: list[bytes],
+    clock_errors_ppm: dict[int, float],
+    sync_waiting_time: float = 0.1,
+    baudrate: int = hs.BAUDRATE,
+) -> dict[str, SyncStats]:
+    """Play tracks 0-F on simulated nodes with stop-and-wait and with beacons.
+
+    Args:
+        byte_list (list[bytes]): Track N is played by node N.
+        clock_errors_ppm (dict[int, float]): Clock error of every node.
+        sync_waiting_time (float): Wait of the stop-and-wait sync.
+        baudrate (int): Baud rate of the bus. Defaults to BAUDRATE.
+
+    Returns:
+        dict[str, SyncStats]: Results per mode.
+    """
+    from simulator import SimulatedSerial
+
+    packets = byte_list[:16]
+    markers = len(beacon_times(packets))
+    results = {}
+    for mode in ("stop-and-wait", "beacons"):
+        sim = SimulatedSerial(range(len(packets)), baudrate)
+        hs.send_music_data(sim, packets, {})
+        for node_id, node in sim.nodes.items():
+            node.clock_error_ppm = clock_errors_ppm.get(node_id, 0.0)
+        sim.timeout = 0.1
+        hs.send_command(sim, bytes([0x30]))
+        start = sim.now
+        # Runs that never end are cut off well after the expected end
+        limit = start + 2 * max(beacon_times(packets), default=0.0) + 60.0
+        if mode == "beacons":
+            send_beacons(
+                lambda data: hs.send_command(sim, data),
+                beacon_times(packets),
+                lambda: sim.now < limit,
+                baudrate=baudrate,
+                clock=lambda: sim.now,
+                sleep=sim.sleep,
+            )
+            wait = 0.0  # No sync requests come in beacon mode
+        else:
+            wait = sync_waiting_time
+        hs.serve_sync_requests(sim, wait, lambda: sim.now < limit, sleep=sim.sleep)
+        results[mode] = _sync_stats(sim, markers, sim.now - start)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare stop-and-wait and beacon sync on simulated nodes"
+    )
+    parser.add_argument("midi_file")
+    parser.add_argument(
+        "--drift", type=float, default=3000, metavar="PPM", help="largest clock error"
+    )
+    parser.add_argument("--sync-wait", type=float, default=0.1, metavar="SECONDS")
+    parser.add_argument("--baudrate", type=int, default=hs.BAUDRATE)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    byte_list = pm.midi_to_binary_list(args.midi_file, pm.MidiConfig())
+    rng = random.Random(args.seed)
+    errors = {i: rng.uniform(-args.drift, args.drift) for i in range(16)}
+    results = compare(byte_list, errors, args.sync_wait, args.baudrate)
+
+    print(f"{len(beacon_times(byte_list[:16]))} markers, times in ms as mean/max")
+    print(
+        f"{'mode':14} {'duration':>9} {'pause':>13} {'cut':>13} "
+        f"{'drift':>9} {'spread':>9} {'missed':>6}"
+    )
+    for mode, stats in results.items():
+        print(stats.format_row(mode))
+
+
+if __name__ == "__main__":
+    main()
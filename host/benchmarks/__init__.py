@@ -0,0 +1,11 @@
+"""
+Reproducible benchmarks for the host conversion and upload paths.
+
+Run from the `host` directory:
+
+    python -m benchmarks --output benchmarks/results/baseline.json
+    python -m benchmarks --compare benchmarks/results/baseline.json
+
+Inputs are synthetic MIDI files built by `benchmarks.synth` from a fixed
+seed, so results of two runs only differ by the code and the machine.
+"""
@@ -0,0 +1,262 @@
+"""
+Benchmark runner. See `benchmarks/__init__.py` for usage.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import host_serial as hs
+import parse_midi as pm
+import simulator
+from benchmarks.synth import SynthSpec, write
+from multibus import MultiBusController, Target
+
+RESULT_VERSION = 1
+# Read latency of a typical USB-RS485 adapter, in seconds
+ADAPTER_LATENCY = 0.004
+
+CASES = {
+    "small": SynthSpec(tracks=4, notes_per_track=120),
+    "full-bus": SynthSpec(tracks=16, notes_per_track=280, markers=8),
+    "polyphonic": SynthSpec(
+        tracks=8,
+        notes_per_track=600,
+        polyphony=3,
+        tempo_changes=20,
+        cc_per_note=2.0,
+        markers=16,
+    ),
+    "large": SynthSpec(
+        tracks=32,
+        notes_per_track=2000,
+        polyphony=2,
+        tempo_changes=50,
+        cc_per_note=1.0,
+        markers=40,
+    ),
+}
+
+
+def measure(fn: Callable[[], object], repeats: int) -> dict:
+    """Time `fn` after one warm-up call.
+
+    Returns:
+        dict: min/median/mean wall time in seconds over `repeats` calls.
+    """
+    fn()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        fn()
+        samples.append((time.perf_counter_ns() - start) / 1e9)
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "repeats": repeats,
+    }
+
+
+def upload(
+    byte_list: list[bytes], latency: float = 0.0, **kwargs
+) -> simulator.SimulatedSerial:
+    """Upload all tracks to a fresh simulated bus, like the GUI does."""
+    ser = simulator.SimulatedSerial(latency=latency)
+    assignments = {i: "不分配" for i in range(16, len(byte_list))}
+    hs.send_music_data(ser, byte_list, assignments, **kwargs)
+    return ser
+
+
+def upload_doubled(byte_list: list[bytes], fold: bool) -> simulator.SimulatedSerial:
+    """Upload every track to two nodes, like a doubled part."""
+    ser = simulator.SimulatedSerial()
+    hs.send_music_data(ser, byte_list[:8] * 2, {}, fold_duplicates=fold)
+    return ser
+
+
+def upload_multibus(
+    byte_list: list[bytes], bus_count: int
+) -> list[simulator.SimulatedSerial]:
+    """Upload the first 16 tracks to every bus of a fresh multi-bus setup."""
+    buses = [simulator.SimulatedSerial(name=f"sim{i}") for i in range(bus_count)]
+    per_bus = byte_list[:16]
+    assignments = {
+        bus * len(per_bus) + node: Target(bus, node)
+        for bus in range(bus_count)
+        for node in range(len(per_bus))
+    }
+    MultiBusController(buses).upload(per_bus * bus_count, assignments)
+    return buses
+
+
+def run_case(path: str, repeats: int) -> dict:
+    config = pm.MidiConfig()
+    event_list = pm.parse_midi_to_events(path, config)
+    byte_list = [pm.events_to_binary(track) for track in event_list]
+
+    results = {
+        "parse_midi_to_events": measure(
+            lambda: pm.parse_midi_to_events(path, config), repeats
+        ),
+        "events_to_binary": measure(
+            lambda: [pm.events_to_binary(track) for track in event_list], repeats
+        ),
+        "events_to_c_arrays": measure(
+            lambda: pm.events_to_c_arrays(event_list), repeats
+        ),
+        # One packet and response per node, the baseline of the bulk upload
+        "send_music_data": measure(lambda: upload(byte_list, bulk=False), repeats),
+    }
+    # Modelled time on a real 115200 bps bus, independent of the machine
+    results["send_music_data"]["bus_seconds"] = upload(byte_list, bulk=False).now
+    results["send_music_data"]["wire_bytes"] = sum(len(b) for b in byte_list[:16])
+
+    # One bulk frame against one packet and response per node
+    results["bulk_upload"] = measure(lambda: upload(byte_list, bulk=True), repeats)
+    for key, latency in (("bus_seconds", 0.0), ("adapter_seconds", ADAPTER_LATENCY)):
+        results["bulk_upload"][key] = upload(byte_list, latency, bulk=True).now
+        results["bulk_upload"][f"per_node_{key}"] = upload(
+            byte_list, latency, bulk=False
+        ).now
+    results["bulk_upload"]["saved_seconds"] = (
+        results["bulk_upload"]["per_node_adapter_seconds"]
+        - results["bulk_upload"]["adapter_seconds"]
+    )
+
+    # Doubled parts sent once with a multicast upload instead of twice
+    results["multicast_upload"] = measure(
+        lambda: upload_doubled(byte_list, True), repeats
+    )
+    multicast = upload_doubled(byte_list, True).now
+    unicast = upload_doubled(byte_list, False).now
+    results["multicast_upload"]["bus_seconds"] = multicast
+    results["multicast_upload"]["unicast_bus_seconds"] = unicast
+    results["multicast_upload"]["saved_seconds"] = unicast - multicast
+
+    # Four buses carry four times the tracks in the time of one
+    results["multibus_upload"] = measure(lambda: upload_multibus(byte_list, 4), 1)
+    buses = upload_multibus(byte_list, 4)
+    results["multibus_upload"]["bus_seconds"] = max(b.now for b in buses)
+    results["multibus_upload"]["speedup"] = sum(b.now for b in buses) / max(
+        b.now for b in buses
+    )
+    return results
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print a comparison table and return the regressed benchmarks."""
+    regressions = []
+    print(
+        f"\n{'case':<12} {'benchmark':<22} {'baseline':>10} {'current':>10} {'ratio':>7}"
+    )
+    for case, data in current["cases"].items():
+        old_case = baseline.get("cases", {}).get(case)
+        if not old_case or old_case["spec"] != data["spec"]:
+            continue
+        for name, result in data["benchmarks"].items():
+            old = old_case["benchmarks"].get(name)
+            if not old:
+                continue
+            ratio = result["median"] / old["median"]
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  REGRESSION"
+                regressions.append(f"{case}/{name}")
+            print(
+                f"{case:<12} {name:<22} {old['median'] * 1e3:>8.2f}ms "
+                f"{result['median'] * 1e3:>8.2f}ms {ratio:>7.2f}{flag}"
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument(
+        "--case", action="append", choices=sorted(CASES), help="run only these cases"
+    )
+    parser.add_argument("--repeats", type=int, default=7)
+    parser.add_argument(
+        "--quick", action="store_true", help="3 repeats, skip the large case"
+    )
+    parser.add_argument("--output", metavar="PATH", help="write results as JSON")
+    parser.add_argument(
+        "--compare", metavar="PATH", help="compare medians with a previous result"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown reported as a regression (default: 0.1)",
+    )
+    args = parser.parse_args()
+
+    # Upload failures of oversized tracks are expected, keep the output readable
+    logging.disable(logging.CRITICAL)
+    names = args.case or [n for n in CASES if not (args.quick and n == "large")]
+    repeats = 3 if args.quick else args.repeats
+    current = {
+        "version": RESULT_VERSION,
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "cases": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            spec = CASES[name]
+            path = write(spec, os.path.join(tmp, f"{name}.mid"))
+            benchmarks = run_case(path, repeats)
+            current["cases"][name] = {"spec": spec.to_dict(), "benchmarks": benchmarks}
+            for bench, result in benchmarks.items():
+                extra = ""
+                if "bus_seconds" in result:
+                    extra = f"  (bus {result['bus_seconds']:.3f}s)"
+                if "saved_seconds" in result:
+                    extra += f"  saved {result['saved_seconds']:.3f}s"
+                print(
+                    f"{name:<12} {bench:<22} median {result['median'] * 1e3:9.3f}ms"
+                    f"  min {result['min'] * 1e3:9.3f}ms{extra}"
+                )
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Generator of synthetic standard MIDI files for benchmarks.
+"""
+
+import random
+from dataclasses import asdict, dataclass
+
+import mido
+
+
+@dataclass(frozen=True)
+class SynthSpec:
+    """Shape of a synthetic MIDI file"""
+
+    tracks: int = 4
+    notes_per_track: int = 200
+    polyphony: int = 1  # Notes started together in every chord
+    tempo_changes: int = 0
+    cc_per_note: float = 0.0  # Control changes emitted per note on average
+    markers: int = 0
+    ticks_per_beat: int = 480
+    seed: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def generate(spec: SynthSpec) -> mido.MidiFile:
+    """Build a MIDI file following `spec`.
+
+    Notes are drawn from a fixed seed, so the same spec always produces
+    the same file. Tempo changes and markers are placed at evenly spaced
+    times in the first track, like a conductor track exported by a DAW.
+    """
+    rng = random.Random(spec.seed)
+    mid = mido.MidiFile(ticks_per_beat=spec.ticks_per_beat)
+    chords = max(1, spec.notes_per_track // spec.polyphony)
+    step = spec.ticks_per_beat // 2  # Eighth notes
+
+    # Conductor events as (absolute tick, message) of the first track
+    total_ticks = chords * step
+    conductor: list[tuple[int, mido.MetaMessage]] = []
+    for i in range(spec.tempo_changes):
+        tick = total_ticks * i // max(1, spec.tempo_changes)
+        tempo = rng.randint(300000, 800000)
+        conductor.append((tick, mido.MetaMessage("set_tempo", tempo=tempo)))
+    for i in range(spec.markers):
+        # Keep markers off tick 0, the parser ignores markers at time 0
+        tick = total_ticks * (i + 1) // (spec.markers + 1)
+        tick -= tick % step
+        conductor.append((tick, mido.MetaMessage("marker", text=f"M{i + 1}")))
+
+    for track_index in range(spec.tracks):
+        channel = track_index % 16
+        events: list[tuple[int, int, mido.BaseMessage]] = []
+        if track_index == 0:
+            events += [(tick, 0, msg) for tick, msg in conductor]
+
+        base = 48 + (track_index * 7) % 24
+        for chord in range(chords):
+            start = chord * step
+            length = rng.choice((step // 2, step - 10, step))
+            for voice in range(spec.polyphony):
+                note = base + rng.randrange(12) + 12 * (voice % 3)
+                events.append(
+                    (
+                        start,
+                        2,
+                        mido.Message(
+                            "note_on", note=note, velocity=80, channel=channel
+                        ),
+                    )
+                )
+                events.append(
+                    (
+                        start + length,
+                        1,
+                        mido.Message(
+                            "note_off", note=note, velocity=0, channel=channel
+                        ),
+                    )
+                )
+            cc_count = int(spec.cc_per_note * spec.polyphony)
+            if rng.random() < spec.cc_per_note * spec.polyphony - cc_count:
+                cc_count += 1
+            for _ in range(cc_count):
+                events.append(
+                    (
+                        start + rng.randrange(step),
+                        1,
+                        mido.Message(
+                            "control_change",
+                            control=rng.choice((1, 7, 11, 64)),
+                            value=rng.randrange(128),
+                            channel=channel,
+                        ),
+                    )
+                )
+
+        # Note offs sort before note ons at the same tick
+        events.sort(key=lambda e: (e[0], e[1]))
+        track = mido.MidiTrack()
+        last = 0
+        for tick, _, msg in events:
+            track.append(msg.copy(time=tick - last))
+            last = tick
+        track.append(mido.MetaMessage("end_of_track", time=0))
+        mid.tracks.append(track)
+    return mid
+
+
+def write(spec: SynthSpec, path: str) -> str:
+    """Generate a MIDI file and save it to `path`."""
+    generate(spec).save(path)
+    return path
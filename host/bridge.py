@@ -0,0 +1,411 @@
+"""
+TCP bridge for serial ports, for buses out of reach of a USB cable.
+
+On the computer the RS485 adapter is plugged into, run
+
+    python bridge.py serve /dev/ttyUSB0 [--listen 0.0.0.0:7485]
+
+and use `tcp://stage-pc:7485` as the port name on the host.
+`host_serial.open_serial_port` returns a `TcpSerial` for such names, which
+takes the place of an opened `serial.Serial`, so uploads, playback and sync
+work unchanged.
+
+Both directions carry frames of a header, kind (u8), timestamp (u64, ns of
+the sender's `perf_counter_ns`) and payload length (u16), all little-endian,
+followed by the payload:
+
+    DATA    bytes written to the port, or read from it by the bridge
+    CONFIG  baud rate of the port (u32), sent on connect and on changes
+    PING    echoed by the bridge with its own timestamp, the payload is the
+            client's timestamp (u64)
+
+The bridge writes and drains every DATA frame right away and sends what the
+adapter receives as soon as it is read, stamped with the time it was read.
+Nagle's algorithm is disabled on both ends, so a frame is a single segment.
+
+`python bridge.py benchmark` compares round trips through a loopback port
+(`loop://`) opened directly and through a bridge on localhost.
+"""
+
+import argparse
+import logging
+import socket
+import statistics
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+import host_serial as hs
+
+URL_SCHEME = "tcp"
+DEFAULT_PORT = 7485
+CONNECT_TIMEOUT = 5.0
+# Read timeout of the bridge's port, bounds how long a disconnect goes unnoticed
+POLL_INTERVAL = 0.05
+
+# Frame kinds
+DATA = 0
+CONFIG = 1
+PING = 2
+
+_FRAME = struct.Struct("<BQH")
+_BAUDRATE = struct.Struct("<I")
+_STAMP = struct.Struct("<Q")
+MAX_PAYLOAD = 0xFFFF
+
+
+def parse_url(url: str) -> tuple[str, int]:
+    """Host and TCP port of a bridge URL, the port defaults to DEFAULT_PORT."""
+    parts = urlsplit(url)
+    if parts.scheme != URL_SCHEME or not parts.hostname:
+        raise ValueError(f"Not a bridge address: {url}")
+    return parts.hostname, parts.port or DEFAULT_PORT
+
+
+def _pack(kind: int, payload: bytes = b"", stamp: int | None = None) -> bytes:
+    """Frames of a payload, longer payloads are split."""
+    if stamp is None:
+        stamp = time.perf_counter_ns()
+    frames = bytearray()
+    for pos in range(0, max(len(payload), 1), MAX_PAYLOAD):
+        chunk = payload[pos : pos + MAX_PAYLOAD]
+        frames += _FRAME.pack(kind, stamp, len(chunk)) + chunk
+    return bytes(frames)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def _read_frame(sock: socket.socket) -> tuple[int, int, bytes]:
+    """Receive one frame, blocking. Returns kind, timestamp and payload."""
+    kind, stamp, size = _FRAME.unpack(_recv_exact(sock, _FRAME.size))
+    return kind, stamp, _recv_exact(sock, size)
+
+
+class Bridge:
+    """Serve an opened serial port to one TCP client at a time.
+
+    Args:
+        ser (serial.Serial): Port to serve. Its timeout is set to
+            POLL_INTERVAL.
+        host (str): Address to listen on. Defaults to all interfaces.
+        port (int): TCP port, 0 picks a free one. Defaults to DEFAULT_PORT.
+    """
+
+    def __init__(self, ser, host: str = "0.0.0.0", port: int = DEFAULT_PORT):
+        self.ser = ser
+        self.ser.timeout = POLL_INTERVAL
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        self._send_lock = threading.Lock()
+
+    def serve_forever(self):
+        """Serve clients until `close` is called."""
+        logging.info(f"Bridge for {self.ser.name} listening on port {self.address[1]}")
+        while True:
+            try:
+                conn, peer = self.server.accept()
+            except OSError:
+                break  # Closed
+            logging.info(f"Bridge client {peer[0]}:{peer[1]} connected")
+            try:
+                self._serve(conn)
+            finally:
+                conn.close()
+            logging.info(f"Bridge client {peer[0]}:{peer[1]} disconnected")
+
+    def close(self):
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)  # Wakes up accept() on Linux
+        except OSError:
+            pass
+        self.server.close()
+
+    def _send(self, conn: socket.socket, data: bytes):
+        with self._send_lock:
+            conn.sendall(data)
+
+    def _serve(self, conn: socket.socket):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.ser.reset_input_buffer()  # Nobody was listening
+        connected = threading.Event()
+        connected.set()
+        reader = threading.Thread(
+            target=self._forward_reads,
+            args=(conn, connected),
+            name="bridge-reader",
+            daemon=True,
+        )
+        reader.start()
+        try:
+            while True:
+                kind, stamp, payload = _read_frame(conn)
+                if kind == DATA:
+                    self.ser.write(payload)
+                    self.ser.flush()
+                elif kind == CONFIG:
+                    self.ser.baudrate = _BAUDRATE.unpack(payload)[0]
+                    logging.info(f"Bridge port set to {self.ser.baudrate} baud")
+                elif kind == PING:
+                    self._send(conn, _pack(PING, _STAMP.pack(stamp)))
+                else:
+                    logging.warning(f"Ignoring bridge frame of kind {kind}")
+        except (OSError, struct.error) as e:
+            logging.debug(f"Bridge connection ended: {e}")
+        finally:
+            connected.clear()
+            reader.join()
+
+    def _forward_reads(self, conn: socket.socket, connected: threading.Event):
+        while connected.is_set():
+            data = self.ser.read(max(self.ser.in_waiting, 1))
+            if not data:
+                continue
+            try:
+                self._send(conn, _pack(DATA, data))
+            except OSError:
+                break
+
+
+class TcpSerial:
+    """A serial port behind a bridge, used like an opened `serial.Serial`.
+
+    Written bytes are sent as one frame on `flush` or before the next read,
+    so a packet written in several chunks crosses the network at once.
+
+    Args:
+        url (str): Bridge address, e.g. tcp://stage-pc:7485.
+        baudrate (int): Baud rate of the bridged port. Defaults to BAUDRATE.
+        timeout (None | float): Timeout for read operations. Defaults to 2.0.
+    """
+
+    def __init__(
+        self, url: str, baudrate: int = hs.BAUDRATE, timeout: None | float = 2.0
+    ):
+        self.name = url
+        self.port = url
+        self.timeout = timeout
+        # Bridge time (perf_counter_ns) the last bytes read arrived at the adapter
+        self.received_at: int | None = None
+        self._address = parse_url(url)
+        self._sock: socket.socket | None = None
+        self._rx = bytearray()  # Port bytes not read yet
+        self._raw = bytearray()  # Received data of incomplete frames
+        self._tx = bytearray()  # Written bytes not sent yet
+        self._baudrate = baudrate
+        self._pong: tuple[int, int] | None = None  # Bridge and client timestamp
+        self.open()
+
+    @property
+    def is_open(self) -> bool:
+        return self._sock is not None
+
+    def open(self):
+        """Connect to the bridge, it configures the port for `baudrate`."""
+        sock = socket.create_connection(self._address, timeout=CONNECT_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+        self._send(_pack(CONFIG, _BAUDRATE.pack(self._baudrate)))
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    @property
+    def baudrate(self) -> int:
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate: int):
+        self._baudrate = baudrate
+        if self._sock is not None:
+            self._send(_pack(CONFIG, _BAUDRATE.pack(baudrate)))
+
+    def _send(self, frames: bytes):
+        if self._sock is None:
+            raise ConnectionError(f"{self.name} is closed")
+        self._sock.settimeout(CONNECT_TIMEOUT)
+        self._sock.sendall(frames)
+
+    def _receive(self, timeout: None | float) -> bool:
+        """Receive what has arrived within `timeout` and parse whole frames.
+
+        Returns:
+            bool: False if nothing arrived in time.
+        """
+        if self._sock is None:
+            raise ConnectionError(f"{self.name} is closed")
+        self._sock.settimeout(timeout)
+        try:
+            chunk = self._sock.recv(65536)
+        except (TimeoutError, BlockingIOError):
+            return False
+        if not chunk:
+            self.close()
+            raise ConnectionError(f"Bridge {self.name} closed the connection")
+        self._raw += chunk
+        while len(self._raw) >= _FRAME.size:
+            kind, stamp, size = _FRAME.unpack_from(self._raw)
+            if len(self._raw) < _FRAME.size + size:
+                break
+            payload = bytes(self._raw[_FRAME.size : _FRAME.size + size])
+            del self._raw[: _FRAME.size + size]
+            if kind == DATA:
+                self._rx += payload
+                self.received_at = stamp
+            elif kind == PING:
+                self._pong = (stamp, _STAMP.unpack(payload)[0])
+        return True
+
+    def write(self, data) -> int:
+        self._tx += data
+        return len(data)
+
+    def flush(self):
+        if self._tx:
+            self._send(_pack(DATA, bytes(self._tx)))
+            self._tx.clear()
+
+    def read(self, size: int = 1) -> bytes:
+        self.flush()  # A reply can only follow what has been written
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(self._rx) < size:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            self._receive(remaining)
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    @property
+    def in_waiting(self) -> int:
+        while self._receive(0):
+            pass
+        return len(self._rx)
+
+    def read_all(self) -> bytes:
+        return self.read(self.in_waiting)
+
+    def reset_input_buffer(self):
+        self.read_all()
+
+    def ping(self) -> float:
+        """Measure the network round trip to the bridge, without the port.
+
+        Returns:
+            float: Seconds until the echo arrived.
+        """
+        self._pong = None
+        sent = time.perf_counter_ns()
+        self._send(_pack(PING, stamp=sent))
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while self._pong is None or self._pong[1] != sent:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No echo from bridge {self.name}")
+            self._receive(remaining)
+        return (time.perf_counter_ns() - sent) / 1e9
+
+
+def _round_trips(ser, count: int) -> list[float]:
+    """Seconds from writing a byte until it is read back, `count` times."""
+    ser.timeout = 1.0
+    times = []
+    for i in range(count):
+        data = bytes([i & 0xFF])
+        start = time.perf_counter()
+        ser.write(data)
+        ser.flush()
+        if ser.read(1) != data:
+            raise RuntimeError(f"Loopback through {ser.name} lost a byte")
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark(count: int = 1000, port: str = "loop://") -> dict[str, list[float]]:
+    """Round trips of a byte through a port, directly and through a bridge.
+
+    Args:
+        count (int): Round trips per variant. Defaults to 1000.
+        port (str): pyserial URL or device that echoes what is written, e.g.
+            an adapter with RX and TX connected. Defaults to loop://.
+
+    Returns:
+        dict[str, list[float]]: Round trip times per variant, in seconds.
+    """
+    import serial
+
+    results = {}
+    direct = serial.serial_for_url(port, baudrate=hs.BAUDRATE)
+    try:
+        results["direct"] = _round_trips(direct, count)
+    finally:
+        direct.close()
+
+    bridge = Bridge(serial.serial_for_url(port, baudrate=hs.BAUDRATE), "127.0.0.1", 0)
+    server = threading.Thread(target=bridge.serve_forever, daemon=True)
+    server.start()
+    client = TcpSerial(f"{URL_SCHEME}://127.0.0.1:{bridge.address[1]}")
+    try:
+        results["bridge"] = _round_trips(client, count)
+        results["network only"] = [client.ping() for _ in range(count)]
+    finally:
+        client.close()
+        bridge.close()
+        server.join()
+        bridge.ser.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial port bridge over TCP")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("serve", help="serve a serial port to the network")
+    p.add_argument("port", help="serial port, e.g. /dev/ttyUSB0 or COM3")
+    p.add_argument(
+        "--listen",
+        default=f"0.0.0.0:{DEFAULT_PORT}",
+        metavar="ADDRESS:PORT",
+        help=f"address to listen on (default: 0.0.0.0:{DEFAULT_PORT})",
+    )
+    p.add_argument("--baudrate", type=int, default=hs.BAUDRATE)
+    p = subparsers.add_parser("benchmark", help="measure round trips on localhost")
+    p.add_argument("--count", type=int, default=1000)
+    p.add_argument(
+        "--port", default="loop://", help="port echoing its writes (default: loop://)"
+    )
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        print(f"{'variant':14} {'median':>9} {'p99':>9} {'max':>9}  (ms)")
+        for name, times in benchmark(args.count, args.port).items():
+            p99 = statistics.quantiles(times, n=100)[-1]
+            print(
+                f"{name:14} {statistics.median(times) * 1e3:9.3f} "
+                f"{p99 * 1e3:9.3f} {max(times) * 1e3:9.3f}"
+            )
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    host, _, port = args.listen.rpartition(":")
+    bridge = Bridge(
+        hs.open_serial_port(args.port, args.baudrate), host or "0.0.0.0", int(port)
+    )
+    try:
+        bridge.serve_forever()
+    except KeyboardInterrupt:
+        bridge.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Precompiled song bundles, for loading a show without parsing MIDI files.
+
+`compile_bundle` converts one or more MIDI files with
+`midi_to_binary_lists` and stores the ready-to-send packets of the synced
+and the unsynced variant, the default track assignment and per-track
+stats. `Bundle` maps the file into memory: opening it only reads the
+index, and the packets it hands out are memoryview slices of the mapping,
+which `send_track_data` sends without copying them.
+
+Layout, little-endian:
+
+    header: magic "STCB", version (u8), 3 reserved bytes,
+            index offset (u64), index length (u64)
+    packets: track data packets, identical packets are stored once
+    index: UTF-8 JSON with the songs, their tracks and packet positions
+
+Example:
+    python bundle.py compile -o show.stcb opening.mid finale.mid
+    python bundle.py list show.stcb
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+from dataclasses import dataclass
+
+import parse_midi as pm
+import preflight
+
+MAGIC = b"STCB"
+VERSION = 1
+_HEADER = struct.Struct("<4sB3xQQ")
+
+
+@dataclass(frozen=True)
+class TrackInfo:
+    """Stats of a track, from the synced variant"""
+
+    node: str  # Default node ID in hex, or "不分配"
+    entries: int
+    play_seconds: float
+    sync_points: int
+
+
+@dataclass(frozen=True)
+class Song:
+    """A song of a bundle, its packets are views into the mapped file"""
+
+    title: str
+    source: str  # File name of the MIDI file it was compiled from
+    synced: list[memoryview]
+    unsynced: list[memoryview]
+    tracks: list[TrackInfo]
+
+    @property
+    def assignments(self) -> dict[int, str]:
+        """Default track assignment, as for `host_serial.send_music_data`"""
+        return {i: track.node for i, track in enumerate(self.tracks)}
+
+    def packets(self, enable_sync: bool = True) -> list[memoryview]:
+        return self.synced if enable_sync else self.unsynced
+
+
+def default_node(track_index: int) -> str:
+    """Node of a track before any change, same as in the GUI's track table"""
+    return hex(track_index).upper()[2:] if track_index <= 15 else "不分配"
+
+
+def compile_bundle(
+    midi_files: list[str], path: str, config: pm.MidiConfig | None = None
+):
+    """Convert MIDI files into a bundle.
+
+    Args:
+        midi_files (list[str]): Songs in set-list order.
+        path (str): Bundle file to write.
+        config (pm.MidiConfig | None): Conversion settings, `enable_sync`
+            is ignored as both variants are stored. Defaults to MidiConfig().
+    """
+    config = config or pm.MidiConfig()
+    offsets: dict[bytes, int] = {}
+    songs = []
+    with open(path, "wb") as f:
+        f.write(bytes(_HEADER.size))  # Written once the index is known
+
+        def store(packet: bytes) -> list[int]:
+            if packet not in offsets:
+                offsets[packet] = f.tell()
+                f.write(packet)
+            return [offsets[packet], len(packet)]
+
+        for midi_file in midi_files:
+            synced, unsynced = pm.midi_to_binary_lists(midi_file, config)
+            tracks = []
+            for i, (packet, plain) in enumerate(zip(synced, unsynced)):
+                report = preflight.analyze_track(i, packet, default_node(i))
+                tracks.append(
+                    {
+                        "synced": store(packet),
+                        "unsynced": store(plain),
+                        "node": report.node,
+                        "entries": report.entries,
+                        "play_seconds": report.play_seconds,
+                        "sync_points": report.sync_points,
+                    }
+                )
+            songs.append(
+                {
+                    "title": os.path.splitext(os.path.basename(midi_file))[0],
+                    "source": os.path.basename(midi_file),
+                    "tracks": tracks,
+                }
+            )
+
+        index = json.dumps({"songs": songs}, ensure_ascii=False).encode()
+        index_offset = f.tell()
+        f.write(index)
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, index_offset, len(index)))
+
+
+class Bundle:
+    """A bundle mapped into memory.
+
+    The packets of its songs stay valid as long as the bundle is open.
+
+    Args:
+        path (str): Bundle file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset, index_size = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a song bundle of version {VERSION}")
+
+        view = memoryview(self._mmap)
+        index = json.loads(bytes(view[index_offset : index_offset + index_size]))
+        self.songs: list[Song] = []
+        for song in index["songs"]:
+            tracks = song["tracks"]
+            self.songs.append(
+                Song(
+                    title=song["title"],
+                    source=song["source"],
+                    synced=[view[o : o + n] for o, n in (t["synced"] for t in tracks)],
+                    unsynced=[
+                        view[o : o + n] for o, n in (t["unsynced"] for t in tracks)
+                    ],
+                    tracks=[
+                        TrackInfo(
+                            t["node"], t["entries"], t["play_seconds"], t["sync_points"]
+                        )
+                        for t in tracks
+                    ],
+                )
+            )
+
+    def song(self, key: int | str) -> Song:
+        """Look a song up by its position or title."""
+        if isinstance(key, int):
+            return self.songs[key]
+        for song in self.songs:
+            if song.title == key:
+                return song
+        raise KeyError(f"No song {key} in {self.path}")
+
+    def close(self):
+        """Unmap the file. Fails while packets of it are still referenced."""
+        self.songs.clear()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile and inspect song bundles")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("compile", help="convert MIDI files into a bundle")
+    p.add_argument("midi_files", nargs="+")
+    p.add_argument("-o", "--output", required=True)
+    p = subparsers.add_parser("list", help="show the songs of a bundle")
+    p.add_argument("bundle")
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        compile_bundle(args.midi_files, args.output)
+        print(f"{len(args.midi_files)} songs, {os.path.getsize(args.output)} bytes")
+        return
+
+    bundle = Bundle(args.bundle)
+    for i, song in enumerate(bundle.songs):
+        seconds = max((t.play_seconds for t in song.tracks), default=0.0)
+        print(
+            f"{i:3} {song.title} ({song.source}): {len(song.tracks)} tracks, "
+            f"{seconds:.1f} s, {sum(t.sync_points for t in song.tracks)} sync points"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,608 @@
+"""
+Capture and replay of the traffic between the host and the RS485 bus.
+
+`CapturingSerial` wraps an opened port and records every write, flush
+and read of the host code together with a monotonic nanosecond timestamp.
+The capture file is a small header followed by one record per call:
+
+    header: magic "STCC", version (u8), baud rate (u32), wall clock at
+            the start of the capture (i64, ns since the epoch)
+    record: time since the start (u64, ns), kind (u8), length (u16), data
+
+all little-endian. A capture can then be
+
+- decoded into protocol events with the latency of every response
+  (`decode`, `python capture.py decode stage.stccap`),
+- replayed against the host code with `ReplaySerial`, which serves the
+  recorded reads and reports where the host writes something else,
+- fed into a simulated bus with `simulate`, to compare the recorded
+  latencies with the model (`python capture.py simulate stage.stccap`).
+
+Example:
+    ser = CapturingSerial(hs.open_serial_port("/dev/ttyUSB0"), "stage.stccap")
+    hs.send_music_data(ser, byte_list, assignments)
+    ser.close()
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import logging
+import os
+import statistics
+import struct
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, BinaryIO, Callable
+
+import host_serial as hs
+
+if TYPE_CHECKING:
+    import serial
+
+MAGIC = b"STCC"
+VERSION = 1
+CAPTURE_DIR = "captures"  # Default directory of the GUI's captures
+
+# Record kinds
+WRITE = 0  # Bytes written by the host
+READ = 1  # Bytes returned by read(), empty after a timeout
+READ_ALL = 2  # Bytes returned by read_all(), usually discarded
+FLUSH = 3  # flush() returned, the written bytes left the adapter
+
+_HEADER = struct.Struct("<4sBIq")
+_RECORD = struct.Struct("<QBH")
+
+
+@dataclass(frozen=True)
+class Record:
+    """One call on the captured port"""
+
+    time_ns: int  # Since the start of the capture, when the call returned
+    kind: int
+    data: bytes = b""
+
+    @property
+    def time(self) -> float:
+        return self.time_ns / 1e9
+
+
+@dataclass(frozen=True)
+class Capture:
+    """Contents of a capture file"""
+
+    baudrate: int
+    started_ns: int  # Wall clock at the start, ns since the epoch
+    records: list[Record]
+
+
+def default_capture_path(port: str, directory: str = CAPTURE_DIR) -> str:
+    """File name for a new capture of `port`, e.g. `20250101-203000-ttyUSB0.stccap`"""
+    name = os.path.basename(port.rstrip("/\\")) or "port"
+    return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.stccap")
+
+
+class CapturingSerial:
+    """Record the traffic of a serial port while passing it through.
+
+    Other attributes are forwarded to the wrapped port, so the object can
+    be used wherever `host_serial` expects a `serial.Serial`.
+
+    Args:
+        ser (serial.Serial): Opened port to wrap, e.g. a `SimulatedSerial`.
+        file (str | BinaryIO): Capture file name or binary file object.
+        clock (Callable[[], int]): Monotonic time in ns. Defaults to
+            `time.monotonic_ns`, pass the virtual clock of simulated buses.
+    """
+
+    def __init__(
+        self,
+        ser: serial.Serial,
+        file: str | BinaryIO,
+        clock: Callable[[], int] = time.monotonic_ns,
+    ):
+        if isinstance(file, str):
+            os.makedirs(os.path.dirname(file) or ".", exist_ok=True)
+            file = open(file, "wb")
+        baudrate = getattr(ser, "baudrate", 0) or 0
+        file.write(_HEADER.pack(MAGIC, VERSION, baudrate, time.time_ns()))
+        # Set through __dict__, attribute assignment is forwarded
+        self.__dict__.update(
+            ser=ser, file=file, clock=clock, _start=clock(), _lock=threading.Lock()
+        )
+
+    def _record(self, kind: int, data: bytes = b""):
+        with self._lock:
+            if self.file.closed:
+                return
+            # A u16 holds the length, longer calls are split
+            for pos in range(0, max(len(data), 1), 0xFFFF):
+                chunk = data[pos : pos + 0xFFFF]
+                stamp = self.clock() - self._start
+                self.file.write(_RECORD.pack(stamp, kind, len(chunk)) + chunk)
+
+    def write(self, data) -> int:
+        written = self.ser.write(data)
+        self._record(WRITE, bytes(data))
+        return written
+
+    def flush(self):
+        self.ser.flush()
+        self._record(FLUSH)
+        # Keep the file current in case the program dies on stage
+        with self._lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def read(self, size: int = 1) -> bytes:
+        data = self.ser.read(size)
+        self._record(READ, data)
+        return data
+
+    def read_all(self) -> bytes:
+        data = self.ser.read_all()
+        self._record(READ_ALL, data)
+        return data
+
+    def close(self):
+        self.ser.close()
+        with self._lock:
+            self.file.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+        # timeout, baudrate etc. belong to the wrapped port
+        setattr(self.ser, name, value)
+
+
+def parse_capture(data: bytes) -> Capture:
+    """Parse the contents of a capture file."""
+    magic, version, baudrate, started_ns = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a capture file or unsupported version")
+    records = []
+    pos = _HEADER.size
+    while pos + _RECORD.size <= len(data):
+        time_ns, kind, size = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        records.append(Record(time_ns, kind, data[pos : pos + size]))
+        pos += size
+    return Capture(baudrate, started_ns, records)
+
+
+def write_capture(path: str, capture: Capture):
+    """Save a capture, e.g. the result of `simulate`."""
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, capture.baudrate, capture.started_ns))
+        for record in capture.records:
+            f.write(_RECORD.pack(record.time_ns, record.kind, len(record.data)))
+            f.write(record.data)
+
+
+def read_capture(path: str) -> Capture:
+    """Load a capture file."""
+    with open(path, "rb") as f:
+        return parse_capture(f.read())
+
+
+class ReplaySerial:
+    """Serve the reads of a capture to host code and check what it writes.
+
+    The host code should repeat the captured calls: every read returns the
+    bytes recorded for it, and written bytes are compared with the
+    recorded ones. Differences are logged and collected in `mismatches`.
+    Nothing sleeps, `now` is the capture time of the last served record.
+
+    Example:
+        ser = ReplaySerial(read_capture("stage.stccap"))
+        hs.send_music_data(ser, byte_list, assignments)
+        assert not ser.mismatches and not ser.remaining
+    """
+
+    def __init__(self, capture: Capture, *, name: str = "replay"):
+        self.capture = capture
+        self.baudrate = capture.baudrate
+        self.timeout: None | float = 2.0
+        self.name = name
+        self.port = name
+        self.is_open = True
+        self.now = 0.0
+        self.mismatches: list[str] = []
+        self._index = 0
+        self._expected = bytearray()  # Recorded host bytes not written yet
+
+    @property
+    def remaining(self) -> int:
+        """Number of records the host code has not repeated"""
+        return len(self.capture.records) - self._index
+
+    def _next(self, *kinds: int) -> Record | None:
+        """Consume the next record, skipping flushes, if it is of `kinds`."""
+        records = self.capture.records
+        while self._index < len(records) and records[self._index].kind == FLUSH:
+            self._index += 1
+        if self._index == len(records) or records[self._index].kind not in kinds:
+            return None
+        record = records[self._index]
+        self._index += 1
+        self.now = record.time
+        return record
+
+    def _mismatch(self, message: str):
+        message = f"{message} at {self.now:.6f} s"
+        logging.warning(f"Replay diverges: {message}")
+        self.mismatches.append(message)
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        # Recorded writes may be split differently than the replayed ones
+        while len(self._expected) < len(data):
+            record = self._next(WRITE)
+            if record is None:
+                break
+            self._expected += record.data
+        expected = bytes(self._expected[: len(data)])
+        del self._expected[: len(data)]
+        if expected != data:
+            pos = next(
+                (i for i, (a, b) in enumerate(zip(data, expected)) if a != b),
+                min(len(data), len(expected)),
+            )
+            self._mismatch(
+                f"byte {pos} of {len(data)} written differs, wrote "
+                f"{data[pos : pos + 8].hex() or 'none'}, "
+                f"captured {expected[pos : pos + 8].hex() or 'none'}"
+            )
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _read(self, kind: int) -> bytes:
+        if self._expected:
+            self._mismatch(f"read before writing {len(self._expected)} captured bytes")
+            self._expected.clear()
+        record = self._next(kind)
+        if record is None:
+            self._mismatch("read that has not been captured")
+            return b""
+        return record.data
+
+    def read(self, size: int = 1) -> bytes:
+        data = self._read(READ)
+        if len(data) > size:
+            self._mismatch(f"read {size} bytes, captured {len(data)}")
+        return data[:size]
+
+    def read_all(self) -> bytes:
+        return self._read(READ_ALL)
+
+    @property
+    def in_waiting(self) -> int:
+        records = self.capture.records
+        index = self._index
+        while index < len(records) and records[index].kind == FLUSH:
+            index += 1
+        if index < len(records) and records[index].kind == READ:
+            return len(records[index].data)
+        return 0
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def simulate(capture: Capture, node_ids=range(16), *, latency: float = 0.0) -> Capture:
+    """Replay the host side of a capture on a simulated bus.
+
+    Host writes keep their distance to the previous call, so sync waits
+    and user actions last as long as on stage, while everything on the bus
+    follows the simulator. The simulated nodes start empty, so the capture
+    should include the upload of the music they play.
+
+    Args:
+        capture (Capture): Recorded traffic.
+        node_ids: Nodes of the simulated bus. Defaults to all 16.
+        latency (float): Adapter latency, see `SimulatedSerial`.
+
+    Returns:
+        Capture: The traffic of the simulated run.
+    """
+    from simulator import SimulatedSerial
+
+    sim = SimulatedSerial(
+        node_ids, capture.baudrate or 115200, timeout=2.0, latency=latency
+    )
+    out = io.BytesIO()
+    ser = CapturingSerial(sim, out, clock=lambda: round(sim.now * 1e9))
+
+    prev_recorded = 0.0  # Capture time of the previous call
+    prev_simulated = 0.0  # Virtual time after the previous call
+    for record in capture.records:
+        # Time the host spent between the calls, e.g. sleeping
+        target = prev_simulated + record.time - prev_recorded
+        if record.kind == WRITE:
+            sim.sleep(max(target - sim.now, 0.0))
+            ser.write(record.data)
+        elif record.kind == FLUSH:
+            ser.flush()
+        elif record.kind == READ_ALL:
+            sim.sleep(max(target - sim.now, 0.0))
+            ser.read_all()
+        elif record.data:
+            ser.read(len(record.data))
+        else:
+            # A timeout, the host waited without receiving anything
+            sim.sleep(max(target - sim.now, 0.0))
+        prev_recorded = record.time
+        prev_simulated = sim.now
+    return parse_capture(out.getvalue())
+
+
+@dataclass(frozen=True)
+class Event:
+    """A protocol event found in a capture"""
+
+    time: float  # Seconds since the start, when the frame left the host
+    kind: int  # WRITE for frames of the host, READ for bytes of the nodes
+    name: str  # e.g. "upload", "ack", "sync request"
+    description: str
+    data: bytes
+    answers: str | None = None  # Name of the request a response belongs to
+    latency: float | None = None  # Seconds since that request was sent
+
+
+HOST_EVENTS = {
+    0x3: "start",
+    0x4: "stop",
+    0x5: "preview",
+    0x6: "stop node",
+    0x8: "sync release",
+    0x9: "load built-in",
+    0xB: "probe",
+    0xC: "live note",
+}
+NODE_EVENTS = {
+    0x20: "music end",
+    0x70: "sync request",
+    0xE0: "ack",
+    0xE1: "probe reply",
+    0xF0: "checksum error",
+    0xF1: "size error",
+}
+
+
+def _frame_length(frame: bytes) -> int | None:
+    """Total length of a host frame, None while the header is incomplete."""
+    event, param = frame[0] >> 4, frame[0] & 0x0F
+    if event == 0x1:
+        head = 3  # Header, size
+    elif event == 0xA or (event == 0xD and param == 0):
+        head = 5  # Header, offset or mask, size
+    elif event == 0xD and param == 1:
+        if len(frame) < 2:
+            return None
+        count = frame[1]
+        head = 2 + 3 * count
+        if len(frame) < head:
+            return None
+        sizes = [frame[3 + 3 * i] << 8 | frame[4 + 3 * i] for i in range(count)]
+        return head + sum(sizes) + count
+    elif event == 0xC or (event == 0xD and param == 2):
+        return 2  # Header, note or marker
+    elif event == 0xD and param == 3:
+        return 3  # Header, start and loop end marker
+    elif event == 0xD and param == 4:
+        return 3  # Header, tempo scale and transposition
+    else:
+        return 1
+    if len(frame) < head:
+        return None
+    return head + (frame[head - 2] << 8 | frame[head - 1]) + 1
+
+
+def _xor(data) -> int:
+    checksum = 0
+    for dt in data:
+        checksum ^= dt
+    return checksum
+
+
+def _describe_frame(frame: bytes) -> tuple[str, str, list[int]]:
+    """Name, description and the nodes expected to respond."""
+    event, param = frame[0] >> 4, frame[0] & 0x0F
+    if event == 0x1:
+        ok = _xor(frame[3:-1]) == frame[-1]
+        entries = (len(frame) - 4) // 3
+        text = f"upload to node {param:X}, {entries} entries"
+        return "upload", text + ("" if ok else " (bad checksum)"), [param]
+    if event == 0xA:
+        ok = _xor(frame[1:3] + frame[5:-1]) == frame[-1]
+        offset = frame[1] << 8 | frame[2]
+        text = (
+            f"patch node {param:X} at entry {offset}, {(len(frame) - 6) // 3} entries"
+        )
+        return "patch", text + ("" if ok else " (bad checksum)"), [param]
+    if event == 0xD and param == 0:
+        mask = frame[1] << 8 | frame[2]
+        nodes = [n for n in range(16) if mask >> n & 1]
+        ok = _xor(frame[5:-1]) == frame[-1]
+        text = f"multicast to nodes {','.join(f'{n:X}' for n in nodes)}"
+        text += f", {(len(frame) - 6) // 3} entries"
+        return "multicast", text + ("" if ok else " (bad checksum)"), nodes
+    if event == 0xD and param == 1:
+        count = frame[1]
+        pos = 2 + 3 * count
+        segments = []
+        for i in range(count):
+            node = frame[2 + 3 * i]
+            size = frame[3 + 3 * i] << 8 | frame[4 + 3 * i]
+            ok = _xor(frame[pos : pos + size]) == frame[pos + size]
+            segments.append(f"{node:X}:{size // 3}" + ("" if ok else "!"))
+            pos += size + 1
+        nodes = sorted(frame[2 + 3 * i] for i in range(count))
+        return "bulk", f"bulk upload, node:entries {' '.join(segments)}", nodes
+    if event == 0xD and param == 2:
+        # 0xFF right after the start switches the nodes to beacon mode
+        return "beacon", f"beacon of marker {frame[1]}", []
+    if event == 0xD and param == 3:
+        text = f"start after marker {frame[1]}"
+        if frame[2] > frame[1]:
+            text += f", loop back at marker {frame[2]}"
+        return "seek", text, []
+    if event == 0xD and param == 4:
+        transpose = frame[2] - 0x100 if frame[2] & 0x80 else frame[2]
+        scale = frame[1] / hs.TEMPO_UNIT
+        text = f"durations x{scale:.3f}, transpose {transpose:+d} semitones"
+        return "modifier", text, []
+    name = HOST_EVENTS.get(event)
+    if name is None:
+        return "unknown", f"unknown byte {frame[0]:02x}", []
+    if event in (0x5, 0x6, 0xB):
+        return name, f"{name} node {param:X}", [param] if event == 0xB else []
+    if event == 0x9:
+        return name, f"load built-in music {param}", []
+    if event == 0xC:
+        note = "stop" if frame[1] > 127 else f"note {frame[1]}"
+        return name, f"live {note} on node {param:X}", []
+    return name, name, []
+
+
+def decode(capture: Capture) -> list[Event]:
+    """Annotate a capture with the protocol events of `protocol.md`.
+
+    Host frames are reassembled across writes and stamped with the time
+    they left the host (the following flush, if any). Responses of the
+    nodes are matched with the frame they answer in the order the nodes
+    respond, and 0x80 with the preceding sync request.
+    """
+    events: list[Event] = []
+    requests: dict[int, int] = {}  # Response index -> request index
+    frame = bytearray()
+    unflushed: list[int] = []  # Indices of frames not flushed yet
+    expected: list[tuple[int, int]] = []  # (request index, node) to answer
+    sync_request: int | None = None
+
+    for record in capture.records:
+        if record.kind == FLUSH:
+            for i in unflushed:
+                events[i] = replace(events[i], time=record.time)
+            unflushed.clear()
+        elif record.kind == WRITE:
+            for dt in record.data:
+                frame.append(dt)
+                if _frame_length(frame) != len(frame):
+                    continue
+                name, text, nodes = _describe_frame(bytes(frame))
+                event = Event(record.time, WRITE, name, text, bytes(frame))
+                if name == "sync release" and sync_request is not None:
+                    event = replace(event, answers="sync request")
+                    requests[len(events)] = sync_request
+                    sync_request = None
+                if nodes:
+                    # A new request makes pending responses obsolete
+                    expected = [(len(events), node) for node in nodes]
+                unflushed.append(len(events))
+                events.append(event)
+                frame.clear()
+        else:
+            for dt in record.data:
+                name = NODE_EVENTS.get(dt, "unknown")
+                event = Event(record.time, READ, name, "", bytes([dt]))
+                if dt in (0x20, 0x70):
+                    if dt == 0x70:
+                        sync_request = len(events)
+                    event = replace(event, description=f"{name} from node 0")
+                elif expected:
+                    request, node = expected.pop(0)
+                    answers = events[request].name
+                    requests[len(events)] = request
+                    event = replace(
+                        event,
+                        description=f"{name} from node {node:X} to {answers}",
+                        answers=answers,
+                    )
+                else:
+                    event = replace(event, description=f"unsolicited {name}")
+                events.append(event)
+
+    # Latencies, now that all frames have their final send time
+    for response, request in requests.items():
+        latency = events[response].time - events[request].time
+        events[response] = replace(events[response], latency=latency)
+    return events
+
+
+def summarize(events: list[Event]) -> dict[tuple[str, str], list[float]]:
+    """Latencies grouped by (request, response) name."""
+    groups: dict[tuple[str, str], list[float]] = {}
+    for event in events:
+        if event.latency is not None:
+            groups.setdefault((event.answers, event.name), []).append(event.latency)
+    return groups
+
+
+def format_summary(events: list[Event]) -> str:
+    """Table of the latencies per request and response, in ms."""
+    lines = [f"{'request':<14}{'response':<16}{'count':>6}   min / median / max"]
+    for (request, response), latencies in sorted(summarize(events).items()):
+        low, mid, high = (f(latencies) * 1e3 for f in (min, statistics.median, max))
+        lines.append(
+            f"{request:<14}{response:<16}{len(latencies):>6}"
+            f"   {low:.2f} / {mid:.2f} / {high:.2f} ms"
+        )
+    return "\n".join(lines)
+
+
+def format_events(events: list[Event]) -> str:
+    lines = []
+    for event in events:
+        arrow = "->" if event.kind == WRITE else "<-"
+        latency = "" if event.latency is None else f"  (+{event.latency * 1e3:.2f} ms)"
+        lines.append(f"{event.time:12.6f} {arrow} {event.description}{latency}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect bus captures")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("decode", help="list the protocol events")
+    p.add_argument("capture")
+    p.add_argument("--summary", action="store_true", help="latencies only")
+    p = subparsers.add_parser("simulate", help="replay on a simulated bus")
+    p.add_argument("capture")
+    p.add_argument("--nodes", default="0-F", help="nodes on the bus, e.g. 0-7 or 0,3,5")
+    p.add_argument("--latency", type=float, default=0.0, metavar="SECONDS")
+    p.add_argument("-o", "--output", help="save the simulated traffic")
+    args = parser.parse_args()
+
+    capture = read_capture(args.capture)
+    if args.command == "decode":
+        events = decode(capture)
+        if not args.summary:
+            print(format_events(events))
+            print()
+        print(format_summary(events))
+        return
+
+    node_ids = set()
+    for part in args.nodes.split(","):
+        first, _, last = part.partition("-")
+        node_ids.update(range(int(first, 16), int(last or first, 16) + 1))
+    simulated = simulate(capture, sorted(node_ids), latency=args.latency)
+    if args.output:
+        write_capture(args.output, simulated)
+    print("captured:")
+    print(format_summary(decode(capture)))
+    print("\nsimulated:")
+    print(format_summary(decode(simulated)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Headless entry point of the host program.
+
+Examples:
+    python cli.py upload song.mid --port /dev/ttyUSB0 --port /dev/ttyUSB1
+    python cli.py play song.mid --port /dev/ttyUSB0 --assign 0=0:0 --assign 1=0:3
+    python cli.py play show.stcb --song finale --port /dev/ttyUSB0
+
+With several `--port` options, track N goes to bus N // 16, node N % 16
+unless `--assign TRACK=BUS:NODE` options are given.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import host_serial as hs
+import parse_midi as pm
+import sync_tuner
+from beacon import beacon_times, send_beacons
+from bundle import Bundle
+from capture import CapturingSerial
+from multibus import MultiBusController, Target, default_assignments
+
+
+def load_packets(args) -> list[bytes]:
+    if args.midi_file.endswith(".stcb"):
+        # Precompiled, the packets are sent straight from the mapped file
+        song = Bundle(args.midi_file).song(
+            int(args.song) if args.song.isdigit() else args.song
+        )
+        return song.packets(enable_sync=not args.no_sync)
+    config = pm.MidiConfig(enable_sync=not args.no_sync)
+    return pm.midi_to_binary_list(args.midi_file, config)
+
+
+def parse_assignments(args, track_count: int) -> dict[int, Target]:
+    if not args.assign:
+        return default_assignments(track_count, len(args.port))
+    assignments = {}
+    for item in args.assign:
+        try:
+            track, target = item.split("=")
+            track_index, target = int(track, 16), Target.parse(target)
+        except ValueError:
+            args.error(f"invalid --assign {item}, expected TRACK=BUS:NODE")
+        if not 0 <= track_index < track_count:
+            args.error(f"--assign {item}: the song has tracks 0-{track_count - 1:X}")
+        if target.bus >= len(args.port):
+            args.error(f"--assign {item}: there is no --port for bus {target.bus}")
+        if target in assignments.values():
+            args.error(f"--assign {item}: {target} already has a track")
+        assignments[track_index] = target
+    return assignments
+
+
+def open_controller(args) -> MultiBusController:
+    buses = [hs.open_serial_port(p, args.baudrate) for p in args.port]
+    if args.capture:
+        # One capture per bus, numbered when there are several
+        stem, ext = os.path.splitext(args.capture)
+        buses = [
+            CapturingSerial(
+                ser, f"{stem}-bus{i}{ext}" if len(buses) > 1 else args.capture
+            )
+            for i, ser in enumerate(buses)
+        ]
+    return MultiBusController(buses)
+
+
+def upload(
+    controller: MultiBusController,
+    byte_list: list[bytes],
+    assignments: dict[int, Target],
+) -> bool:
+    results = controller.upload(byte_list, assignments)
+    failed = [i for i, ok in results.items() if not ok]
+    for track_index in failed:
+        print(f"track {track_index:X} -> {assignments[track_index]}: failed")
+    print(f"{len(results) - len(failed)}/{len(results)} tracks transmitted")
+    return not failed
+
+
+def cmd_upload(args) -> int:
+    byte_list = load_packets(args)
+    assignments = parse_assignments(args, len(byte_list))
+    controller = open_controller(args)
+    return 0 if upload(controller, byte_list, assignments) else 1
+
+
+def cmd_play(args) -> int:
+    seeking = args.start_marker or args.loop_end
+    if seeking and args.no_sync:
+        print("--start-marker and --loop-end need sync markers", file=sys.stderr)
+        return 2
+    try:
+        hs.start_command(args.start_marker, args.loop_end)
+        hs.modifier_command(args.tempo, args.transpose)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    byte_list = load_packets(args)
+    assignments = parse_assignments(args, len(byte_list))
+    controller = open_controller(args)
+    if not args.no_upload and not upload(controller, byte_list, assignments):
+        return 1
+    if args.no_upload:
+        # Without an upload, assume node 0 of every bus holds a track
+        controller.sync_buses = set(range(len(controller.buses)))
+    for ser in controller.buses:
+        ser.timeout = 0.1
+    # Node 0 of bus 0 first, its requests are the ones observed
+    tracks = sorted(
+        assignments, key=lambda i: (assignments[i].bus, assignments[i].node)
+    )
+    packets = [byte_list[i] for i in tracks]
+    # The learned waits and the beacons follow the markers from the beginning,
+    # the waits are learned at the original tempo
+    tuner = None
+    if (
+        args.adaptive_sync
+        and not args.no_sync
+        and not args.beacons
+        and not seeking
+        and args.tempo == 1.0
+    ):
+        tuner = sync_tuner.SyncTuner(
+            packets, args.sync_wait, sync_tuner.sidecar_path(args.midi_file)
+        )
+    # Nodes keep the tempo and key of earlier runs, so they are always set
+    controller.modify(args.tempo, args.transpose)
+    skew = controller.start(args.start_marker, args.loop_end)
+    print(f"playing, start skew between buses {skew * 1e6:.0f} us")
+    if tuner:
+        tuner.begin()
+    try:
+        if args.beacons and not args.no_sync and not seeking:
+            scale = hs.tempo_scale(args.tempo) / hs.TEMPO_UNIT
+            send_beacons(
+                controller.broadcast,
+                [t * scale for t in beacon_times(packets)],
+                lambda: True,
+                baudrate=args.baudrate,
+            )
+        controller.serve_sync_requests(
+            tuner.wait if tuner else args.sync_wait, lambda: True
+        )
+    except KeyboardInterrupt:
+        controller.stop()
+    if tuner:
+        tuner.finish()
+    return 0
+
+
+def cmd_stop(args) -> int:
+    open_controller(args).stop()
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="STC-Choir headless control")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.set_defaults(error=parser.error)  # Reports bad options found later
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_bus_options(p):
+        p.add_argument(
+            "--port",
+            action="append",
+            required=True,
+            help="serial port of a bus, repeat for several buses",
+        )
+        p.add_argument("--baudrate", type=int, default=hs.BAUDRATE)
+        p.add_argument(
+            "--capture", metavar="FILE", help="record the bus traffic, see capture.py"
+        )
+
+    def add_song_options(p):
+        p.add_argument("midi_file", help="MIDI file or song bundle, see bundle.py")
+        p.add_argument(
+            "--assign",
+            action="append",
+            metavar="TRACK=BUS:NODE",
+            help="hexadecimal track and node, e.g. 1A=1:A",
+        )
+        p.add_argument("--no-sync", action="store_true", help="ignore sync markers")
+        p.add_argument(
+            "--song", default="0", help="title or number of a song in a .stcb bundle"
+        )
+
+    p = subparsers.add_parser("upload", help="upload a MIDI file to the buses")
+    add_song_options(p)
+    add_bus_options(p)
+    p.set_defaults(func=cmd_upload)
+
+    p = subparsers.add_parser("play", help="upload, play and answer sync requests")
+    add_song_options(p)
+    add_bus_options(p)
+    p.add_argument("--no-upload", action="store_true", help="play what nodes hold")
+    p.add_argument("--sync-wait", type=float, default=0.1, metavar="SECONDS")
+    p.add_argument(
+        "--adaptive-sync",
+        action="store_true",
+        help="learn the wait of every marker, see sync_tuner.py",
+    )
+    p.add_argument(
+        "--beacons",
+        action="store_true",
+        help="release markers by timing beacons instead of pausing, see beacon.py",
+    )
+    p.add_argument(
+        "--start-marker",
+        type=int,
+        default=0,
+        metavar="N",
+        help="start after the N-th sync marker",
+    )
+    p.add_argument(
+        "--loop-end",
+        type=int,
+        default=0,
+        metavar="M",
+        help="jump back to the start marker at the M-th sync marker until stopped",
+    )
+    p.add_argument(
+        "--tempo",
+        type=float,
+        default=1.0,
+        metavar="FACTOR",
+        help="playback speed relative to the song, e.g. 0.8",
+    )
+    p.add_argument(
+        "--transpose", type=int, default=0, metavar="SEMITONES", help="e.g. -2"
+    )
+    p.set_defaults(func=cmd_play)
+
+    p = subparsers.add_parser("stop", help="stop playback on all buses")
+    add_bus_options(p)
+    p.set_defaults(func=cmd_stop)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
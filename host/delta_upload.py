@@ -0,0 +1,196 @@
+"""
+Upload only the entries of a track that changed since the last upload.
+
+Nodes keep their music data until they are powered off, so after a few
+notes have been edited most of a re-upload repeats what the nodes already
+hold. `DeltaUploader` remembers the last acknowledged packet of every node
+and sends the differing entry ranges as patch events (0xA_). When the
+patches would take longer than the whole track, e.g. because inserted
+notes shifted every later entry, it falls back to a full upload.
+
+The cache cannot tell when a node has been power-cycled, loaded built-in
+music or received data from another program. Call `forget()` whenever
+that may have happened.
+"""
+
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import host_serial as hs
+from parse_midi import ENTRY_SIZE
+
+if TYPE_CHECKING:
+    import serial
+
+PATCH_FRAMING = 6  # Header, offset, size and checksum of a patch packet
+# Seconds every packet costs on top of its bytes: flush, half-duplex
+# turnaround and the wait for the response
+TURNAROUND = 0.002
+
+
+@dataclass(frozen=True)
+class Patch:
+    """Entries to write from `offset` on"""
+
+    offset: int
+    entries: bytes
+
+
+def entries_of(packet: bytes) -> bytes:
+    """Data section of a track data packet, without header, size and checksum."""
+    return bytes(packet[3:-1])
+
+
+def diff_runs(old: bytes, new: bytes) -> list[tuple[int, int]]:
+    """Find the entries of `new` that differ from `old`.
+
+    Returns:
+        list[tuple[int, int]]: (first, end) entry index ranges, end excluded.
+    """
+    runs = []
+    start = None
+    for i in range(len(new) // ENTRY_SIZE):
+        pos = i * ENTRY_SIZE
+        changed = new[pos : pos + ENTRY_SIZE] != old[pos : pos + ENTRY_SIZE]
+        if changed and start is None:
+            start = i
+        elif not changed and start is not None:
+            runs.append((start, i))
+            start = None
+    if start is not None:
+        runs.append((start, len(new) // ENTRY_SIZE))
+    return runs
+
+
+def plan_patches(
+    old: bytes, new: bytes, baudrate: int = hs.BAUDRATE
+) -> list[Patch] | None:
+    """Choose the patches that turn `old` entries into `new` the fastest.
+
+    Neighbouring runs are merged when resending the unchanged entries in
+    between is cheaper than another packet.
+
+    Args:
+        old (bytes): Entries the node holds.
+        new (bytes): Entries the node should hold.
+        baudrate (int): Baud rate of the bus. Defaults to BAUDRATE.
+
+    Returns:
+        list[Patch] | None: Patches to send, None if a full upload is faster.
+    """
+    byte_time = 10 / baudrate
+    packet_cost = PATCH_FRAMING * byte_time + TURNAROUND
+
+    merged: list[list[int]] = []
+    for start, end in diff_runs(old, new):
+        gap = start - merged[-1][1] if merged else 0
+        if merged and gap * ENTRY_SIZE * byte_time < packet_cost:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+
+    cost = sum(
+        packet_cost + (end - start) * ENTRY_SIZE * byte_time for start, end in merged
+    )
+    full_cost = (len(new) + 4) * byte_time + TURNAROUND
+    if cost >= full_cost:
+        return None
+    return [
+        Patch(start, new[start * ENTRY_SIZE : end * ENTRY_SIZE])
+        for start, end in merged
+    ]
+
+
+class DeltaUploader:
+    """Track what every node holds and upload the differences only."""
+
+    def __init__(self):
+        self.acked: dict[int, bytes] = {}  # Node ID -> entries it acknowledged
+
+    def forget(self, node_id: int | None = None):
+        """Drop the cached data of a node, or of all nodes with None."""
+        if node_id is None:
+            self.acked.clear()
+        else:
+            self.acked.pop(node_id, None)
+
+    def plan(
+        self, node_id: int, track_data: bytes, baudrate: int = hs.BAUDRATE
+    ) -> list[Patch] | None:
+        """Patches bringing `node_id` up to date, None for a full upload."""
+        old = self.acked.get(node_id)
+        if old is None or not track_data:
+            return None
+        return plan_patches(old, entries_of(track_data), baudrate)
+
+    def send_track_data(
+        self, ser: serial.Serial, node_id: int, track_data: bytes
+    ) -> bool:
+        """Bring a single node up to date, like `host_serial.send_track_data`."""
+        baudrate = getattr(ser, "baudrate", hs.BAUDRATE)
+        patches = self.plan(node_id, track_data, baudrate)
+        if patches == []:
+            logging.info(f"Node {node_id:X} is up to date")
+            return True
+        if patches is not None:
+            size = sum(len(p.entries) + PATCH_FRAMING for p in patches)
+            logging.info(
+                f"Patching node {node_id:X} with {len(patches)} patch(es), "
+                f"{size} bytes instead of {len(track_data)}"
+            )
+            if all(
+                hs.send_patch_data(ser, node_id, p.offset, p.entries) for p in patches
+            ):
+                self.acked[node_id] = entries_of(track_data)
+                return True
+            logging.warning(f"Patching node {node_id:X} failed, sending whole track")
+
+        self.acked.pop(node_id, None)
+        if hs.send_track_data(ser, node_id, track_data):
+            self.acked[node_id] = entries_of(track_data)
+            return True
+        return False
+
+    def send_music_data(
+        self,
+        ser: serial.Serial,
+        byte_list: list[bytes],
+        track_assignments: dict[int, str],
+    ) -> int:
+        """Upload tracks like `host_serial.send_music_data`, patching known nodes.
+
+        Returns:
+            int: Number of successfully transmitted tracks
+        """
+        uploads: dict[int, int] = {}  # Track index -> node ID
+        for track_index in range(len(byte_list)):
+            node_id = track_assignments.get(track_index, hex(track_index).upper()[2:])
+            if node_id != "不分配":
+                uploads[track_index] = int(node_id, 16)
+        node_uses: dict[int, int] = {}
+        for node_id in uploads.values():
+            node_uses[node_id] = node_uses.get(node_id, 0) + 1
+
+        success_count = 0
+        remaining = dict(track_assignments)
+        for track_index, node_id in uploads.items():
+            if node_id not in self.acked or node_uses[node_id] > 1:
+                continue
+            remaining[track_index] = "不分配"
+            if self.send_track_data(ser, node_id, byte_list[track_index]):
+                success_count += 1
+            else:
+                logging.error(f"Track {track_index} transmission failed.")
+
+        def remember(track_index: int, node_id: int, success: bool):
+            if success:
+                self.acked[node_id] = entries_of(byte_list[track_index])
+            else:
+                self.acked.pop(node_id, None)
+
+        return success_count + hs.send_music_data(
+            ser, byte_list, remaining, on_result=remember
+        )
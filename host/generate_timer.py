@@ -9,10 +9,9 @@ TIMER_CYCLE = 12  # Ticks per timer count, 12 for 8051 timer
 REST_TH = 0xFF  # If frequency is unavailable, use rest value
 REST_TL = 0xFF
 
-th0_list = []
-tl0_list = []
 
-for midi in range(128):
+def timer_values(midi: int) -> tuple[int, int]:
+    """TH0 and TL0 reload values producing the pitch of a MIDI note."""
     # Calculate frequency from MIDI note number
     freq = 440.0 * (2 ** ((midi - 69) / 12))
 
@@ -21,23 +20,35 @@ for midi in range(128):
 
     # Handle out of range values
     if y <= 0 or y >= 65536:
-        th0 = REST_TH
-        tl0 = REST_TL
-    else:
-        val = 65536 - y
-        th0 = val // 256
-        tl0 = val % 256
-
-    th0_list.append(th0)
-    tl0_list.append(tl0)
-
-# Print the results in C array format
-print("unsigned char code th0_table[128] = {")
-for i, val in enumerate(th0_list):
-    print(f"  {val},", end="\n" if (i + 1) % 12 == 0 else " ")
-print("};\n")
-
-print("unsigned char code tl0_table[128] = {")
-for i, val in enumerate(tl0_list):
-    print(f"  {val},", end="\n" if (i + 1) % 12 == 0 else " ")
-print("};")
+        return REST_TH, REST_TL
+    val = 65536 - y
+    return val // 256, val % 256
+
+
+def square_wave_frequency(th0: int, tl0: int) -> float:
+    """Frequency of the buzzer square wave for the given reload values.
+
+    Timer 0 overflows every (65536 - reload) * TIMER_CYCLE clocks and every
+    overflow toggles the buzzer, so a period takes two overflows.
+    """
+    return F_TIMER / (2 * TIMER_CYCLE * (65536 - (th0 * 256 + tl0)))
+
+
+if __name__ == "__main__":
+    th0_list = []
+    tl0_list = []
+    for midi in range(128):
+        th0, tl0 = timer_values(midi)
+        th0_list.append(th0)
+        tl0_list.append(tl0)
+
+    # Print the results in C array format
+    print("unsigned char code th0_table[128] = {")
+    for i, val in enumerate(th0_list):
+        print(f"  {val},", end="\n" if (i + 1) % 12 == 0 else " ")
+    print("};\n")
+
+    print("unsigned char code tl0_table[128] = {")
+    for i, val in enumerate(tl0_list):
+        print(f"  {val},", end="\n" if (i + 1) % 12 == 0 else " ")
+    print("};")
@@ -1,14 +1,29 @@
+import functools
 import logging
+import os
+import sys
 import threading
 import time
 import tkinter as tk
-import webbrowser
 from tkinter import filedialog, messagebox, ttk
+from typing import TYPE_CHECKING
 
-import serial
-
+import bundle
+import capture
 import host_serial as hs
+import metrics
 import parse_midi as pm
+import preflight
+import profiling
+import sync_tuner
+import watch
+from delta_upload import DeltaUploader
+from node_state import NodeStateModel
+from port_monitor import PortInfo, PortMonitor
+
+# Heavy modules are imported on first use, see startup_report.py
+if TYPE_CHECKING:
+    import serial
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s"
@@ -33,20 +48,54 @@ class MidiFilePlayer:
         self.selected_port: str = ""  # Current selected serial port
         self.opened_ser: serial.Serial | None = None  # Opened serial port object
         self.playback_thread: threading.Thread | None = None  # Playback thread
+        # Held by the workers that talk to the nodes, their bytes and the
+        # answers they wait for must not interleave on the bus
+        self.bus_lock = threading.Lock()
         self.enable_sync = True  # Sync flag
         self.baudrate = 115200  # Default baudrate
         self.sync_waiting_time: float = 0.1  # Default sync waiting time
+        self.profile_loading = False  # Profile the conversion of loaded files
+        self.profile_allocations = False  # Trace allocations while profiling
+        self.load_cancel: threading.Event | None = None  # Set to cancel loading
+        self.load_generation = 0  # Incremented by every load, stale results are dropped
+        self.loaded_rows = 0  # Track rows shown while a file is loading
+        self.delta_upload = True  # Re-upload only the notes that changed
+        self.delta_uploader = DeltaUploader()  # What every node acknowledged
+        # Solo and mute without re-uploading, see show_mixer
+        self.node_states = NodeStateModel(self.delta_uploader)
+        self.present_nodes: set[int] | None = None  # Nodes found by the last scan
+        self.capture_bus = False  # Record the bus traffic, see capture.py
+        self.bridge_address = ""  # tcp:// address of a network bridge, see bridge.py
+        self.bundle: bundle.Bundle | None = None  # Holds the packets of a bundle song
+        self.song_path = ""  # MIDI file or bundle of the loaded song
+        self.adaptive_sync = True  # Learn the sync wait of every marker
+        self.beacon_sync = False  # Release markers by timing beacons, see beacon.py
+        self.watch_file = False  # Reload and re-upload the MIDI file when it changes
+        self.midi_parser = watch.IncrementalParser()  # Parses in watch mode
+        self.file_watcher: watch.FileWatcher | None = None
+        self.tempo = 1.0  # Playback speed relative to the song
+        self.transpose = 0  # Semitones, tempo and key are sent as a modifier (0xD4)
+        self.beacons_running = False  # The tempo is fixed while beacons are sent
+        self.tuner_running = False  # And while the sync waits are learned
+        self.library_root = ""  # Directory of the MIDI library, see library.py
 
         # Display filename
         tk.Label(root, text="文件:").grid(row=0, column=0, sticky="w", padx=10, pady=5)
         self.file_label = tk.Label(root, text=self.file_name, width=30, anchor="w")
-        self.file_label.grid(row=0, column=1, columnspan=3, padx=10, pady=5, sticky="w")
+        self.file_label.grid(row=0, column=1, columnspan=2, padx=10, pady=5, sticky="w")
+        tk.Button(root, text="曲库", command=self.show_library).grid(
+            row=0, column=3, padx=10, pady=5
+        )
 
         # Playback status
         tk.Label(root, text="状态:").grid(row=1, column=0, sticky="w", padx=10, pady=5)
         self.status_label = tk.Label(root, text="停止", width=10, anchor="w")
         self.status_label.grid(row=1, column=1, padx=10, pady=5, sticky="w")
 
+        # Upload estimate
+        self.eta_label = tk.Label(root, text="", anchor="w")
+        self.eta_label.grid(row=1, column=2, columnspan=2, padx=10, pady=5, sticky="w")
+
         # Serial port selection
         self.create_serial_port_selection()
 
@@ -79,6 +128,128 @@ class MidiFilePlayer:
             row=6, column=3, padx=10, pady=10, sticky="ew"
         )
 
+        # Start and loop markers
+        self.create_marker_selection()
+
+        # Tempo and key
+        self.create_modifier_selection()
+
+    def create_marker_selection(self):
+        """Create interface for the sync markers to start from and loop at"""
+        frame = tk.Frame(self.root)
+        frame.grid(row=7, column=0, columnspan=3, padx=10, pady=(0, 10), sticky="w")
+        tk.Label(frame, text="从同步点:").pack(side=tk.LEFT)
+        self.start_marker_combo = ttk.Combobox(frame, state="readonly", width=12)
+        self.start_marker_combo.pack(side=tk.LEFT, padx=(5, 15))
+        tk.Label(frame, text="循环至:").pack(side=tk.LEFT)
+        self.loop_end_combo = ttk.Combobox(frame, state="readonly", width=12)
+        self.loop_end_combo.pack(side=tk.LEFT, padx=5)
+        self._update_markers()
+
+        tk.Button(self.root, text="调音台", command=self.show_mixer).grid(
+            row=7, column=3, padx=10, pady=(0, 10), sticky="ew"
+        )
+
+    def _update_markers(self):
+        """List the sync markers of the loaded song, keeping valid selections"""
+        times = []
+        if self.byte_list:
+            import beacon
+
+            times = beacon.beacon_times(self.byte_list)
+        labels = []
+        for index, seconds in enumerate(times, 1):
+            minutes, seconds = divmod(round(seconds), 60)
+            labels.append(f"{index}（{minutes}:{seconds:02d}）")
+        for combo, first in (
+            (self.start_marker_combo, "开头"),
+            (self.loop_end_combo, "不循环"),
+        ):
+            selected = combo.current()
+            combo["values"] = [first] + labels
+            combo.current(selected if 0 < selected <= len(labels) else 0)
+
+    def create_modifier_selection(self):
+        """Create interface for the playback tempo and transposition"""
+        frame = tk.Frame(self.root)
+        frame.grid(row=8, column=0, columnspan=4, padx=10, pady=(0, 10), sticky="w")
+        tk.Label(frame, text="速度（%）:").pack(side=tk.LEFT)
+        self.tempo_var = tk.StringVar(value="100")
+        tempo_spin = tk.Spinbox(
+            frame,
+            from_=30,
+            to=400,
+            increment=5,
+            width=5,
+            textvariable=self.tempo_var,
+            command=self.on_modifier_change,
+        )
+        tempo_spin.pack(side=tk.LEFT, padx=(5, 15))
+        tk.Label(frame, text="移调（半音）:").pack(side=tk.LEFT)
+        self.transpose_var = tk.StringVar(value="0")
+        transpose_spin = tk.Spinbox(
+            frame,
+            from_=-24,
+            to=24,
+            increment=1,
+            width=5,
+            textvariable=self.transpose_var,
+            command=self.on_modifier_change,
+        )
+        transpose_spin.pack(side=tk.LEFT, padx=(5, 15))
+        for spin in (tempo_spin, transpose_spin):
+            spin.bind("<Return>", self.on_modifier_change)
+            spin.bind("<FocusOut>", self.on_modifier_change)
+        tk.Button(frame, text="还原", command=self.reset_modifier).pack(side=tk.LEFT)
+
+    def _show_modifier(self):
+        """Show the tempo and transposition in effect"""
+        self.tempo_var.set(str(round(self.tempo * 100)))
+        self.transpose_var.set(str(self.transpose))
+
+    def on_modifier_change(self, event=None):
+        """Send a changed tempo or transposition to the nodes at once"""
+        try:
+            tempo = int(self.tempo_var.get()) / 100
+            transpose = int(self.transpose_var.get())
+            command = hs.modifier_command(tempo, transpose)
+        except ValueError:
+            messagebox.showwarning("提示", "速度或移调超出范围！")
+            self._show_modifier()
+            return
+        if (tempo, transpose) == (self.tempo, self.transpose):
+            return
+        if tempo != self.tempo and self.beacons_running:
+            # The beacons have been planned for the tempo at the start
+            messagebox.showwarning("提示", "信标同步播放时无法修改速度！")
+            self._show_modifier()
+            return
+        if tempo != self.tempo and self.tuner_running:
+            # The learned waits hold for the original tempo only
+            messagebox.showwarning("提示", "自适应同步播放时无法修改速度！")
+            self._show_modifier()
+            return
+        self.tempo = tempo
+        self.transpose = transpose
+        # Playing nodes apply it from their next note, without an upload. The
+        # playback holds the bus lock, a single write does not disturb it. Other
+        # workers wait for answers, the next start command sets it instead.
+        if not (self.opened_ser and self.opened_ser.is_open):
+            return
+        if self.is_playing:
+            hs.send_command(self.opened_ser, command)
+        elif self.bus_lock.acquire(blocking=False):
+            try:
+                hs.send_command(self.opened_ser, command)
+            finally:
+                self.bus_lock.release()
+
+    def reset_modifier(self):
+        """Play at the original tempo and key again"""
+        self.tempo_var.set("100")
+        self.transpose_var.set("0")
+        self.on_modifier_change()
+
     def create_serial_port_selection(self):
         """Create interface for serial port selection"""
         # Serial port label
@@ -101,58 +272,157 @@ class MidiFilePlayer:
             row=2, column=3, padx=10, pady=5
         )
 
-        # Initial port refresh
-        self.refresh_ports()
+        # Ports are enumerated and opened in the background once the window
+        # has been drawn, see start_background_tasks
+        self.port_combo.set("正在扫描串口…")
+        self.port_monitor = PortMonitor(
+            lambda ports: self.root.after(0, self.on_ports_changed, ports)
+        )
 
-    def refresh_ports(self):
-        """Refresh the list of available serial ports"""
-        if self.opened_ser:
-            self.opened_ser.close()
-        try:
-            self.available_ports, port_descriptions = hs.get_serial_ports()
-            self.port_combo["values"] = port_descriptions
-
-            # Try keeping previous selection if possible
-            if self.selected_port and self.selected_port in self.available_ports:
-                for i, desc in enumerate(port_descriptions):
-                    if desc.startswith(self.selected_port):
-                        self.port_combo.current(i)
-                        self.opened_ser = hs.open_serial_port(
-                            self.selected_port, self.baudrate
-                        )
-                        break
-            elif port_descriptions and self.available_ports:
-                # If no previous selection, select the first available port
-                self.port_combo.current(0)
-                self.selected_port = self.available_ports[0]
-                self.opened_ser = hs.open_serial_port(self.selected_port, self.baudrate)
-            else:
-                # No available ports
-                self.port_combo.set("无可用串口")
-                self.selected_port = ""
+    def start_background_tasks(self):
+        """Start work deferred until after the first frame"""
+        self.port_monitor.start()
 
-        except Exception as e:
-            messagebox.showerror("错误", f"刷新串口失败: {e}")
-            self.port_combo.set("刷新失败")
-            logging.error(f"Error refreshing ports: {e}")
-            self.selected_port = ""
+    def refresh_ports(self):
+        """Rescan serial ports, reopening the selected one if it is closed"""
+        if self.selected_port and not (self.opened_ser and self.opened_ser.is_open):
+            self._open_port(self.selected_port)
+        self.port_monitor.refresh()
+
+    def on_ports_changed(self, ports):
+        """Update the port list after the monitor found a change"""
+        if self.bridge_address:
+            ports = [*ports, PortInfo(self.bridge_address, "网络桥接")]
+        self.available_ports = [port.device for port in ports]
+        port_descriptions = [port.label for port in ports]
+        self.port_combo["values"] = port_descriptions
+
+        # Try keeping previous selection if possible
+        if self.selected_port and self.selected_port in self.available_ports:
+            self.port_combo.current(self.available_ports.index(self.selected_port))
+        elif self.selected_port and self.opened_ser is None:
+            # Keep the selection, the adapter is reopened when it comes back
+            self.port_combo.set("串口已断开，等待重新连接")
+        elif self.available_ports and not self.selected_port:
+            # If no previous selection, select the first available port
+            self.port_combo.current(0)
+            self.selected_port = self.available_ports[0]
+            self._open_port(self.selected_port)
+        elif not self.available_ports:
+            # No available ports
+            self.port_combo.set("无可用串口")
 
     def on_port_selected(self, event):
         """Handle serial port selection event"""
         selection = self.port_combo.current()
+        if selection >= 0 and selection < len(self.available_ports):
+            self.selected_port = self.available_ports[selection]
+            logging.debug(f"Serial port selected: {self.selected_port}")
+            self._open_port(self.selected_port)
+
+    def _open_port(self, port, success_message=None):
+        """Open `port` off the UI thread, closing the current port first"""
+        old_ser = self.opened_ser
+        self.opened_ser = None
+        self.port_monitor.open_async(
+            port,
+            self.baudrate,
+            lambda ser, error: self.root.after(
+                0, self._on_port_opened, port, ser, error, success_message
+            ),
+            close=old_ser,
+            settle=0.1 if old_ser else 0.0,  # Brief delay for port to close
+        )
+
+    def _on_port_opened(self, port, ser, error, success_message):
+        """Make a freshly opened port current"""
+        if error is not None:
+            messagebox.showerror("错误", f"打开串口失败: {error}")
+            if port == self.selected_port:
+                self.selected_port = ""
+                self.port_combo.set("打开失败")
+            return
+        if port != self.selected_port or self.opened_ser is not None:
+            # Another port has been selected in the meantime
+            ser.close()
+            return
+        if self.capture_bus:
+            path = capture.default_capture_path(port)
+            try:
+                ser = capture.CapturingSerial(ser, path)
+                logging.info(f"Recording bus traffic to {path}")
+            except OSError as e:
+                logging.error(f"Cannot record bus traffic: {e}")
+        self.opened_ser = ser
+        # Nodes may have been powered off while the port was closed
+        self.delta_uploader.forget()
+        self.port_monitor.track(
+            port,
+            on_lost=lambda info: self.root.after(0, self._on_port_lost, info),
+            on_reconnect=lambda info: self.root.after(0, self._on_port_back, info),
+        )
+        if success_message:
+            messagebox.showinfo("提示", success_message)
+        if not self.is_playing:
+            self.scan_nodes(quiet=True)
+
+    def scan_nodes(self, quiet=False):
+        """Probe all node addresses in the background"""
+        if not (self.opened_ser and self.opened_ser.is_open):
+            if not quiet:
+                messagebox.showwarning("提示", "请先选择串口！")
+            return
+        if self.is_playing:
+            if not quiet:
+                messagebox.showwarning("提示", "播放时节点不会响应探测，请先停止播放！")
+            return
+        self.nodes_label.config(text="在线节点: 正在扫描…")
+        ser = self.opened_ser
+
+        def worker():
+            try:
+                with self.bus_lock:
+                    present = hs.scan_nodes(ser)
+            except Exception as e:
+                logging.error(f"Error scanning nodes: {e}")
+                present = None
+            self.root.after(0, self._on_nodes_scanned, present)
+
+        threading.Thread(target=worker, name="node-scan", daemon=True).start()
+
+    def _on_nodes_scanned(self, present):
+        """Show the result of a node scan"""
+        self.present_nodes = present
+        if present is None:
+            self.nodes_label.config(text="在线节点: 扫描失败")
+        elif present:
+            nodes = " ".join(hex(i).upper()[2:] for i in sorted(present))
+            self.nodes_label.config(text=f"在线节点: {nodes}")
+        else:
+            self.nodes_label.config(text="在线节点: 无")
+        self._refresh_node_column()
+
+    def _on_port_lost(self, info):
+        """Drop the port object of an unplugged adapter"""
+        if info.device != self.selected_port or self.opened_ser is None:
+            return
         try:
-            if self.opened_ser:
-                self.opened_ser.close()
-            if selection >= 0 and selection < len(self.available_ports):
-                self.selected_port = self.available_ports[selection]
-                logging.debug(f"Serial port selected: {self.selected_port}")
-                self.opened_ser = hs.open_serial_port(self.selected_port, self.baudrate)
+            self.opened_ser.close()
         except Exception as e:
-            messagebox.showerror("错误", f"打开串口失败: {e}")
-            logging.error(f"Error opening selected port: {e}")
-            self.selected_port = ""
-            self.opened_ser = None
-            self.port_combo.set("打开失败")
+            logging.debug(f"Error closing unplugged port: {e}")
+        self.opened_ser = None
+        self.is_playing = False
+        self.status_label.config(text="停止")
+        self.port_combo.set("串口已断开，等待重新连接")
+
+    def _on_port_back(self, info):
+        """Reopen the adapter after it has been plugged in again"""
+        if self.opened_ser is not None:
+            return
+        self.selected_port = info.device
+        if info.device in self.available_ports:
+            self.port_combo.current(self.available_ports.index(info.device))
+        self._open_port(info.device)
 
     def create_track_table(self):
         # Track table label
@@ -160,24 +430,43 @@ class MidiFilePlayer:
             row=3, column=0, sticky="w", padx=10, pady=5
         )
 
+        # Node presence
+        self.nodes_label = tk.Label(self.root, text="在线节点: 未扫描", anchor="w")
+        self.nodes_label.grid(row=3, column=1, columnspan=2, padx=10, sticky="w")
+        tk.Button(self.root, text="扫描节点", command=self.scan_nodes).grid(
+            row=3, column=3, padx=10, pady=5
+        )
+
         # Track table frame
         table_frame = tk.Frame(self.root)
         table_frame.grid(row=4, column=0, columnspan=4, padx=10, pady=5, sticky="ew")
 
         # Create Treeview for track table
+        columns = ("编号", "大小", "音符", "传输", "时长", "同步", "分配节点")
         self.track_tree = ttk.Treeview(
-            table_frame, columns=("编号", "大小", "分配节点"), show="headings", height=6
+            table_frame, columns=columns, show="headings", height=6
         )
 
         # Define column headings
         self.track_tree.heading("编号", text="编号")
         self.track_tree.heading("大小", text="大小")
+        self.track_tree.heading("音符", text=f"音符/{preflight.MAX_NOTES}")
+        self.track_tree.heading("传输", text="传输时间")
+        self.track_tree.heading("时长", text="演奏时长")
+        self.track_tree.heading("同步", text="同步点")
         self.track_tree.heading("分配节点", text="分配至节点")
 
         # Configure column widths
-        self.track_tree.column("编号", width=80, anchor="center")
-        self.track_tree.column("大小", width=120, anchor="center")
-        self.track_tree.column("分配节点", width=200, anchor="center")
+        self.track_tree.column("编号", width=50, anchor="center")
+        self.track_tree.column("大小", width=70, anchor="center")
+        self.track_tree.column("音符", width=80, anchor="center")
+        self.track_tree.column("传输", width=70, anchor="center")
+        self.track_tree.column("时长", width=70, anchor="center")
+        self.track_tree.column("同步", width=60, anchor="center")
+        self.track_tree.column("分配节点", width=120, anchor="center")
+
+        # Tracks that do not fit into a node
+        self.track_tree.tag_configure("oversized", foreground="red")
 
         # Add scrollbar
         scrollbar = ttk.Scrollbar(
@@ -195,39 +484,88 @@ class MidiFilePlayer:
         # Store comboboxes for each track
         self.track_comboboxes = {}
 
-    def update_track_table(self):
-        """Update the track table with current byte_list data"""
-        # Clear existing items
+    def _clear_track_table(self):
+        """Remove all rows from the track table"""
         for item in self.track_tree.get_children():
             self.track_tree.delete(item)
 
         # Clear comboboxes
         self.track_comboboxes.clear()
 
-        if not self.byte_list:
-            return
+    def _insert_track_row(self, i, track_size):
+        """Append the row of track `i` with its default node assignment"""
+        track_num = hex(i).upper()[2:]  # Convert to hex (0-F)
 
-        # Add tracks to table
-        for i, track_bytes in enumerate(self.byte_list):
-            track_num = hex(i).upper()[2:]  # Convert to hex (0-F)
-            track_size = len(track_bytes)
+        # Check if track index exceeds available nodes (0-F, i.e., 0-15)
+        if i > 15:
+            default_node = "不分配"  # Assign to "unassigned" if track index > 15
+        else:
+            default_node = track_num  # Default assignment is track number
 
-            # Check if track index exceeds available nodes (0-F, i.e., 0-15)
-            if i > 15:
-                default_node = "不分配"  # Assign to "unassigned" if track index > 15
-            else:
-                default_node = track_num  # Default assignment is track number
+        # Store default assignment
+        self.track_assignments[i] = default_node
 
-            # Store default assignment
-            self.track_assignments[i] = default_node
+        # Insert row into treeview
+        display_assignment = self._node_display(default_node)
+        self.track_tree.insert(
+            "",
+            "end",
+            values=(track_num, track_size, "", "", "", "", display_assignment),
+        )
 
-            # Insert row into treeview
-            display_assignment = (
-                default_node if default_node == "不分配" else f"节点 {default_node}"
-            )
-            item_id = self.track_tree.insert(
-                "", "end", values=(track_num, track_size, display_assignment)
+    def _node_display(self, node_id):
+        """Text of the node column, flagging nodes missing in the last scan"""
+        if node_id == "不分配":
+            return node_id
+        if (
+            self.present_nodes is not None
+            and int(node_id, 16) not in self.present_nodes
+        ):
+            return f"节点 {node_id}（离线）"
+        return f"节点 {node_id}"
+
+    def _refresh_node_column(self):
+        """Redraw the node column, e.g. after a scan"""
+        for track_index, item in enumerate(self.track_tree.get_children()):
+            node_id = self.track_assignments.get(
+                track_index, hex(track_index).upper()[2:]
             )
+            self.track_tree.set(item, "分配节点", self._node_display(node_id))
+
+    def update_track_table(self):
+        """Update the track table with current byte_list data"""
+        # Clear existing items
+        self._clear_track_table()
+        self._update_markers()
+
+        if not self.byte_list:
+            return
+
+        # Add tracks to table
+        for i, track_bytes in enumerate(self.byte_list):
+            self._insert_track_row(i, len(track_bytes))
+        self._update_preflight()
+
+    def _preflight(self):
+        """Preflight results of the tracks the next upload would send"""
+        byte_list = self.byte_list if self.enable_sync else self.unsynced_list
+        return preflight.analyze(byte_list, self.track_assignments, self.baudrate)
+
+    def _update_preflight(self):
+        """Fill the estimate columns of the track table and the upload ETA"""
+        if not self.byte_list or self.load_cancel is not None:
+            self.eta_label.config(text="")
+            return
+        reports = self._preflight()
+        for report, item in zip(reports, self.track_tree.get_children()):
+            minutes, seconds = divmod(round(report.play_seconds), 60)
+            self.track_tree.set(item, "大小", report.wire_bytes)
+            self.track_tree.set(item, "音符", report.entries)
+            self.track_tree.set(item, "传输", f"{report.upload_seconds:.2f} 秒")
+            self.track_tree.set(item, "时长", f"{minutes}:{seconds:02d}")
+            self.track_tree.set(item, "同步", report.sync_points)
+            self.track_tree.item(item, tags=() if report.fits else ("oversized",))
+        self.eta_label.config(text=f"预计传输: {preflight.upload_eta(reports):.1f} 秒")
 
     def on_node_assignment_change(self, track_index, selected_value):
         """Process node assignment change"""
@@ -236,9 +574,8 @@ class MidiFilePlayer:
         items = self.track_tree.get_children()
         if track_index < len(items):
             item = items[track_index]
-            values = list(self.track_tree.item(item, "values"))
-            values[2] = f"节点 {selected_value}"
-            self.track_tree.item(item, values=values)
+            self.track_tree.set(item, "分配节点", self._node_display(selected_value))
+        self._update_preflight()
 
     def on_track_double_click(self, event):
         """Process track double-click event to show node selection dialog"""
@@ -296,12 +633,10 @@ class MidiFilePlayer:
             items = self.track_tree.get_children()
             if track_index < len(items):
                 item = items[track_index]
-                values = list(self.track_tree.item(item, "values"))
-                if new_assignment == "不分配":
-                    values[2] = "不分配"
-                else:
-                    values[2] = f"节点 {new_assignment}"
-                self.track_tree.item(item, values=values)
+                self.track_tree.set(
+                    item, "分配节点", self._node_display(new_assignment)
+                )
+            self._update_preflight()
             dialog.destroy()
 
         def on_preview():
@@ -311,15 +646,22 @@ class MidiFilePlayer:
                 and self.opened_ser.is_open
                 and selected_node != "不分配"
             ):
+                if not self.bus_lock.acquire(blocking=False):
+                    messagebox.showwarning(
+                        "提示", "正在播放、传输或扫描节点，请稍后再试！"
+                    )
+                    return
                 try:
-                    hs.preview_track(
+                    # Uploads only if the node holds something else
+                    self.node_states.preview(
                         self.opened_ser,
-                        int(selected_node, 16),
-                        self.unsynced_list[track_index],
+                        {int(selected_node, 16): self.unsynced_list[track_index]},
                     )
                 except Exception as e:
                     messagebox.showerror("错误", f"预览失败: {e}")
                     logging.error(f"Error during preview: {e}")
+                finally:
+                    self.bus_lock.release()
             else:
                 messagebox.showwarning("提示", "请先选择有效的串口和节点！")
             logging.info(
@@ -339,8 +681,15 @@ class MidiFilePlayer:
                 and self.opened_ser.is_open
                 and selected_node != "不分配"
             ):
-                cmd = 0x60 | (int(selected_node, 16) & 0x0F)
-                hs.send_command(self.opened_ser, bytes([cmd]))
+                if not self.bus_lock.acquire(blocking=False):
+                    messagebox.showwarning(
+                        "提示", "正在播放、传输或扫描节点，请稍后再试！"
+                    )
+                    return
+                try:
+                    self.node_states.mute(self.opened_ser, [int(selected_node, 16)])
+                finally:
+                    self.bus_lock.release()
 
         tk.Button(button_frame, text="确定", command=on_ok).pack(side=tk.LEFT, padx=5)
         tk.Button(button_frame, text="预览", command=on_preview).pack(
@@ -351,29 +700,634 @@ class MidiFilePlayer:
             side=tk.LEFT, padx=5
         )
 
+    def show_mixer(self):
+        """Open the mixer to solo and mute the tracks on their nodes"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("调音台")
+        dialog.geometry("460x380")
+        dialog.transient(self.root)
+
+        tk.Label(
+            dialog, text="选择音轨后独奏、试听或静音，节点已有该音轨时无需重新传输。"
+        ).pack(padx=10, pady=(10, 5), anchor="w")
+
+        columns = ("音轨", "节点", "内容", "状态")
+        tree = ttk.Treeview(dialog, columns=columns, show="headings", height=10)
+        for column, width in zip(columns, (60, 80, 200, 80)):
+            tree.heading(column, text=column)
+            tree.column(column, width=width, anchor="center")
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+        latency_label = tk.Label(dialog, text="延迟: -", anchor="w")
+        latency_label.pack(fill=tk.X, padx=10)
+
+        def node_of(track_index):
+            node_id = self.track_assignments.get(
+                track_index, hex(track_index).upper()[2:]
+            )
+            return None if node_id == "不分配" else int(node_id, 16)
+
+        def refresh():
+            if not dialog.winfo_exists():
+                return
+            self.node_states.set_song(self.byte_list, self.unsynced_list)
+            selection = tree.selection()
+            tree.delete(*tree.get_children())
+            for track_index in range(len(self.unsynced_list)):
+                node_id = node_of(track_index)
+                state = None if node_id is None else self.node_states.state(node_id)
+                if node_id is None:
+                    content = ""
+                elif state is None:
+                    content = "未知"
+                elif state.track is None:
+                    content = f"其他数据 {state.digest.hex()[:8]}"
+                else:
+                    variant = "含同步点" if state.synced else "无同步点"
+                    content = f"音轨 {state.track:X}（{variant}）"
+                tree.insert(
+                    "",
+                    "end",
+                    iid=str(track_index),
+                    values=(
+                        f"{track_index:X}",
+                        "不分配" if node_id is None else f"节点 {node_id:X}",
+                        content,
+                        "播放中" if state and state.playing else "",
+                    ),
+                )
+            tree.selection_set([i for i in selection if tree.exists(i)])
+
+        def selected_parts():
+            """Node ID -> unsynced packet of the selected tracks, None if invalid"""
+            parts = {}
+            for item in tree.selection():
+                track_index = int(item)
+                node_id = node_of(track_index)
+                if node_id is None:
+                    messagebox.showwarning(
+                        "提示", "所选音轨未分配节点！", parent=dialog
+                    )
+                    return None
+                if node_id in parts:
+                    messagebox.showwarning(
+                        "提示", "所选音轨分配到了同一节点！", parent=dialog
+                    )
+                    return None
+                parts[node_id] = self.unsynced_list[track_index]
+            if not parts:
+                messagebox.showwarning("提示", "请先选择音轨！", parent=dialog)
+                return None
+            return parts
+
+        def run(name, action):
+            if not self.opened_ser or not self.opened_ser.is_open:
+                messagebox.showwarning("提示", "请先选择串口！", parent=dialog)
+                return
+            if self.is_playing:
+                messagebox.showwarning("提示", "请先停止播放！", parent=dialog)
+                return
+
+            def worker():
+                try:
+                    with self.bus_lock:
+                        result = action(self.opened_ser)
+                except Exception as e:
+                    logging.error(f"Mixer {name} failed: {e}")
+                    self.root.after(0, on_failed, e)
+                    return
+                self.root.after(0, on_done, result)
+
+            def on_failed(error):
+                if dialog.winfo_exists():
+                    messagebox.showerror("错误", f"{name}失败: {error}", parent=dialog)
+                    refresh()
+
+            def on_done(result):
+                if not dialog.winfo_exists():
+                    return
+                text = f"{name}延迟: {result.latency * 1000:.2f} ms"
+                if result.uploaded:
+                    text += (
+                        f"（含传输 {len(result.uploaded)} 个节点 "
+                        f"{result.upload_seconds:.2f} 秒）"
+                    )
+                latency_label.config(text=text)
+                refresh()
+
+            threading.Thread(target=worker, daemon=True).start()
+
+        def on_solo():
+            parts = selected_parts()
+            if parts:
+                run("独奏", lambda ser: self.node_states.preview(ser, parts, solo=True))
+
+        def on_preview():
+            parts = selected_parts()
+            if parts:
+                run("试听", lambda ser: self.node_states.preview(ser, parts))
+
+        def on_mute():
+            parts = selected_parts()
+            if parts:
+                run("静音", lambda ser: self.node_states.mute(ser, parts))
+
+        button_frame = tk.Frame(dialog)
+        button_frame.pack(fill=tk.X, padx=10, pady=10)
+        tk.Button(button_frame, text="独奏", command=on_solo, width=8).pack(
+            side=tk.LEFT, padx=(0, 5)
+        )
+        tk.Button(button_frame, text="试听", command=on_preview, width=8).pack(
+            side=tk.LEFT, padx=(0, 5)
+        )
+        tk.Button(button_frame, text="静音", command=on_mute, width=8).pack(
+            side=tk.LEFT, padx=(0, 5)
+        )
+        tk.Button(
+            button_frame,
+            text="全部停止",
+            command=lambda: run("停止", self.node_states.stop_all),
+            width=8,
+        ).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="关闭", command=dialog.destroy, width=8).pack(
+            side=tk.RIGHT
+        )
+
+        refresh()
+
+    def show_library(self):
+        """Pick a song from the indexed MIDI library, see library.py"""
+        # The index and the process pool are only loaded when asked for
+        import sqlite3
+
+        import library
+
+        if not self.library_root:
+            self.library_root = filedialog.askdirectory(title="选择 MIDI 曲库目录")
+            if not self.library_root:
+                return
+        try:
+            catalog = library.Library(self.library_root)
+        except (OSError, sqlite3.Error) as e:
+            messagebox.showerror("错误", f"无法打开曲库索引: {e}")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("曲库")
+        dialog.geometry("640x460")
+        dialog.transient(self.root)
+
+        dir_frame = tk.Frame(dialog)
+        dir_frame.pack(fill=tk.X, padx=10, pady=(10, 5))
+
+        filter_frame = tk.Frame(dialog)
+        filter_frame.pack(fill=tk.X, padx=10, pady=5)
+        tk.Label(filter_frame, text="名称:").pack(side=tk.LEFT)
+        name_var = tk.StringVar()
+        tk.Entry(filter_frame, textvariable=name_var, width=20).pack(
+            side=tk.LEFT, padx=(5, 15)
+        )
+        fits_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            filter_frame,
+            text=f"只显示适合 {library.NODE_COUNT} 个节点的乐曲",
+            variable=fits_var,
+        ).pack(side=tk.LEFT)
+        online_var = tk.BooleanVar(value=False)
+        online_check = tk.Checkbutton(
+            filter_frame, text="音轨数不超过在线节点数", variable=online_var
+        )
+        online_check.pack(side=tk.LEFT, padx=(10, 0))
+        if self.present_nodes is None:
+            online_check.config(state=tk.DISABLED)
+
+        columns = ("文件", "音轨", "音符", "复音", "时长", "变速", "同步点")
+        table_frame = tk.Frame(dialog)
+        table_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        tree = ttk.Treeview(table_frame, columns=columns, show="headings", height=12)
+        for column, width in zip(columns, (240, 50, 80, 50, 60, 50, 60)):
+            tree.heading(column, text=column)
+            tree.column(
+                column, width=width, anchor="w" if column == "文件" else "center"
+            )
+        tree.heading("音符", text=f"音符/{library.MAX_NOTES}")
+        scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        status_label = tk.Label(dialog, text="", anchor="w")
+        status_label.pack(fill=tk.X, padx=10)
+        refreshing = False
+
+        def show_songs(*args):
+            if refreshing or not dialog.winfo_exists():
+                return
+            max_tracks = None
+            if online_var.get() and self.present_nodes is not None:
+                max_tracks = len(self.present_nodes)
+            songs = catalog.find(
+                name=name_var.get().strip(), fits=fits_var.get(), max_tracks=max_tracks
+            )
+            tree.delete(*tree.get_children())
+            for song in songs:
+                minutes, seconds = divmod(round(song.duration), 60)
+                tree.insert(
+                    "",
+                    "end",
+                    iid=song.path,
+                    values=(
+                        song.path,
+                        song.tracks,
+                        song.max_entries,
+                        song.polyphony,
+                        f"{minutes}:{seconds:02d}",
+                        song.tempo_changes,
+                        song.markers,
+                    ),
+                )
+            status_label.config(text=f"共 {len(songs)} 首")
+
+        def refresh_index():
+            nonlocal refreshing
+            if refreshing:
+                return
+            refreshing = True
+            status_label.config(text="正在更新索引…")
+
+            def show_progress(done, count):
+                if dialog.winfo_exists():
+                    status_label.config(text=f"正在更新索引… {done}/{count}")
+
+            def on_file(done, count):
+                self.root.after(0, show_progress, done, count)
+
+            def worker():
+                try:
+                    result = catalog.refresh(on_file=on_file)
+                except (OSError, sqlite3.Error) as e:
+                    logging.error(f"Library refresh failed: {e}")
+                    result = None
+                self.root.after(0, on_refreshed, result)
+
+            threading.Thread(target=worker, daemon=True).start()
+
+        def on_refreshed(result):
+            nonlocal refreshing
+            refreshing = False
+            if not dialog.winfo_exists():
+                catalog.close()
+                return
+            show_songs()
+            if result is None:
+                status_label.config(text="更新索引失败")
+            elif result.failed:
+                status_label.config(
+                    text=f"{status_label.cget('text')}，{result.failed} 个文件无法解析"
+                )
+
+        def on_choose_dir():
+            path = filedialog.askdirectory(title="选择 MIDI 曲库目录", parent=dialog)
+            if path:
+                self.library_root = path
+                on_close()
+                self.show_library()
+
+        def on_load(event=None):
+            selection = tree.selection()
+            if not selection:
+                messagebox.showwarning("提示", "请先选择乐曲！", parent=dialog)
+                return
+            path = catalog.full_path(selection[0])
+            on_close()
+            self.load_midi(path)
+
+        def on_close():
+            dialog.destroy()
+            if not refreshing:
+                catalog.close()
+
+        tk.Button(dir_frame, text="更换目录", command=on_choose_dir).pack(side=tk.RIGHT)
+        tk.Button(dir_frame, text="更新索引", command=refresh_index).pack(
+            side=tk.RIGHT, padx=5
+        )
+        tk.Label(dir_frame, text=self.library_root, anchor="w").pack(
+            side=tk.LEFT, fill=tk.X, expand=True
+        )
+        name_var.trace_add("write", show_songs)
+        fits_var.trace_add("write", show_songs)
+        online_var.trace_add("write", show_songs)
+        tree.bind("<Double-1>", on_load)
+
+        button_frame = tk.Frame(dialog)
+        button_frame.pack(fill=tk.X, padx=10, pady=10)
+        tk.Button(button_frame, text="加载", command=on_load, width=8).pack(
+            side=tk.LEFT
+        )
+        tk.Button(button_frame, text="关闭", command=on_close, width=8).pack(
+            side=tk.RIGHT
+        )
+        dialog.protocol("WM_DELETE_WINDOW", on_close)
+
+        # Only new and changed files are converted
+        show_songs()
+        refresh_index()
+
     def load_file(self):
         path = filedialog.askopenfilename(
-            title="选择 MIDI 文件", filetypes=[("MIDI 文件", "*.mid")]
+            title="选择 MIDI 文件",
+            filetypes=[
+                ("MIDI 文件或曲目包", "*.mid *.stcb"),
+                ("MIDI 文件", "*.mid"),
+                ("曲目包", "*.stcb"),
+            ],
         )
-        if path:
-            self.file_name = path.split("/")[-1]
-            self.file_label.config(text=self.file_name)
-            self.is_playing = False
-            self.status_label.config(text="停止")
-            try:
-                self.byte_list = pm.midi_to_binary_list(path, pm.MidiConfig())
-                self.unsynced_list = pm.midi_to_binary_list(
-                    path, pm.MidiConfig(enable_sync=False)
+        if path and path.endswith(".stcb"):
+            self.load_bundle(path)
+        elif path:
+            self.load_midi(path)
+
+    def load_midi(self, path):
+        """Parse a MIDI file in the background and show its tracks"""
+        # Cancel the previous load, its results would be discarded anyway
+        if self.load_cancel is not None:
+            self.load_cancel.set()
+        self.load_cancel = threading.Event()
+        self.load_generation += 1
+
+        self.file_name = path.split("/")[-1]
+        self.song_path = path
+        self.file_label.config(text=f"{self.file_name}（解析中）")
+        self.is_playing = False
+        self.status_label.config(text="停止")
+        self._clear_track_table()
+        self.loaded_rows = 0
+
+        # Parse in a new thread to keep the UI responsive
+        load_thread = threading.Thread(
+            target=self._load_worker,
+            args=(path, self.load_generation, self.load_cancel),
+            daemon=True,
+        )
+        load_thread.start()
+
+    def load_bundle(self, path):
+        """Open a precompiled song bundle, see bundle.py"""
+        try:
+            song_bundle = bundle.Bundle(path)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("错误", f"无法打开曲目包: {e}")
+            return
+        if len(song_bundle.songs) == 1:
+            self._load_song(song_bundle, song_bundle.songs[0])
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("选择曲目")
+        dialog.geometry("300x320")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        dialog.geometry(
+            "+%d+%d" % (self.root.winfo_rootx() + 100, self.root.winfo_rooty() + 100)
+        )
+
+        listbox = tk.Listbox(dialog)
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        for i, song in enumerate(song_bundle.songs):
+            seconds = round(max((t.play_seconds for t in song.tracks), default=0))
+            listbox.insert(
+                tk.END, f"{i + 1}. {song.title} ({seconds // 60}:{seconds % 60:02d})"
+            )
+        listbox.selection_set(0)
+
+        def on_ok(event=None):
+            selection = listbox.curselection()
+            if selection:
+                dialog.destroy()
+                self._load_song(song_bundle, song_bundle.songs[selection[0]])
+
+        listbox.bind("<Double-1>", on_ok)
+        button_frame = tk.Frame(dialog)
+        button_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+        tk.Button(button_frame, text="确定", command=on_ok, width=8).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="取消", command=dialog.destroy, width=8).pack(
+            side=tk.RIGHT
+        )
+
+    def _load_song(self, song_bundle, song):
+        """Show a song of a bundle, its packets stay in the mapped file"""
+        # A MIDI file still loading would replace the song
+        if self.load_cancel is not None:
+            self.load_cancel.set()
+            self.load_cancel = None
+        self.load_generation += 1
+
+        self._watch(None)
+        self.bundle = song_bundle
+        self.song_path = song_bundle.path
+        self.file_name = f"{song.title}（{os.path.basename(song_bundle.path)}）"
+        self.is_playing = False
+        self.status_label.config(text="停止")
+        self.byte_list, self.unsynced_list = song.synced, song.unsynced
+        self.file_label.config(text=self.file_name)
+        self.update_track_table()
+        self.track_assignments.update(song.assignments)
+        self._refresh_node_column()
+        self._update_preflight()
+
+    def _load_worker(self, path, generation, cancel):
+        """Worker thread to convert a MIDI file into synced and unsynced packets"""
+
+        def on_track(index, count, events):
+            self.root.after(
+                0, self._on_track_parsed, generation, index, count, len(events)
+            )
+
+        if self.watch_file:
+            # Keeps the tracks for converting only what the next export changes
+            convert = self.midi_parser.parse
+        else:
+            convert = functools.partial(pm.midi_to_binary_lists, config=pm.MidiConfig())
+        profiler = None
+        try:
+            if self.profile_loading:
+                with profiling.profile(self.profile_allocations) as profiler:
+                    byte_list, unsynced_list = convert(
+                        path, on_track=on_track, cancel=cancel
+                    )
+            else:
+                byte_list, unsynced_list = convert(
+                    path, on_track=on_track, cancel=cancel
                 )
-                # Automatically update track table after file loaded
-                self.update_track_table()
-            except Exception as e:
-                messagebox.showerror("错误", f"无法解析文件: {e}")
-                self.file_name = "未加载"
-                self.file_label.config(text=self.file_name + "（解析失败）")
-                self.byte_list = []
-                self.update_track_table()  # Clear the table
-                return
+        except pm.ParseCancelled:
+            logging.debug(f"Loading {path} cancelled")
+            return
+        except Exception as e:
+            logging.error(f"Error parsing {path}: {e}")
+            self.root.after(0, self._on_load_failed, generation, e)
+            return
+        self.root.after(
+            0, self._on_load_finished, generation, byte_list, unsynced_list, profiler
+        )
+
+    def _on_track_parsed(self, generation, index, count, event_count):
+        """Show the progress of a running load and its first tracks"""
+        if generation != self.load_generation:
+            return
+        self.file_label.config(text=f"{self.file_name}（解析中 {index + 1}/{count}）")
+        if event_count > 0:
+            # Size without sync markers, corrected once loading finishes
+            self._insert_track_row(self.loaded_rows, 3 * (event_count + 1) + 4)
+            self.loaded_rows += 1
+
+    def _on_load_finished(self, generation, byte_list, unsynced_list, profiler):
+        """Swap in the packets of a finished load"""
+        if generation != self.load_generation:
+            return
+        self.load_cancel = None
+        self.bundle = None
+        self.byte_list, self.unsynced_list = byte_list, unsynced_list
+        self.file_label.config(text=self.file_name)
+        # Automatically update track table after file loaded
+        self.update_track_table()
+        self._watch(self.song_path if self.watch_file else None)
+        if profiler is not None:
+            self.show_profile_report(profiler)
+
+    def _watch(self, path):
+        """Watch `path` for new exports, or stop watching with None"""
+        if self.file_watcher is not None:
+            self.file_watcher.stop()
+            self.file_watcher = None
+        if path:
+            generation = self.load_generation
+            self.file_watcher = watch.FileWatcher(
+                path, lambda p: self._on_file_changed(p, generation)
+            )
+            self.file_watcher.start()
+            logging.info(f"Watching {path} for changes")
+
+    def _on_file_changed(self, path, generation):
+        """Convert a changed file again, on the watcher's thread"""
+        try:
+            byte_list, unsynced_list = self.midi_parser.parse(path)
+        except Exception as e:
+            logging.error(f"Error parsing changed {path}: {e}")
+            self.root.after(
+                0,
+                lambda: self.file_label.config(
+                    text=f"{self.file_name}（重新解析失败）"
+                ),
+            )
+            return
+        changed = set(self.midi_parser.changed_tracks)
+        self.root.after(
+            0, self._on_file_reloaded, generation, byte_list, unsynced_list, changed
+        )
+
+    def _on_file_reloaded(self, generation, byte_list, unsynced_list, changed):
+        """Show the tracks of a new export and upload the changed ones"""
+        if generation != self.load_generation or self.load_cancel is not None:
+            return
+        self.byte_list, self.unsynced_list = byte_list, unsynced_list
+        # The table rebuild resets the nodes, keep those the user assigned
+        assignments = dict(self.track_assignments)
+        self.update_track_table()
+        self.track_assignments.update(
+            (i, node_id) for i, node_id in assignments.items() if i < len(byte_list)
+        )
+        self._refresh_node_column()
+        self._update_preflight()
+        changed = {i for i in changed if i < len(byte_list)}
+        if not changed:
+            self.file_label.config(text=f"{self.file_name}（已重新加载，音符无变化）")
+            return
+        if (
+            self.is_playing
+            or not (self.opened_ser and self.opened_ser.is_open)
+            or self._check_node_assignment_conflicts()
+            or preflight.oversized(self._preflight())
+        ):
+            self.file_label.config(text=f"{self.file_name}（已重新加载，请手动传输）")
+            return
+        self.file_label.config(
+            text=f"{self.file_name}（已重新加载，正在传输 {len(changed)} 个音轨）"
+        )
+        threading.Thread(
+            target=self._upload_changed_worker, args=(changed,), daemon=True
+        ).start()
+
+    def _upload_changed_worker(self, changed):
+        """Worker thread to upload the tracks of a new export that changed"""
+        absent_nodes = self._absent_assigned_nodes()
+        assignments = {}
+        for i in range(len(self.byte_list)):
+            node_id = self.track_assignments.get(i, hex(i).upper()[2:])
+            if i not in changed or node_id in absent_nodes:
+                node_id = "不分配"
+            assignments[i] = node_id
+        expected = len(self.byte_list) - self._count_unassigned_tracks(assignments)
+        if self.delta_upload:
+            send_music_data = self.delta_uploader.send_music_data
+        else:
+            self.delta_uploader.forget()
+            send_music_data = hs.send_music_data
+        byte_list = self.byte_list if self.enable_sync else self.unsynced_list
+        try:
+            with self.bus_lock:
+                success_count = send_music_data(self.opened_ser, byte_list, assignments)
+        except Exception as e:
+            logging.error(f"Error uploading changed tracks: {e}")
+            success_count = 0
+        if success_count == expected:
+            text = f"{self.file_name}（已自动传输 {success_count} 个音轨）"
+        else:
+            text = f"{self.file_name}（自动传输失败 {expected - success_count} 个音轨）"
+        self.root.after(0, lambda: self.file_label.config(text=text))
+
+    def _on_load_failed(self, generation, error):
+        """Report a load that raised an exception"""
+        if generation != self.load_generation:
+            return
+        self.load_cancel = None
+        self._watch(None)
+        messagebox.showerror("错误", f"无法解析文件: {error}")
+        self.file_name = "未加载"
+        self.song_path = ""
+        self.file_label.config(text=self.file_name + "（解析失败）")
+        self.byte_list = []
+        self.unsynced_list = []
+        self.update_track_table()  # Clear the table
+
+    def show_profile_report(self, profiler: profiling.Profiler):
+        """Show the per-stage timing of the last file conversion"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"性能分析 - {self.file_name}")
+        dialog.geometry("720x400")
+
+        text = tk.Text(dialog, font=("Courier", 9), wrap="none")
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        text.insert(tk.END, profiler.summary_table())
+        text.config(state=tk.DISABLED)
+
+        button_frame = tk.Frame(dialog)
+        button_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+
+        def on_export():
+            path = filedialog.asksaveasfilename(
+                parent=dialog,
+                title="导出火焰图数据",
+                defaultextension=".folded",
+                filetypes=[("Collapsed stacks", "*.folded")],
+            )
+            if path:
+                try:
+                    profiler.write_collapsed(path)
+                except OSError as e:
+                    messagebox.showerror("错误", f"导出失败: {e}", parent=dialog)
+
+        tk.Button(button_frame, text="导出火焰图", command=on_export).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="关闭", command=dialog.destroy).pack(side=tk.RIGHT)
 
     def play_music(self):
         """Send play command to firmware"""
@@ -382,36 +1336,107 @@ class MidiFilePlayer:
             messagebox.showwarning("提示", "请先选择串口！")
             return
 
+        start_marker = max(self.start_marker_combo.current(), 0)
+        loop_end = max(self.loop_end_combo.current(), 0)
+        if (start_marker or loop_end) and not self.enable_sync:
+            messagebox.showwarning("提示", "未启用同步时无法从同步点开始或循环播放！")
+            return
+        if loop_end and loop_end <= start_marker:
+            messagebox.showwarning("提示", "循环终点必须在起始同步点之后！")
+            return
+        if self.bus_lock.locked():
+            messagebox.showwarning("提示", "正在播放、传输或扫描节点，请稍后再试！")
+            return
+
         # Send data in a new thread in case
         self.playback_thread = threading.Thread(
-            target=self._playback_controller, daemon=True
+            target=self._playback_controller,
+            args=(start_marker, loop_end),
+            daemon=True,
         )
         self.playback_thread.start()
 
-    def _playback_controller(self):
-        """Worker thread to send play command"""
+    def _playback_controller(self, start_marker: int = 0, loop_end: int = 0):
+        """Worker thread to send play command
+
+        Args:
+            start_marker (int): Sync marker to start after, 0 for the beginning.
+            loop_end (int): Sync marker to jump back to `start_marker` at, 0
+                to play to the end.
+        """
+        # The sync requests are read until the playback ends. The stop command
+        # and the modifiers are single writes and do not take the lock.
+        with self.bus_lock:
+            self._play(start_marker, loop_end)
+
+    def _play(self, start_marker: int, loop_end: int):
+        """Start playback and serve the sync requests until it ends"""
         if self.opened_ser and self.opened_ser.is_open:
-            hs.send_command(self.opened_ser, bytes([0x30]))
+            # Nodes keep the tempo and key of earlier runs, so they are always set
+            tempo = self.tempo
+            hs.send_command(
+                self.opened_ser,
+                hs.modifier_command(tempo, self.transpose)
+                + hs.start_command(start_marker, loop_end),
+            )
+            self.node_states.clear_playing()
         else:
             messagebox.showwarning("提示", "串口未打开！")
             logging.warning("Attempted to play music but serial port is not open.")
             return
 
+        # The learned waits and the beacons follow the markers from the beginning,
+        # the waits are learned at the original tempo
+        from_beginning = self.enable_sync and not (start_marker or loop_end)
+        tuner = None
+        beacon_times = None
+        if from_beginning and self.beacon_sync:
+            import beacon
+
+            scale = hs.tempo_scale(tempo) / hs.TEMPO_UNIT
+            beacon_times = [
+                t * scale
+                for t in beacon.beacon_times(
+                    sync_tuner.assigned_packets(self.byte_list, self.track_assignments)
+                )
+            ]
+        elif from_beginning and self.adaptive_sync and self.song_path and tempo == 1.0:
+            tuner = sync_tuner.SyncTuner.for_assignments(
+                self.byte_list,
+                self.track_assignments,
+                self.sync_waiting_time,
+                sync_tuner.sidecar_path(self.song_path),
+            )
+            self.tuner_running = True
+            tuner.begin()
+
         self.opened_ser.timeout = 0.1
         # Update UI status
         self.is_playing = True
         self.root.after(0, lambda: self.status_label.config(text="播放中"))
 
-        while self.opened_ser:
-            dt = self.opened_ser.read(1)
-            if len(dt) == 1:
-                if dt == b"\x70":
-                    time.sleep(self.sync_waiting_time)
-                    hs.send_command(self.opened_ser, bytes([0x80]))
-                elif dt == b"\x20":
-                    break
-            if not self.is_playing:
-                break
+        if beacon_times is not None:
+            ser = self.opened_ser
+            self.beacons_running = True
+            try:
+                beacon.send_beacons(
+                    lambda data: hs.send_command(ser, data),
+                    beacon_times,
+                    lambda: self.is_playing,
+                    baudrate=self.baudrate,
+                )
+            finally:
+                self.beacons_running = False
+        try:
+            hs.serve_sync_requests(
+                self.opened_ser,
+                tuner.wait if tuner else self.sync_waiting_time,
+                lambda: self.is_playing,
+            )
+            if tuner:
+                tuner.finish()
+        finally:
+            self.tuner_running = False
 
         self.opened_ser.timeout = 2.0
         self.root.after(0, lambda: self.status_label.config(text="停止"))
@@ -434,6 +1459,7 @@ class MidiFilePlayer:
         """Worker thread to send stop command"""
         if self.opened_ser and self.opened_ser.is_open:
             hs.send_command(self.opened_ser, bytes([0x40]))
+            self.node_states.clear_playing()
         else:
             messagebox.showwarning("提示", "串口未打开！")
             logging.warning("Attempted to stop music but serial port is not open.")
@@ -441,6 +1467,9 @@ class MidiFilePlayer:
     def transmit_music(self):
         """Transmit music data to the firmware"""
         # Check if file is loaded
+        if self.load_cancel is not None:
+            messagebox.showwarning("提示", "文件仍在加载中，请稍候！")
+            return
         if self.file_name == "未加载" or not self.byte_list:
             messagebox.showwarning("提示", "请先加载MIDI文件！")
             return
@@ -449,6 +1478,9 @@ class MidiFilePlayer:
         if not self.selected_port:
             messagebox.showwarning("提示", "请先选择串口！")
             return
+        if self.bus_lock.locked():
+            messagebox.showwarning("提示", "正在播放、传输或扫描节点，请稍后再试！")
+            return
 
         # Check for node assignment conflicts
         conflict_info = self._check_node_assignment_conflicts()
@@ -461,9 +1493,41 @@ class MidiFilePlayer:
             messagebox.showerror("节点分配冲突", conflict_message)
             return
 
+        # Catch size errors and slow uploads before sending anything
+        reports = self._preflight()
+        too_large = preflight.oversized(reports)
+        if too_large:
+            lines = [
+                f"音轨{hex(r.track_index).upper()[2:]}（节点 {r.node}）: {r.entries} 个音符"
+                for r in too_large
+            ]
+            messagebox.showerror(
+                "音轨过长",
+                f"以下音轨超过节点容量（{preflight.MAX_NOTES} 个音符）：\n\n"
+                + "\n".join(lines)
+                + "\n\n请取消分配这些音轨或缩短乐曲后再传输。",
+            )
+            return
+        eta = preflight.upload_eta(reports)
+        if eta > preflight.SLOW_UPLOAD_SECONDS and not messagebox.askyesno(
+            "传输较慢",
+            f"以当前波特率 {self.baudrate} 传输预计需要 {eta:.0f} 秒，是否继续？",
+        ):
+            return
+
+        # Skip nodes that did not answer the last scan if the user agrees
+        absent_nodes = self._absent_assigned_nodes()
+        if absent_nodes:
+            names = ", ".join(sorted(absent_nodes))
+            if not messagebox.askyesno(
+                "节点离线",
+                f"以下节点在上次扫描时未响应：{names}\n\n是否跳过这些节点继续传输？",
+            ):
+                return
+
         # Transmit in a new thread to avoid blocking UI
         transmission_thread = threading.Thread(
-            target=self._transmit_worker, daemon=True
+            target=self._transmit_worker, args=(absent_nodes,), daemon=True
         )
         transmission_thread.start()
 
@@ -501,37 +1565,58 @@ class MidiFilePlayer:
 
         return conflicts
 
-    def _count_unassigned_tracks(self):
+    def _absent_assigned_nodes(self):
+        """Assigned nodes that did not answer the last scan"""
+        if self.present_nodes is None:
+            return set()
+        absent = set()
+        for i in range(len(self.byte_list)):
+            node_id = self.track_assignments.get(i, hex(i).upper()[2:])
+            if node_id != "不分配" and int(node_id, 16) not in self.present_nodes:
+                absent.add(node_id)
+        return absent
+
+    def _count_unassigned_tracks(self, assignments=None):
         """Calculate number of unassigned tracks"""
+        if assignments is None:
+            assignments = self.track_assignments
         unassigned_count = 0
         for i in range(len(self.byte_list)):
-            node_id = self.track_assignments.get(i, hex(i).upper()[2:])
+            node_id = assignments.get(i, hex(i).upper()[2:])
             if node_id == "不分配":
                 unassigned_count += 1
         return unassigned_count
 
-    def _transmit_worker(self):
-        """Worker thread to transmit music data"""
+    def _transmit_worker(self, skipped_nodes=frozenset()):
+        """Worker thread to transmit music data, leaving out `skipped_nodes`"""
+        assignments = dict(self.track_assignments)
+        for i in range(len(self.byte_list)):
+            if assignments.get(i, hex(i).upper()[2:]) in skipped_nodes:
+                assignments[i] = "不分配"
         if self.opened_ser and self.opened_ser.is_open:
             # Transmission start
-            if not self.enable_sync:
-                success_count = hs.send_music_data(
-                    self.opened_ser, self.unsynced_list, self.track_assignments
-                )
+            if self.delta_upload:
+                send_music_data = self.delta_uploader.send_music_data
             else:
-                success_count = hs.send_music_data(
-                    self.opened_ser, self.byte_list, self.track_assignments
-                )
+                self.delta_uploader.forget()
+                send_music_data = hs.send_music_data
+            byte_list = self.byte_list if self.enable_sync else self.unsynced_list
+            with self.bus_lock:
+                success_count = send_music_data(self.opened_ser, byte_list, assignments)
             # Calculate expected transmissions
-            expected_transmissions = (
-                len(self.byte_list) - self._count_unassigned_tracks()
-            )
-            unassigned_count = self._count_unassigned_tracks()
+            expected_transmissions = len(
+                self.byte_list
+            ) - self._count_unassigned_tracks(assignments)
+            unassigned_count = self._count_unassigned_tracks(assignments)
 
             # Report results
             if success_count == expected_transmissions:
                 if unassigned_count > 0:
                     message = f"成功传输 {success_count} 个轨道！（跳过 {unassigned_count} 个未分配轨道）"
+                    if skipped_nodes:
+                        message += (
+                            f"\n离线节点 {', '.join(sorted(skipped_nodes))} 未传输"
+                        )
                 else:
                     message = f"所有 {success_count} 个轨道传输完成！"
                 self.root.after(
@@ -553,7 +1638,7 @@ class MidiFilePlayer:
         """Open settings dialog"""
         dialog = tk.Toplevel(self.root)
         dialog.title("设置")
-        dialog.geometry("400x425")
+        dialog.geometry("400x760")
         dialog.transient(self.root)
         dialog.grab_set()
         dialog.resizable(False, False)
@@ -614,6 +1699,22 @@ class MidiFilePlayer:
         )
         sync_waiting_desc.pack(anchor="w", pady=(5, 0))
 
+        self.adaptive_sync_var = tk.BooleanVar()
+        self.adaptive_sync_var.set(self.adaptive_sync)
+        tk.Checkbutton(
+            sync_frame,
+            text="按同步标记自动调整等待时间（记录在乐曲旁）",
+            variable=self.adaptive_sync_var,
+        ).pack(anchor="w", pady=(5, 0))
+
+        self.beacon_sync_var = tk.BooleanVar()
+        self.beacon_sync_var.set(self.beacon_sync)
+        tk.Checkbutton(
+            sync_frame,
+            text="信标同步（由上位机定时校准，标记处不停顿）",
+            variable=self.beacon_sync_var,
+        ).pack(anchor="w")
+
         # Baudrate settings section
         baudrate_frame = tk.LabelFrame(main_frame, text="串口设置", padx=10, pady=10)
         baudrate_frame.pack(fill=tk.X, pady=(0, 15))
@@ -652,6 +1753,69 @@ class MidiFilePlayer:
         )
         baudrate_desc.pack(anchor="w", pady=(5, 0))
 
+        self.delta_var = tk.BooleanVar()
+        self.delta_var.set(self.delta_upload)
+        tk.Checkbutton(
+            baudrate_frame,
+            text="增量传输（只发送修改过的音符）",
+            variable=self.delta_var,
+        ).pack(anchor="w", pady=(5, 0))
+
+        self.watch_var = tk.BooleanVar()
+        self.watch_var.set(self.watch_file)
+        tk.Checkbutton(
+            baudrate_frame,
+            text="监视 MIDI 文件，重新导出后自动传输修改过的音轨",
+            variable=self.watch_var,
+        ).pack(anchor="w")
+
+        self.capture_var = tk.BooleanVar()
+        self.capture_var.set(self.capture_bus)
+        tk.Checkbutton(
+            baudrate_frame,
+            text=f"记录总线数据到 {capture.CAPTURE_DIR} 目录（用于复现问题）",
+            variable=self.capture_var,
+        ).pack(anchor="w")
+
+        tk.Label(
+            baudrate_frame, text="网络桥接地址（如 tcp://舞台电脑:7485，留空不用）:"
+        ).pack(anchor="w", pady=(5, 0))
+        self.bridge_var = tk.StringVar()
+        self.bridge_var.set(self.bridge_address)
+        tk.Entry(baudrate_frame, textvariable=self.bridge_var, width=30).pack(
+            anchor="w"
+        )
+
+        # Telemetry settings section
+        telemetry_frame = tk.LabelFrame(main_frame, text="遥测设置", padx=10, pady=10)
+        telemetry_frame.pack(fill=tk.X, pady=(0, 15))
+
+        self.telemetry_var = tk.BooleanVar()
+        self.telemetry_var.set(metrics.is_enabled())
+
+        tk.Checkbutton(
+            telemetry_frame, text="启用传输遥测", variable=self.telemetry_var
+        ).pack(side=tk.LEFT)
+        tk.Button(
+            telemetry_frame, text="遥测面板", command=self.show_telemetry_panel
+        ).pack(side=tk.RIGHT)
+
+        # Profiling settings section
+        profiling_frame = tk.LabelFrame(main_frame, text="性能分析", padx=10, pady=10)
+        profiling_frame.pack(fill=tk.X, pady=(0, 15))
+
+        self.profile_var = tk.BooleanVar()
+        self.profile_var.set(self.profile_loading)
+        self.profile_alloc_var = tk.BooleanVar()
+        self.profile_alloc_var.set(self.profile_allocations)
+
+        tk.Checkbutton(
+            profiling_frame, text="加载文件时分析耗时", variable=self.profile_var
+        ).pack(side=tk.LEFT)
+        tk.Checkbutton(
+            profiling_frame, text="统计内存分配", variable=self.profile_alloc_var
+        ).pack(side=tk.LEFT, padx=(10, 0))
+
         # Button frame
         button_frame = tk.Frame(main_frame)
         button_frame.pack(fill=tk.X, pady=(15, 0))
@@ -659,6 +1823,8 @@ class MidiFilePlayer:
         def on_ok():
             """Apply settings and close dialog"""
             old_baudrate = self.baudrate
+            old_capture_bus = self.capture_bus
+            old_bridge_address = self.bridge_address
 
             # Validate sync waiting time
             try:
@@ -672,10 +1838,47 @@ class MidiFilePlayer:
                 messagebox.showerror("错误", "同步等待时间必须是有效的数字")
                 return
 
+            bridge_address = self.bridge_var.get().strip()
+            if bridge_address:
+                import bridge
+
+                try:
+                    bridge.parse_url(bridge_address)
+                except ValueError:
+                    messagebox.showerror(
+                        "错误", "网络桥接地址的格式应为 tcp://主机:端口"
+                    )
+                    return
+
             # Update settings
             self.enable_sync = self.sync_var.get()
             self.baudrate = int(self.baudrate_var.get())
             self.sync_waiting_time = sync_waiting_time
+            self.adaptive_sync = self.adaptive_sync_var.get()
+            self.beacon_sync = self.beacon_sync_var.get()
+            self.delta_upload = self.delta_var.get()
+            if self.watch_var.get() != self.watch_file:
+                self.watch_file = self.watch_var.get()
+                self.midi_parser.forget()
+                watched = self.song_path and self.bundle is None and self.byte_list
+                if self.watch_file and watched:
+                    # Learn the current tracks, only later exports are uploaded
+                    threading.Thread(
+                        target=self.midi_parser.parse,
+                        args=(self.song_path,),
+                        daemon=True,
+                    ).start()
+                    self._watch(self.song_path)
+                else:
+                    self._watch(None)
+            self.capture_bus = self.capture_var.get()
+            self.bridge_address = bridge_address
+            metrics.enable(self.telemetry_var.get())
+            self.profile_loading = self.profile_var.get()
+            self.profile_allocations = self.profile_alloc_var.get()
+            self._update_preflight()  # Baud rate and sync change the estimates
+            if old_bridge_address != self.bridge_address:
+                self.on_ports_changed(self.port_monitor.ports)
 
             # If baudrate changed and serial port is open, reconnect
             if (
@@ -683,21 +1886,21 @@ class MidiFilePlayer:
                 and self.opened_ser
                 and self.opened_ser.is_open
             ):
-                try:
-                    port = self.selected_port
-                    self.opened_ser.close()
-                    time.sleep(0.1)  # Brief delay for port to close
-                    self.opened_ser = hs.open_serial_port(port, self.baudrate)
-                    messagebox.showinfo(
-                        "提示", f"串口已重新连接，波特率: {self.baudrate}"
-                    )
-                    logging.info(
-                        f"Serial port reconnected with new baudrate: {self.baudrate}"
-                    )
-                except Exception as e:
-                    messagebox.showerror("错误", f"重新连接串口失败: {e}")
-                    logging.error(f"Failed to reconnect serial port: {e}")
-                    self.opened_ser = None
+                self._open_port(
+                    self.selected_port,
+                    success_message=f"串口已重新连接，波特率: {self.baudrate}",
+                )
+                logging.info(
+                    f"Reconnecting serial port with new baudrate: {self.baudrate}"
+                )
+            elif (
+                old_capture_bus != self.capture_bus
+                and self.opened_ser
+                and self.opened_ser.is_open
+                and not self.is_playing
+            ):
+                # Recording starts or stops with the next opening of the port
+                self._open_port(self.selected_port)
 
             dialog.destroy()
             logging.info(
@@ -713,6 +1916,15 @@ class MidiFilePlayer:
             self.sync_var.set(True)
             self.baudrate_var.set("115200")
             self.sync_waiting_var.set("0.1")
+            self.adaptive_sync_var.set(True)
+            self.beacon_sync_var.set(False)
+            self.delta_var.set(True)
+            self.watch_var.set(False)
+            self.capture_var.set(False)
+            self.bridge_var.set("")
+            self.telemetry_var.set(False)
+            self.profile_var.set(False)
+            self.profile_alloc_var.set(False)
 
         # Create buttons
         tk.Button(button_frame, text="确定", command=on_ok, width=8).pack(
@@ -727,6 +1939,59 @@ class MidiFilePlayer:
             side=tk.RIGHT
         )
 
+    def show_telemetry_panel(self):
+        """Open a live view of the transmission telemetry"""
+        panel = tk.Toplevel(self.root)
+        panel.title("遥测面板")
+        panel.geometry("560x420")
+
+        text = tk.Text(panel, font=("Courier", 9), wrap="none")
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+
+        button_frame = tk.Frame(panel)
+        button_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+
+        def refresh():
+            if not panel.winfo_exists():
+                return
+            if metrics.is_enabled():
+                content = metrics.to_prometheus()
+            else:
+                content = "遥测未启用，请在选项设置中开启。\n"
+            text.delete("1.0", tk.END)
+            text.insert(tk.END, content)
+            panel.after(1000, refresh)
+
+        def export(kind):
+            path = filedialog.asksaveasfilename(
+                parent=panel,
+                title="导出遥测数据",
+                defaultextension=".prom" if kind == "prom" else ".json",
+                filetypes=[("Prometheus 文本", "*.prom")]
+                if kind == "prom"
+                else [("JSON 文件", "*.json")],
+            )
+            if not path:
+                return
+            try:
+                if kind == "prom":
+                    metrics.write_prometheus(path)
+                else:
+                    metrics.write_json(path)
+            except OSError as e:
+                messagebox.showerror("错误", f"导出失败: {e}", parent=panel)
+
+        tk.Button(
+            button_frame, text="导出 Prometheus", command=lambda: export("prom")
+        ).pack(side=tk.LEFT, padx=(0, 5))
+        tk.Button(button_frame, text="导出 JSON", command=lambda: export("json")).pack(
+            side=tk.LEFT, padx=(0, 5)
+        )
+        tk.Button(button_frame, text="清零", command=metrics.reset).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="关闭", command=panel.destroy).pack(side=tk.RIGHT)
+
+        refresh()
+
     def preset_music(self):
         """Open preset music selection dialog"""
         # Check if serial port is selected
@@ -810,7 +2075,9 @@ class MidiFilePlayer:
         """Worker thread to send preset music command"""
         if self.opened_ser and self.opened_ser.is_open:
             try:
-                hs.send_command(self.opened_ser, bytes([command_byte]))
+                with self.bus_lock:
+                    hs.send_command(self.opened_ser, bytes([command_byte]))
+                self.delta_uploader.forget()  # Built-in music replaced the data
                 self.root.after(
                     0,
                     lambda: messagebox.showinfo(
@@ -833,6 +2100,8 @@ class MidiFilePlayer:
 
     def about(self):
         """Show about dialog with author and project information"""
+        import webbrowser
+
         dialog = tk.Toplevel(self.root)
         dialog.title("关于")
         dialog.geometry("480x280")
@@ -909,8 +2178,28 @@ class MidiFilePlayer:
         version_label.pack(pady=(10, 0))
 
 
+def on_first_frame(root, callback):
+    """Call `callback` once, after the window has been mapped and drawn"""
+
+    def on_map(event):
+        if event.widget is root:
+            root.unbind("<Map>", binding)
+            # Idle callbacks queued after the mapping run after its redraw
+            root.after_idle(callback)
+
+    binding = root.bind("<Map>", on_map, add="+")
+
+
 if __name__ == "__main__":
     root = tk.Tk()
     app = MidiFilePlayer(root)
     root.resizable(False, False)
+    on_first_frame(root, app.start_background_tasks)
+    if "--measure-startup" in sys.argv:
+        # Used by startup_report.py: print the wall clock of the first frame
+        def report_first_frame():
+            print(f"first-frame {time.time():.6f}", flush=True)
+            root.after(0, root.destroy)
+
+        on_first_frame(root, report_first_frame)
     root.mainloop()
@@ -1,9 +1,24 @@
+from __future__ import annotations
+
 import logging
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Callable
+
+import metrics
 
-import serial
-import serial.tools.list_ports
+# pyserial is imported on first use to keep the GUI start fast
+if TYPE_CHECKING:
+    import serial
 
 BAUDRATE = 115200
+# Spacing of the node responses to multicast and bulk uploads, see protocol.md
+ACK_SLOT = 0.002
+# Reply window of a presence probe, covering the node and USB adapter latency
+PROBE_TIMEOUT = 0.03
+# Duration multiplier of the original tempo in a modifier (0xD4), TEMPO_UNIT
+# in globals.h
+TEMPO_UNIT = 64
 
 
 def get_serial_ports() -> tuple[list[str], list[str]]:
@@ -14,6 +29,8 @@ def get_serial_ports() -> tuple[list[str], list[str]]:
             - List of available serial port names.
             - List of port descriptions (including name and description).
     """
+    import serial.tools.list_ports
+
     ports = serial.tools.list_ports.comports()
     available_ports = [port.device for port in ports]
 
@@ -37,8 +54,18 @@ def open_serial_port(port: str, baudrate: int = BAUDRATE, *, timeout: None | flo
         timeout (None | float): Timeout for read operations. Defaults to 2.0.
 
     Returns:
-        serial.Serial: Opened serial port object.
+        serial.Serial: Opened serial port object. For a bridge address such
+            as tcp://stage-pc:7485 a `bridge.TcpSerial` that behaves like one.
     """
+    if port.startswith("tcp://"):
+        from bridge import TcpSerial
+
+        ser = TcpSerial(port, baudrate, timeout)
+        logging.debug(f"Bridge {port} connected with baudrate {baudrate}.")
+        return ser
+
+    import serial
+
     ser = serial.Serial(
         port=port,
         baudrate=baudrate,
@@ -55,27 +82,104 @@ def send_command(ser: serial.Serial, data: bytes):
     """Send data to the specified serial port."""
     ser.write(data)
     ser.flush()
+    metrics.inc("stc_bytes_written_total", len(data))
 
     logging.info(f"Command 0x{data.hex()} sent successfully to port {ser.name}")
 
 
+def start_command(start_marker: int = 0, loop_end: int = 0) -> bytes:
+    """Command starting playback on all nodes (0x30), or from a marker (0xD3).
+
+    Markers are counted from 1 in every track, the same in all of them.
+
+    Args:
+        start_marker (int): Sync marker to start after, 0 plays from the beginning.
+        loop_end (int): Sync marker at which playback jumps back to
+            `start_marker` after the sync, 0 plays to the end. Must come after
+            `start_marker`.
+
+    Returns:
+        bytes: The command, for `send_command`.
+    """
+    if not 0 <= start_marker <= 0xFF or not 0 <= loop_end <= 0xFF:
+        raise ValueError("Markers must be between 0 and 255")
+    if loop_end and loop_end <= start_marker:
+        raise ValueError(f"Loop end {loop_end} is not after marker {start_marker}")
+    if start_marker == 0 and loop_end == 0:
+        return bytes([0x30])
+    return bytes([0xD3, start_marker, loop_end])
+
+
+def tempo_scale(tempo: float) -> int:
+    """Duration multiplier in 1/TEMPO_UNIT the nodes play `tempo` with.
+
+    Args:
+        tempo (float): Playback speed relative to the song, 0.5 for half speed.
+
+    Raises:
+        ValueError: If the nodes cannot play that speed.
+    """
+    scale = round(TEMPO_UNIT / tempo) if tempo > 0 else 0
+    if not 1 <= scale <= 0xFF:
+        raise ValueError(
+            f"Tempo must be between {TEMPO_UNIT / 0xFF:.2f} and {TEMPO_UNIT:.0f}"
+        )
+    return scale
+
+
+def modifier_command(tempo: float = 1.0, transpose: int = 0) -> bytes:
+    """Command changing the tempo and key of all nodes (0xD4).
+
+    The nodes apply it from their next note on, also while playing, and
+    keep it for later playbacks until the next modifier.
+
+    Args:
+        tempo (float): Playback speed relative to the song, see `tempo_scale`.
+        transpose (int): Semitones to transpose by, between -128 and 127.
+
+    Returns:
+        bytes: The command, for `send_command`.
+    """
+    if not -0x80 <= transpose <= 0x7F:
+        raise ValueError("Transposition must be between -128 and 127 semitones")
+    return bytes([0xD4, tempo_scale(tempo), transpose & 0xFF])
+
+
 def send_music_data(
-    ser: serial.Serial, byte_list: list[bytes], track_assignments: dict[int, str]
+    ser: serial.Serial,
+    byte_list: list[bytes],
+    track_assignments: dict[int, str],
+    *,
+    fold_duplicates: bool = True,
+    bulk: bool = True,
+    on_result: Callable[[int, int, bool], None] | None = None,
+    clock: Callable[[], float] = time.perf_counter,
 ) -> int:
     """Send music data to the specified serial port.
 
+    Identical tracks assigned to different nodes are sent once with a
+    multicast upload (0xD0) unless `fold_duplicates` is False. The other
+    tracks are sent together in one bulk frame (0xD1) unless `bulk` is False.
+
     Args:
         ser (serial.Serial): Serial port name.
         byte_list (list[bytes]): List of byte data for each track.
         track_assignments (dict[int, str]): Mapping of track index to node ID.
+        fold_duplicates (bool): Fold identical tracks into multicast uploads.
+            Defaults to True.
+        bulk (bool): Send tracks of different nodes in one bulk frame.
+            Defaults to True.
+        on_result (Callable[[int, int, bool], None] | None): Called with the
+            track index, node ID and result of every upload.
+        clock (Callable[[], float]): Time source matching the responses to
+            their slots, replaceable for simulated buses. Defaults to
+            time.perf_counter.
 
     Returns:
         int: Number of successfully transmitted tracks
     """
-    success_count = 0
-    processed_tracks = 0
-
-    for track_index, track_data in enumerate(byte_list):
+    uploads: list[tuple[int, int]] = []  # (track index, node ID)
+    for track_index in range(len(byte_list)):
         # Get node ID from assignments, default to hex of track index
         node_id = track_assignments.get(track_index, hex(track_index).upper()[2:])
 
@@ -83,21 +187,114 @@ def send_music_data(
         if node_id == "不分配":
             logging.debug(f"Skip {track_index} (unassigned)")
             continue
+        uploads.append((track_index, int(node_id, 16)))
 
-        processed_tracks += 1
-        node_id_int = int(node_id, 16)
-
-        logging.info(f"Start transmitting track {track_index} to node {node_id}...")
+    if fold_duplicates:
+        groups = group_duplicate_tracks(byte_list, uploads)
+    else:
+        groups = [[upload] for upload in uploads]
+
+    bulk_group: list[tuple[int, int]] = []
+    if bulk:
+        node_uses = Counter(node_id for _, node_id in uploads)
+        bulk_group = [
+            group[0]
+            for group in groups
+            if len(group) == 1
+            and node_uses[group[0][1]] == 1
+            and len(byte_list[group[0][0]]) >= 4
+        ]
+    if len(bulk_group) > 1:
+        groups = [bulk_group] + [g for g in groups if g[0] not in bulk_group]
 
-        if send_track_data(ser, node_id_int, track_data):
-            success_count += 1
-            logging.debug(f"Track {track_index} transmitted successfully.")
+    success_count = 0
+    saved_bytes = 0
+    for group in groups:
+        if group is bulk_group:
+            logging.info(
+                f"Start transmitting tracks "
+                f"{', '.join(str(i) for i, _ in group)} in one bulk frame..."
+            )
+            results = send_bulk_data(
+                ser, [(node_id, byte_list[i]) for i, node_id in group], clock=clock
+            )
+        elif len(group) == 1:
+            track_index, node_id = group[0]
+            logging.info(
+                f"Start transmitting track {track_index} to node {node_id:X}..."
+            )
+            results = {node_id: send_track_data(ser, node_id, byte_list[track_index])}
         else:
-            logging.error(f"Track {track_index} transmission failed.")
-
+            track_index = group[0][0]
+            node_ids = [node_id for _, node_id in group]
+            logging.info(
+                f"Start transmitting track {track_index} to nodes "
+                f"{', '.join(f'{n:X}' for n in node_ids)}..."
+            )
+            results = send_multicast_data(
+                ser, node_ids, byte_list[track_index], clock=clock
+            )
+            # 0xD0 adds two bytes of node mask to a single packet
+            saved_bytes += (len(group) - 1) * len(byte_list[track_index]) - 2
+
+        for track_index, node_id in group:
+            success = results.get(node_id)
+            if success is None:
+                logging.warning(
+                    f"Retrying track {track_index} on node {node_id:X} alone"
+                )
+                success = send_track_data(ser, node_id, byte_list[track_index])
+            if success:
+                success_count += 1
+                logging.debug(f"Track {track_index} transmitted successfully.")
+            else:
+                logging.error(f"Track {track_index} transmission failed.")
+            if on_result is not None:
+                on_result(track_index, node_id, success)
+
+    if saved_bytes > 0:
+        baudrate = getattr(ser, "baudrate", BAUDRATE)
+        logging.info(
+            f"Multicast saved {saved_bytes} bytes "
+            f"({saved_bytes * 10 / baudrate:.2f} s at {baudrate} bps)"
+        )
     return success_count
 
 
+def group_duplicate_tracks(
+    byte_list: list[bytes], uploads: list[tuple[int, int]]
+) -> list[list[tuple[int, int]]]:
+    """Group uploads of identical tracks that can share a multicast upload.
+
+    Nodes receiving more than one track keep their own uploads, so the
+    order in which they are overwritten does not change.
+
+    Args:
+        byte_list (list[bytes]): List of byte data for each track.
+        uploads (list[tuple[int, int]]): (track index, node ID) in sending order.
+
+    Returns:
+        list[list[tuple[int, int]]]: Groups in order of their first upload.
+    """
+    node_uses: dict[int, int] = {}
+    for _, node_id in uploads:
+        node_uses[node_id] = node_uses.get(node_id, 0) + 1
+
+    groups: list[list[tuple[int, int]]] = []
+    by_data: dict[bytes, list[tuple[int, int]]] = {}
+    for track_index, node_id in uploads:
+        data = byte_list[track_index][1:]  # The header holds the node ID
+        if node_uses[node_id] > 1 or not data:
+            groups.append([(track_index, node_id)])
+            continue
+        group = by_data.get(data)
+        if group is None:
+            group = by_data[data] = []
+            groups.append(group)
+        group.append((track_index, node_id))
+    return groups
+
+
 def preview_track(ser: serial.Serial, node_id: int, track_data: bytes) -> bool:
     """Preview a single track on the specified node.
 
@@ -129,7 +326,8 @@ def send_track_data(ser: serial.Serial, node_id: int, track_data: bytes) -> bool
     Args:
         ser (str): Serial port object.
         node_id (int): The node ID to send data to.
-        track_data (byte): The complete track data packet.
+        track_data (bytes): The complete track data packet, any bytes-like
+            object such as a memoryview of a bundle.
             (NOTE: You don't have to modify the header by yourself, this function
             will do it for you. But you need to make sure other data is correct,
             including size and checksum.)
@@ -145,39 +343,350 @@ def send_track_data(ser: serial.Serial, node_id: int, track_data: bytes) -> bool
             logging.warning(f"Track data for node {node_id} is empty. Skipping.")
             return False
 
-        # Create a mutable bytearray from the original track data
-        packet = bytearray(track_data)
-        new_header = 0x10 | (node_id & 0x0F)
-        packet[0] = new_header
+        # Only the header differs, so it is written on its own and the rest
+        # of the packet is sent without a copy, e.g. straight from a bundle
+        new_header = bytes([0x10 | (node_id & 0x0F)])
+        return _send_and_wait(ser, node_id, new_header, memoryview(track_data)[1:])
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        return False
 
-        # Send the packet
-        logging.debug(f"Sending data ({len(packet)} bytes) to node {node_id}")
-        ser.write(packet)
-        ser.flush()
 
-        # Wait for response
-        response = ser.read(1)
-        if len(response) == 1:
-            response_byte = response[0]
-            logging.debug(f"Response received: {hex(response_byte)}")
+def send_patch_data(
+    ser: serial.Serial, node_id: int, offset: int, entries: bytes
+) -> bool:
+    """Overwrite part of the music data of a node (event 0xA_).
 
-            if response_byte == 0xE0:  # Success
-                return True
-            elif response_byte == 0xF0:  # Fail
-                logging.warning(f"Firmware reported failure for node {node_id}")
-                return False
-            elif response_byte == 0xF1:  # Size error
-                logging.warning(f"Size error reported by node {node_id}")
-                return False
-            else:
-                logging.warning(
-                    f"Unknown response from node {node_id}: {hex(response_byte)}"
-                )
-                return False
-        else:
-            logging.warning(f"No response received from node {node_id}")
-            return False
+    Args:
+        ser (serial.Serial): Serial port object.
+        node_id (int): The node ID to send data to.
+        offset (int): Index of the first entry to overwrite.
+        entries (bytes): New entries, 3 bytes each as in a track data packet.
 
+    Returns:
+        bool: True if the node acknowledged the patch, False otherwise.
+    """
+    try:
+        ser.read_all()  # Clear input buffer
+        size = len(entries)
+        packet = bytearray([0xA0 | (node_id & 0x0F), offset >> 8, offset & 0xFF])
+        packet += bytes([size >> 8, size & 0xFF])
+        packet += entries
+        checksum = (offset >> 8) ^ (offset & 0xFF)
+        for dt in entries:
+            checksum ^= dt
+        packet.append(checksum)
+        return _send_and_wait(ser, node_id, packet)
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
         return False
+
+
+def _send_and_wait(ser: serial.Serial, node_id: int, *chunks: bytes) -> bool:
+    """Send a packet addressed to a single node and check its response.
+
+    The packet may be given in several chunks, they are written back to back.
+    """
+    size = sum(len(chunk) for chunk in chunks)
+    logging.debug(f"Sending data ({size} bytes) to node {node_id}")
+    for chunk in chunks:
+        ser.write(chunk)
+    ser.flush()
+    sent_at = time.perf_counter()
+    metrics.inc("stc_bytes_written_total", size)
+    metrics.inc("stc_packets_sent_total", node=node_id)
+
+    # Wait for response
+    response = ser.read(1)
+    if len(response) == 1:
+        return _check_response(node_id, response[0], sent_at)
+    else:
+        logging.warning(f"No response received from node {node_id}")
+        metrics.inc("stc_upload_responses_total", node=node_id, result="timeout")
+        return False
+
+
+def send_multicast_data(
+    ser: serial.Serial,
+    node_ids: list[int],
+    track_data: bytes,
+    *,
+    clock: Callable[[], float] = time.perf_counter,
+) -> dict[int, bool]:
+    """Send a single track data packet to several nodes at once (event 0xD0).
+
+    The nodes respond in node order, one every `ACK_SLOT`.
+
+    Args:
+        ser (serial.Serial): Serial port object.
+        node_ids (list[int]): The node IDs to send data to.
+        track_data (bytes): The complete track data packet, as for
+            `send_track_data`.
+        clock (Callable[[], float]): Time source matching the responses to
+            their slots. Defaults to time.perf_counter.
+
+    Returns:
+        dict[int, bool]: Whether each node received the data. Nodes whose
+            response could not be matched to them are left out, see
+            `_send_and_collect`.
+    """
+    node_ids = sorted(set(node_ids))
+    try:
+        ser.read_all()  # Clear input buffer
+        if len(track_data) == 0:
+            logging.warning("Track data for multicast upload is empty. Skipping.")
+            return {}
+
+        mask = 0
+        for node_id in node_ids:
+            mask |= 1 << (node_id & 0x0F)
+        packet = bytes([0xD0, mask >> 8, mask & 0xFF]) + track_data[1:]
+
+        logging.debug(f"Sending data ({len(packet)} bytes) to node mask {mask:04x}")
+        return _send_and_collect(ser, node_ids, packet, clock)
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        return {}
+
+
+def send_bulk_data(
+    ser: serial.Serial,
+    tracks: list[tuple[int, bytes]],
+    *,
+    clock: Callable[[], float] = time.perf_counter,
+) -> dict[int, bool]:
+    """Send track data packets of several nodes in one frame (event 0xD1).
+
+    The nodes respond after the whole frame in node order, one every
+    `ACK_SLOT`.
+
+    Args:
+        ser (serial.Serial): Serial port object.
+        tracks (list[tuple[int, bytes]]): Node ID and complete track data
+            packet, as for `send_track_data`, of up to 16 different nodes.
+        clock (Callable[[], float]): Time source matching the responses to
+            their slots. Defaults to time.perf_counter.
+
+    Returns:
+        dict[int, bool]: Whether each node received its data. Nodes whose
+            response could not be matched to them are left out, see
+            `_send_and_collect`.
+    """
+    if len(tracks) > 16 or len({node_id for node_id, _ in tracks}) != len(tracks):
+        raise ValueError("A bulk frame holds up to 16 different nodes")
+    try:
+        ser.read_all()  # Clear input buffer
+        if not tracks or any(len(track_data) < 4 for _, track_data in tracks):
+            logging.warning("Track data for bulk upload is empty. Skipping.")
+            return {}
+
+        # Segment table, then data and checksum of every packet
+        packet = bytearray([0xD1, len(tracks)])
+        for node_id, track_data in tracks:
+            packet += bytes([node_id & 0x0F]) + track_data[1:3]
+        for _, track_data in tracks:
+            packet += track_data[3:]
+
+        logging.debug(
+            f"Sending bulk frame ({len(packet)} bytes) to {len(tracks)} nodes"
+        )
+        return _send_and_collect(ser, sorted(n for n, _ in tracks), packet, clock)
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        return {}
+
+
+def _send_and_collect(
+    ser: serial.Serial,
+    node_ids: list[int],
+    packet: bytes,
+    clock: Callable[[], float] = time.perf_counter,
+) -> dict[int, bool]:
+    """Send a packet to several nodes and match their slotted responses.
+
+    Responses do not name their node. If some are missing, the others are
+    matched to the slots by their arrival times, see `_match_slots`. Nodes
+    whose response cannot be told apart are left out of the result.
+    """
+    ser.write(packet)
+    ser.flush()
+    sent_at = time.perf_counter()
+    metrics.inc("stc_bytes_written_total", len(packet))
+    for node_id in node_ids:
+        metrics.inc("stc_packets_sent_total", node=node_id)
+
+    # The first response takes as long as for a single node, the others
+    # follow in their slots
+    arrivals: list[tuple[float, int]] = []
+    response = ser.read(1)
+    if len(response) == 1:
+        arrivals.append((clock(), response[0]))
+        deadline = arrivals[0][0] + len(node_ids) * ACK_SLOT + 0.05
+        timeout = ser.timeout
+        try:
+            while len(arrivals) < len(node_ids) and clock() < deadline:
+                ser.timeout = deadline - clock()
+                response = ser.read(1)
+                if len(response) != 1:
+                    break
+                arrivals.append((clock(), response[0]))
+        finally:
+            ser.timeout = timeout
+
+    if len(arrivals) == len(node_ids):
+        responses = dict(enumerate(response_byte for _, response_byte in arrivals))
+    else:
+        logging.warning(f"{len(arrivals)} responses from {len(node_ids)} nodes")
+        responses = _match_slots(arrivals, len(node_ids))
+    return {
+        node_ids[slot]: _check_response(node_ids[slot], response_byte, sent_at)
+        for slot, response_byte in responses.items()
+    }
+
+
+def _match_slots(arrivals: list[tuple[float, int]], slot_count: int) -> dict[int, int]:
+    """Response of every slot that can be told apart when some are missing.
+
+    The spacing of the arrivals gives their slots relative to the first
+    one. Which slot that is depends on how many of the missing responses
+    come first, and the adapter latency hides it. A slot is matched only
+    if every possible first slot gives it a response of the same value.
+
+    Args:
+        arrivals (list[tuple[float, int]]): Arrival time and byte of every
+            response, in order.
+        slot_count (int): Number of nodes addressed.
+
+    Returns:
+        dict[int, int]: Slot -> response byte. Empty if two responses
+            arrived in one slot, e.g. delivered together by the USB adapter.
+    """
+    if not arrivals:
+        return {}
+    start = arrivals[0][0]
+    by_offset = {
+        round((t - start) / ACK_SLOT): response_byte for t, response_byte in arrivals
+    }
+    if len(by_offset) != len(arrivals) or max(by_offset) >= slot_count:
+        return {}
+    spare = slot_count - 1 - max(by_offset)
+    matched = {}
+    for slot in range(slot_count):
+        candidates = {by_offset.get(slot - s) for s in range(spare + 1)}
+        if len(candidates) == 1 and None not in candidates:
+            matched[slot] = candidates.pop()
+    return matched
+
+
+def _check_response(node_id: int, response_byte: int, sent_at: float) -> bool:
+    """Interpret the response of a node to an upload and record it."""
+    logging.debug(f"Response received: {hex(response_byte)}")
+    metrics.inc("stc_bytes_read_total")
+    metrics.observe(
+        "stc_ack_latency_seconds", time.perf_counter() - sent_at, node=node_id
+    )
+
+    if response_byte == 0xE0:  # Success
+        metrics.inc("stc_upload_responses_total", node=node_id, result="ack")
+        return True
+    elif response_byte == 0xF0:  # Fail
+        logging.warning(f"Firmware reported failure for node {node_id}")
+        metrics.inc("stc_upload_responses_total", node=node_id, result="nak")
+        return False
+    elif response_byte == 0xF1:  # Size error
+        logging.warning(f"Size error reported by node {node_id}")
+        metrics.inc("stc_upload_responses_total", node=node_id, result="size_error")
+        return False
+    else:
+        logging.warning(f"Unknown response from node {node_id}: {hex(response_byte)}")
+        metrics.inc("stc_upload_responses_total", node=node_id, result="unknown")
+        return False
+
+
+def probe_node(
+    ser: serial.Serial, node_id: int, timeout: float = PROBE_TIMEOUT
+) -> bool:
+    """Check whether a node is on the bus (event 0xB_).
+
+    Nodes do not answer while they are playing.
+
+    Args:
+        ser (serial.Serial): Serial port object.
+        node_id (int): The node ID to probe.
+        timeout (float): Seconds to wait for the reply. Defaults to PROBE_TIMEOUT.
+
+    Returns:
+        bool: True if the node replied.
+    """
+    ser.read_all()  # Clear input buffer
+    ser.write(bytes([0xB0 | (node_id & 0x0F)]))
+    ser.flush()
+    metrics.inc("stc_bytes_written_total")
+
+    old_timeout = ser.timeout
+    ser.timeout = timeout
+    try:
+        response = ser.read(1)
+    finally:
+        ser.timeout = old_timeout
+    metrics.inc("stc_bytes_read_total", len(response))
+    return response == b"\xe1"
+
+
+def scan_nodes(
+    ser: serial.Serial, node_ids=range(16), timeout: float = PROBE_TIMEOUT
+) -> set[int]:
+    """Probe every address and return the nodes that replied.
+
+    Scanning all 16 addresses takes at most 16 * `timeout`.
+    """
+    present = {node_id for node_id in node_ids if probe_node(ser, node_id, timeout)}
+    logging.info(f"Nodes present: {', '.join(f'{n:X}' for n in sorted(present))}")
+    return present
+
+
+def serve_sync_requests(
+    ser: serial.Serial,
+    sync_waiting_time: float | Callable[[int], float],
+    keep_running: Callable[[], bool],
+    *,
+    sleep: Callable[[float], None] = time.sleep,
+) -> bool:
+    """Answer sync requests of node 0 until the music ends or playback is stopped.
+
+    Args:
+        ser (serial.Serial): Serial port object, its timeout should be short
+            enough for `keep_running` to be polled regularly.
+        sync_waiting_time (float | Callable[[int], float]): Delay before
+            answering a sync request with 0x80, or a function of the index of
+            the marker returning it, e.g. `SyncTuner.wait`.
+        keep_running (Callable[[], bool]): Polled after every read, playback
+            control returns as soon as it reports False.
+        sleep (Callable[[float], None]): Waits before the reply, replaceable
+            for simulated buses. Defaults to time.sleep.
+
+    Returns:
+        bool: True if node 0 reported the end of the music (0x20).
+    """
+    marker = 0
+    while ser:
+        dt = ser.read(1)
+        if len(dt) == 1:
+            metrics.inc("stc_bytes_read_total")
+            if dt == b"\x70":
+                requested_at = time.perf_counter()
+                metrics.inc("stc_sync_requests_total")
+                if callable(sync_waiting_time):
+                    sleep(sync_waiting_time(marker))
+                else:
+                    sleep(sync_waiting_time)
+                marker += 1
+                send_command(ser, bytes([0x80]))
+                metrics.observe(
+                    "stc_sync_turnaround_seconds", time.perf_counter() - requested_at
+                )
+            elif dt == b"\x20":
+                return True
+        if not keep_running():
+            break
+    return False
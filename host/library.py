@@ -0,0 +1,567 @@
+"""
+Catalog of a MIDI library, for finding songs that fit the nodes.
+
+`Library` scans a directory tree for MIDI files and keeps per-file and
+per-track stats in an SQLite index: converted tracks, entries after
+encoding (see preflight.py), polyphony, playing time, tempo changes, sync
+markers and whether the song fits into NODE_COUNT nodes of MAX_NOTES
+entries each. Refreshing converts new files in parallel worker processes
+and skips files whose size and modification time are unchanged. A file
+that was only touched is recognized by its content hash and not
+converted again.
+
+The index lives in INDEX_NAME at the root of the library unless another
+path is given. Examples:
+
+    python library.py scan ~/midi
+    python library.py find ~/midi --fits --max-tracks 8 --name waltz
+    python library.py tracks ~/midi choir/waltz.mid
+"""
+
+import argparse
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import Callable
+
+import parse_midi as pm
+import preflight
+
+NODE_COUNT = 16  # Nodes on a bus
+MAX_NOTES = preflight.MAX_NOTES
+INDEX_NAME = ".stc-library.sqlite"
+MIDI_EXTENSIONS = (".mid", ".midi")
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,  -- Relative to the library root, "/" separated
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    midi_tracks INTEGER NOT NULL,
+    tracks INTEGER NOT NULL,  -- Tracks after conversion, one per node
+    max_entries INTEGER NOT NULL,
+    polyphony INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    tempo_changes INTEGER NOT NULL,
+    markers INTEGER NOT NULL,
+    fits INTEGER NOT NULL,
+    error TEXT NOT NULL  -- Why the file could not be converted, "" if it was
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE,
+    track INTEGER NOT NULL,
+    midi_track INTEGER NOT NULL,
+    entries INTEGER NOT NULL,
+    polyphony INTEGER NOT NULL,
+    play_seconds REAL NOT NULL,
+    sync_points INTEGER NOT NULL,
+    PRIMARY KEY (path, track)
+);
+CREATE INDEX IF NOT EXISTS files_fit ON files (fits, tracks, duration);
+"""
+
+
+@dataclass(frozen=True)
+class TrackStats:
+    """Stats of a converted track, from its synced variant"""
+
+    track: int  # Track index as in the GUI's track table
+    midi_track: int  # MIDI track it was converted from
+    entries: int  # Notes, rests, markers and the end symbol
+    polyphony: int  # Most notes held at once, above 1 they play one after another
+    play_seconds: float
+    sync_points: int
+
+
+@dataclass(frozen=True)
+class SongStats:
+    """Stats of a MIDI file of the library"""
+
+    path: str  # Relative to the library root, "/" separated
+    midi_tracks: int
+    tracks: int
+    max_entries: int
+    polyphony: int  # Most notes held at once over all tracks
+    duration: float  # Seconds, the longest track
+    tempo_changes: int
+    markers: int
+    fits: bool  # At most NODE_COUNT tracks of at most MAX_NOTES entries
+    error: str = ""
+
+
+@dataclass(frozen=True)
+class _Analysis:
+    """Result of a worker, None stats if the content is unchanged"""
+
+    path: str
+    size: int
+    mtime_ns: int
+    digest: str
+    song: SongStats | None
+    tracks: list[TrackStats] = field(default_factory=list)
+
+
+@dataclass
+class RefreshResult:
+    """What a refresh of the index did"""
+
+    files: int = 0  # MIDI files found
+    converted: int = 0
+    touched: int = 0  # Modified time changed, content did not
+    removed: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+
+def _scan_track(track) -> tuple[int, list[tuple[int, int]], int]:
+    """Count what the converter does not report for a MIDI track.
+
+    Returns:
+        tuple: Most notes held at once, counted by note number like the
+            converter does, the (tick, +1 or -1) changes of held notes and
+            the tempo changes after the start.
+    """
+    held: set[int] = set()
+    changes = []
+    tick = 0
+    most = 0
+    tempo_changes = 0
+    for msg in track:
+        tick += msg.time
+        if msg.type == "note_on" and msg.velocity > 0:
+            if msg.note not in held:
+                held.add(msg.note)
+                changes.append((tick, 1))
+                most = max(most, len(held))
+        elif msg.type in ("note_off", "note_on"):
+            if msg.note in held:
+                held.remove(msg.note)
+                changes.append((tick, -1))
+        elif msg.type == "set_tempo" and tick > 0:
+            tempo_changes += 1
+    return most, changes, tempo_changes
+
+
+def analyze_song(
+    path: str, data: bytes, config: pm.MidiConfig | None = None
+) -> tuple[SongStats, list[TrackStats]]:
+    """Convert a MIDI file like the GUI does and collect its stats.
+
+    Args:
+        path (str): Name of the file in the results.
+        data (bytes): Content of the MIDI file.
+        config (pm.MidiConfig | None): Conversion settings, `enable_sync`
+            is ignored. Defaults to MidiConfig().
+    """
+    # mido is imported on first use, worker processes import it themselves
+    from mido import MidiFile
+
+    config = replace(config or pm.MidiConfig(), enable_sync=True)
+    mid = MidiFile(file=io.BytesIO(data))
+    tempo = config.default_tempo
+    note_stack: dict[int, int] = {}
+    event_list = []
+    sources = []  # MIDI track of every converted track
+    polyphony = []
+    markers = []
+    changes = []
+    tempo_changes = 0
+    for midi_track, track in enumerate(mid.tracks):
+        events, tempo, track_markers = pm.walk_track(
+            track, mid.ticks_per_beat, tempo, note_stack, config
+        )
+        markers += track_markers
+        most, track_changes, track_tempo_changes = _scan_track(track)
+        changes += track_changes
+        tempo_changes += track_tempo_changes
+        if events:
+            event_list.append(events)
+            sources.append(midi_track)
+            polyphony.append(most)
+    pm.merge_markers(event_list, markers, config)
+
+    tracks = []
+    for track_index, events in enumerate(event_list):
+        report = preflight.analyze_track(track_index, pm.events_to_binary(events), "")
+        tracks.append(
+            TrackStats(
+                track_index,
+                sources[track_index],
+                report.entries,
+                polyphony[track_index],
+                report.play_seconds,
+                report.sync_points,
+            )
+        )
+
+    # Releases before attacks at the same tick
+    held = most = 0
+    for _, change in sorted(changes):
+        held += change
+        most = max(most, held)
+    max_entries = max((t.entries for t in tracks), default=0)
+    song = SongStats(
+        path=path,
+        midi_tracks=len(mid.tracks),
+        tracks=len(tracks),
+        max_entries=max_entries,
+        polyphony=most,
+        duration=max((t.play_seconds for t in tracks), default=0.0),
+        tempo_changes=tempo_changes,
+        markers=max((t.sync_points for t in tracks), default=0),
+        fits=0 < len(tracks) <= NODE_COUNT and max_entries <= MAX_NOTES,
+    )
+    return song, tracks
+
+
+def _analyze_file(root: str, path: str, known_digest: str | None) -> _Analysis:
+    """Worker: hash a file and convert it unless the hash is `known_digest`."""
+    full_path = os.path.join(root, path)
+    with open(full_path, "rb") as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if digest == known_digest:
+        return _Analysis(path, st.st_size, st.st_mtime_ns, digest, None)
+    try:
+        song, tracks = analyze_song(path, data)
+    except Exception as e:
+        # Broken or unusual files are listed with the reason
+        error = str(e) or type(e).__name__
+        song = SongStats(path, 0, 0, 0, 0, 0.0, 0, 0, False, error)
+        tracks = []
+    return _Analysis(path, st.st_size, st.st_mtime_ns, digest, song, tracks)
+
+
+def find_midi_files(root: str) -> dict[str, os.stat_result]:
+    """MIDI files below `root` by their relative, "/" separated path."""
+    found = {}
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            if name.lower().endswith(MIDI_EXTENSIONS):
+                full_path = os.path.join(directory, name)
+                path = os.path.relpath(full_path, root).replace(os.sep, "/")
+                try:
+                    found[path] = os.stat(full_path)
+                except OSError:
+                    continue  # Removed while scanning
+    return found
+
+
+class Library:
+    """SQLite index of the MIDI files below a directory.
+
+    Args:
+        root (str): Directory of the library.
+        index_path (str | None): Index file. Defaults to INDEX_NAME in `root`.
+    """
+
+    def __init__(self, root: str, index_path: str | None = None):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path or os.path.join(self.root, INDEX_NAME)
+        # Refreshes may run on a worker thread of the GUI
+        self._db = sqlite3.connect(self.index_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA foreign_keys = ON")
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            # Only a cache of the files, rebuilt when the layout changes
+            self._db.executescript(
+                "DROP TABLE IF EXISTS tracks; DROP TABLE IF EXISTS files;"
+            )
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._db.executescript(_SCHEMA)
+
+    def refresh(
+        self,
+        *,
+        jobs: int | None = None,
+        on_file: Callable[[int, int], None] | None = None,
+    ) -> RefreshResult:
+        """Bring the index up to date with the files.
+
+        Args:
+            jobs (int | None): Worker processes, 1 converts in this process.
+                Defaults to the number of CPUs.
+            on_file (Callable[[int, int], None] | None): Called with the
+                number of files done and to do after every checked file.
+
+        Returns:
+            RefreshResult: Counts of what changed.
+        """
+        start = time.perf_counter()
+        found = find_midi_files(self.root)
+        known = {
+            row["path"]: row
+            for row in self._db.execute(
+                "SELECT path, size, mtime_ns, digest FROM files"
+            )
+        }
+        result = RefreshResult(files=len(found))
+
+        removed = [(path,) for path in known if path not in found]
+        with self._db:
+            self._db.executemany("DELETE FROM files WHERE path = ?", removed)
+        result.removed = len(removed)
+
+        todo = []
+        for path, st in found.items():
+            row = known.get(path)
+            if row and (row["size"], row["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+                continue
+            todo.append((path, row["digest"] if row else None))
+
+        jobs = jobs or os.cpu_count() or 1
+        if jobs == 1 or len(todo) < 2:
+            analyses = (_analyze_file(self.root, *item) for item in todo)
+            self._store(analyses, len(todo), result, on_file)
+        else:
+            paths = [path for path, _ in todo]
+            digests = [digest for _, digest in todo]
+            # Fresh interpreters, forking the threads of the GUI is unsafe
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(jobs, mp_context=context) as pool:
+                analyses = pool.map(
+                    _analyze_file, [self.root] * len(todo), paths, digests, chunksize=4
+                )
+                self._store(analyses, len(todo), result, on_file)
+
+        result.seconds = time.perf_counter() - start
+        logging.info(
+            f"Library {self.root}: {result.files} files, {result.converted} "
+            f"converted, {result.touched} touched, {result.removed} removed, "
+            f"{result.failed} failed in {result.seconds:.2f} s"
+        )
+        return result
+
+    def _store(self, analyses, count: int, result: RefreshResult, on_file):
+        for done, analysis in enumerate(analyses, 1):
+            with self._db:
+                if analysis.song is None:
+                    self._db.execute(
+                        "UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?",
+                        (analysis.size, analysis.mtime_ns, analysis.path),
+                    )
+                    result.touched += 1
+                else:
+                    self._insert(analysis)
+                    result.converted += 1
+                    result.failed += bool(analysis.song.error)
+            if on_file is not None:
+                on_file(done, count)
+
+    def _insert(self, analysis: _Analysis):
+        song = analysis.song
+        # Replacing the row drops its tracks through the foreign key
+        self._db.execute(
+            "INSERT OR REPLACE INTO files VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                song.path,
+                analysis.size,
+                analysis.mtime_ns,
+                analysis.digest,
+                song.midi_tracks,
+                song.tracks,
+                song.max_entries,
+                song.polyphony,
+                song.duration,
+                song.tempo_changes,
+                song.markers,
+                song.fits,
+                song.error,
+            ),
+        )
+        self._db.executemany(
+            "INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    song.path,
+                    t.track,
+                    t.midi_track,
+                    t.entries,
+                    t.polyphony,
+                    t.play_seconds,
+                    t.sync_points,
+                )
+                for t in analysis.tracks
+            ],
+        )
+
+    def find(
+        self,
+        *,
+        name: str = "",
+        fits: bool = False,
+        max_tracks: int | None = None,
+        max_seconds: float | None = None,
+        max_polyphony: int | None = None,
+        with_markers: bool = False,
+    ) -> list[SongStats]:
+        """Songs of the index matching all given conditions, by path.
+
+        Args:
+            name (str): Part of the path, case-insensitive.
+            fits (bool): Only songs that fit NODE_COUNT nodes of MAX_NOTES.
+            max_tracks (int | None): Most converted tracks, e.g. the online nodes.
+            max_seconds (float | None): Longest playing time.
+            max_polyphony (int | None): Most notes held at once in a track.
+            with_markers (bool): Only songs with sync markers.
+        """
+        conditions = ["error = ''"]
+        params: list[object] = []
+        if name:
+            conditions.append("path LIKE ? ESCAPE '\\'")
+            for char in "\\%_":
+                name = name.replace(char, "\\" + char)
+            params.append(f"%{name}%")
+        if fits:
+            conditions.append("fits")
+        if max_tracks is not None:
+            conditions.append("tracks <= ?")
+            params.append(max_tracks)
+        if max_seconds is not None:
+            conditions.append("duration <= ?")
+            params.append(max_seconds)
+        if max_polyphony is not None:
+            conditions.append(
+                "NOT EXISTS (SELECT 1 FROM tracks t "
+                "WHERE t.path = files.path AND t.polyphony > ?)"
+            )
+            params.append(max_polyphony)
+        if with_markers:
+            conditions.append("markers > 0")
+        rows = self._db.execute(
+            f"SELECT * FROM files WHERE {' AND '.join(conditions)} ORDER BY path",
+            params,
+        )
+        return [self._song(row) for row in rows]
+
+    def failed(self) -> list[SongStats]:
+        """Files that could not be converted, with the reason."""
+        rows = self._db.execute("SELECT * FROM files WHERE error != '' ORDER BY path")
+        return [self._song(row) for row in rows]
+
+    def tracks(self, path: str) -> list[TrackStats]:
+        """Track stats of a song of the index."""
+        rows = self._db.execute(
+            "SELECT track, midi_track, entries, polyphony, play_seconds, sync_points "
+            "FROM tracks WHERE path = ? ORDER BY track",
+            (path,),
+        )
+        return [TrackStats(*row) for row in rows]
+
+    def full_path(self, path: str) -> str:
+        return os.path.join(self.root, *path.split("/"))
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _song(row: sqlite3.Row) -> SongStats:
+        return SongStats(
+            path=row["path"],
+            midi_tracks=row["midi_tracks"],
+            tracks=row["tracks"],
+            max_entries=row["max_entries"],
+            polyphony=row["polyphony"],
+            duration=row["duration"],
+            tempo_changes=row["tempo_changes"],
+            markers=row["markers"],
+            fits=bool(row["fits"]),
+            error=row["error"],
+        )
+
+
+def format_song(song: SongStats) -> str:
+    """One line of the `find` output."""
+    if song.error:
+        return f"{song.path}: {song.error}"
+    minutes, seconds = divmod(round(song.duration), 60)
+    return (
+        f"{song.path}: {song.tracks} tracks, {song.max_entries}/{MAX_NOTES} entries, "
+        f"polyphony {song.polyphony}, {minutes}:{seconds:02d}, "
+        f"{song.tempo_changes} tempo changes, {song.markers} markers"
+        + ("" if song.fits else ", does not fit")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index and search a MIDI library")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_library_options(p):
+        p.add_argument("root", help="directory of the library")
+        p.add_argument("--index", help=f"index file, defaults to ROOT/{INDEX_NAME}")
+
+    p = subparsers.add_parser("scan", help="update the index with the files")
+    add_library_options(p)
+    p.add_argument("-j", "--jobs", type=int, help="worker processes")
+    p = subparsers.add_parser("find", help="list indexed songs")
+    add_library_options(p)
+    p.add_argument("--name", default="", help="part of the path")
+    p.add_argument("--fits", action="store_true", help=f"fits {NODE_COUNT} nodes")
+    p.add_argument("--max-tracks", type=int, metavar="N")
+    p.add_argument("--max-seconds", type=float, metavar="SECONDS")
+    p.add_argument(
+        "--max-polyphony", type=int, metavar="N", help="most notes at once per track"
+    )
+    p.add_argument("--markers", action="store_true", help="with sync markers only")
+    p.add_argument("--failed", action="store_true", help="list unreadable files")
+    p = subparsers.add_parser("tracks", help="show the tracks of a song")
+    add_library_options(p)
+    p.add_argument("path", help="path of the song relative to ROOT")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+
+    with Library(args.root, args.index) as library:
+        if args.command == "scan":
+            result = library.refresh(jobs=args.jobs)
+            print(
+                f"{result.files} files: {result.converted} converted "
+                f"({result.failed} failed), {result.touched} unchanged after a "
+                f"touch, {result.removed} removed, {result.seconds:.2f} s"
+            )
+        elif args.command == "find":
+            if args.failed:
+                songs = library.failed()
+            else:
+                songs = library.find(
+                    name=args.name,
+                    fits=args.fits,
+                    max_tracks=args.max_tracks,
+                    max_seconds=args.max_seconds,
+                    max_polyphony=args.max_polyphony,
+                    with_markers=args.markers,
+                )
+            for song in songs:
+                print(format_song(song))
+        else:
+            for t in library.tracks(args.path):
+                print(
+                    f"{t.track:3X} (MIDI track {t.midi_track}): {t.entries} entries, "
+                    f"polyphony {t.polyphony}, {t.play_seconds:.1f} s, "
+                    f"{t.sync_points} sync points"
+                )
+
+
+if __name__ == "__main__":
+    main()
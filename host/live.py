@@ -0,0 +1,435 @@
+"""
+Live MIDI input, played by the nodes as it comes in.
+
+Notes from a `mido` input port, e.g. a MIDI keyboard, are given to free
+nodes by `VoiceAllocator` and sent as live note events (0xC_, see
+protocol.md), which a node plays as soon as it has received them.
+`LiveScheduler` coalesces the events arriving within a short window into
+one write, leaves out events superseded by a later one for the same node
+and measures the latency from the arrival of a MIDI message until its
+event has left the host.
+
+Opening input ports needs a mido backend such as python-rtmidi:
+
+    python live.py --port /dev/ttyUSB0 [--input "USB Keyboard"] [--nodes 0-7]
+    python live.py --list
+
+`--loopback` plays a MIDI file through the same code on a simulated bus
+instead and reports the latency until the nodes have received the events:
+
+    python live.py --loopback song.mid [--baudrate 115200] [--budget 5]
+"""
+
+import argparse
+import logging
+import queue
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+import mido
+
+import host_serial as hs
+import metrics
+
+NOTE_STOP = 255
+# Seconds an event waits for others to share its write, e.g. the notes of a chord
+COALESCE_WINDOW = 0.001
+# Seconds between polls of keep_running while no MIDI messages come in
+IDLE_TIMEOUT = 0.1
+
+
+@dataclass(frozen=True)
+class LiveEvent:
+    """A live note event written to the bus"""
+
+    node_id: int
+    note: int  # MIDI note number, or NOTE_STOP
+    received: float  # Clock time the MIDI message arrived
+    sent: float  # Clock time the write had left the host
+
+    @property
+    def latency(self) -> float:
+        return self.sent - self.received
+
+
+class VoiceAllocator:
+    """Gives every sounding note a node of its own.
+
+    A new note goes to the node that has been silent for the longest time.
+    When all nodes sound, the oldest note is cut off for it.
+
+    Args:
+        node_ids: Nodes available for live notes.
+    """
+
+    def __init__(self, node_ids):
+        self.free: list[int] = list(node_ids)  # Longest silent first
+        # (channel, note) -> node ID, in the order the notes started
+        self.voices: dict[tuple[int, int], int] = {}
+
+    def note_on(self, channel: int, note: int) -> list[tuple[int, int]]:
+        """Start a note.
+
+        Returns:
+            list[tuple[int, int]]: (node ID, note byte) events to send.
+        """
+        key = (channel, note)
+        if key in self.voices:
+            node_id = self.voices.pop(key)  # Struck again, keep its node
+        elif self.free:
+            node_id = self.free.pop(0)
+        elif self.voices:
+            oldest = next(iter(self.voices))
+            node_id = self.voices.pop(oldest)
+            logging.debug(f"Note {oldest[1]} cut off on node {node_id:X}")
+        else:
+            return []
+        self.voices[key] = node_id
+        return [(node_id, note)]
+
+    def note_off(self, channel: int, note: int) -> list[tuple[int, int]]:
+        """Release a note, nothing happens for notes that were cut off."""
+        node_id = self.voices.pop((channel, note), None)
+        if node_id is None:
+            return []
+        self.free.append(node_id)
+        return [(node_id, NOTE_STOP)]
+
+    def all_off(self) -> list[tuple[int, int]]:
+        """Release all sounding notes."""
+        events = [(node_id, NOTE_STOP) for node_id in self.voices.values()]
+        self.free += [node_id for node_id, _ in events]
+        self.voices.clear()
+        return events
+
+
+class LiveScheduler:
+    """Writes live note events, coalescing the ones that arrive together.
+
+    Args:
+        ser (serial.Serial): Serial port object.
+        window (float): Seconds the first pending event waits for others
+            before they are written together. Defaults to COALESCE_WINDOW.
+        clock (Callable[[], float]): Time source of the receive times,
+            replaceable for simulated buses. Defaults to time.perf_counter.
+    """
+
+    def __init__(
+        self,
+        ser,
+        *,
+        window: float = COALESCE_WINDOW,
+        clock: Callable[[], float] = time.perf_counter,
+    ):
+        self.ser = ser
+        self.window = window
+        self.clock = clock
+        self._pending: dict[int, tuple[int, float]] = {}  # Node -> (note, received)
+        self._sounding: dict[int, int] = {}  # Node -> last note byte sent
+        self.writes = 0
+        self.coalesced = 0  # Events left out as a later one superseded them
+
+    def submit(self, node_id: int, note: int, received: float):
+        """Queue an event, it replaces a pending one for the same node."""
+        if node_id in self._pending:
+            self.coalesced += 1
+            del self._pending[node_id]
+        if self._sounding.get(node_id, NOTE_STOP) == note:
+            # The node already sounds it, e.g. a note released and struck
+            # again within the window
+            self.coalesced += 1
+            return
+        self._pending[node_id] = (note, received)
+
+    def timeout(self) -> float | None:
+        """Seconds until the pending events are due, None without any."""
+        if not self._pending:
+            return None
+        first = min(received for _, received in self._pending.values())
+        return max(first + self.window - self.clock(), 0.0)
+
+    def poll(self) -> list[LiveEvent]:
+        """Write the pending events if they are due.
+
+        Returns:
+            list[LiveEvent]: The events written, in the order they arrived.
+        """
+        timeout = self.timeout()
+        if timeout is None or timeout > 0:
+            return []
+        return self.flush()
+
+    def flush(self) -> list[LiveEvent]:
+        """Write all pending events at once."""
+        if not self._pending:
+            return []
+        pending = sorted(self._pending.items(), key=lambda item: item[1][1])
+        self._pending.clear()
+        frame = bytearray()
+        for node_id, (note, _) in pending:
+            frame += bytes([0xC0 | node_id, note])
+        # flush() returns once the bytes left the port, for USB adapters
+        # once the adapter took them
+        self.ser.write(frame)
+        self.ser.flush()
+        sent = self.clock()
+        self.writes += 1
+        metrics.inc("stc_bytes_written_total", len(frame))
+
+        events = []
+        for node_id, (note, received) in pending:
+            self._sounding[node_id] = note
+            event = LiveEvent(node_id, note, received, sent)
+            metrics.inc("stc_live_events_total", node=node_id)
+            metrics.observe("stc_live_latency_seconds", event.latency)
+            events.append(event)
+        return events
+
+
+class LivePlayer:
+    """Turns MIDI messages into live note events on one bus.
+
+    Args:
+        ser (serial.Serial): Serial port object.
+        node_ids: Nodes available for live notes.
+        **scheduler_options: Passed to `LiveScheduler`.
+    """
+
+    def __init__(self, ser, node_ids, **scheduler_options):
+        self.allocator = VoiceAllocator(node_ids)
+        self.scheduler = LiveScheduler(ser, **scheduler_options)
+        self.latencies: list[float] = []
+
+    def handle(self, message, received: float):
+        """Queue the events of a MIDI message that arrived at `received`."""
+        if message.type == "note_on" and message.velocity > 0:
+            events = self.allocator.note_on(message.channel, message.note)
+        elif message.type in ("note_on", "note_off"):
+            events = self.allocator.note_off(message.channel, message.note)
+        elif message.type == "control_change" and message.control in (120, 123):
+            events = self.allocator.all_off()  # All sound off, all notes off
+        else:
+            return
+        for node_id, note in events:
+            self.scheduler.submit(node_id, note, received)
+
+    def timeout(self) -> float | None:
+        return self.scheduler.timeout()
+
+    def poll(self) -> list[LiveEvent]:
+        events = self.scheduler.poll()
+        self.latencies += [event.latency for event in events]
+        return events
+
+    def stop(self) -> list[LiveEvent]:
+        """Silence all nodes right away."""
+        for node_id, note in self.allocator.all_off():
+            self.scheduler.submit(node_id, note, self.scheduler.clock())
+        events = self.scheduler.flush()
+        self.latencies += [event.latency for event in events]
+        return events
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def format_latencies(latencies: list[float]) -> str:
+    """One-line summary of latencies in seconds."""
+    if not latencies:
+        return "no events"
+    values = sorted(latencies)
+    return (
+        f"{len(values)} events, p50 {percentile(values, 0.5) * 1e3:.2f} ms, "
+        f"p99 {percentile(values, 0.99) * 1e3:.2f} ms, "
+        f"max {values[-1] * 1e3:.2f} ms"
+    )
+
+
+def play_live(
+    player: LivePlayer, input_name: str | None, keep_running: Callable[[], bool]
+):
+    """Play the notes of a MIDI input port until `keep_running` reports False.
+
+    The nodes are silenced when it returns, also on exceptions such as
+    KeyboardInterrupt.
+
+    Args:
+        player (LivePlayer): Player of the bus, with a time.perf_counter clock.
+        input_name (str | None): MIDI input port, None for the default one.
+        keep_running (Callable[[], bool]): Polled at least every IDLE_TIMEOUT.
+    """
+    clock = player.scheduler.clock
+    messages = queue.SimpleQueue()
+    # Nodes playing music ignore live notes
+    hs.send_command(player.scheduler.ser, bytes([0x40]))
+    try:
+        # Messages are timestamped in the backend's thread as they arrive
+        port = mido.open_input(
+            input_name, callback=lambda message: messages.put((clock(), message))
+        )
+    except ImportError:
+        raise RuntimeError(
+            "MIDI input ports need a mido backend, install it with "
+            "`pip install python-rtmidi`"
+        ) from None
+    logging.info(f"Playing live input from {port.name}")
+
+    with port:
+        try:
+            while keep_running():
+                timeout = player.timeout()
+                try:
+                    received, message = messages.get(
+                        timeout=IDLE_TIMEOUT if timeout is None else timeout
+                    )
+                    player.handle(message, received)
+                    # Take everything that arrived meanwhile before writing
+                    while True:
+                        received, message = messages.get_nowait()
+                        player.handle(message, received)
+                except queue.Empty:
+                    pass
+                player.poll()
+        finally:
+            player.stop()
+
+
+def loopback(
+    midi_file: str,
+    node_ids=range(16),
+    baudrate: int = hs.BAUDRATE,
+    *,
+    window: float = COALESCE_WINDOW,
+    latency: float = 0.0,
+) -> tuple[LivePlayer, list[float]]:
+    """Play a MIDI file as live input on a simulated bus.
+
+    The messages arrive at the times of the file, so chords arrive as
+    bursts and notes of busy passages queue up behind the writes before
+    them, as with a keyboard.
+
+    Args:
+        midi_file (str): Path to the MIDI file.
+        node_ids: Nodes on the bus. Defaults to all 16.
+        baudrate (int): Baud rate of the bus. Defaults to BAUDRATE.
+        window (float): Coalescing window. Defaults to COALESCE_WINDOW.
+        latency (float): Adapter latency, see `SimulatedSerial`.
+
+    Returns:
+        tuple[LivePlayer, list[float]]: The player, with the latencies until
+            the events had left the host, and the latencies until the nodes
+            had received them.
+    """
+    from simulator import SimulatedSerial
+
+    node_ids = list(node_ids)
+    sim = SimulatedSerial(node_ids, baudrate, latency=latency)
+    player = LivePlayer(sim, node_ids, window=window, clock=lambda: sim.now)
+    sent: list[LiveEvent] = []
+
+    t = 0.0
+    for message in mido.MidiFile(midi_file):
+        t += message.time
+        if message.is_meta:
+            continue
+        while (timeout := player.timeout()) is not None and sim.now + timeout <= t:
+            sim.sleep(timeout)
+            sent += player.poll()
+        sim.sleep(max(t - sim.now, 0.0))
+        player.handle(message, t)
+        sent += player.poll()
+    while (timeout := player.timeout()) is not None:
+        sim.sleep(timeout)
+        sent += player.poll()
+    sent += player.stop()
+
+    # Every event written is logged once by its node, in the same order
+    arrivals = {node_id: iter(node.live_log) for node_id, node in sim.nodes.items()}
+    node_latencies = [next(arrivals[e.node_id])[0] - e.received for e in sent]
+    return player, node_latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play live MIDI input on the nodes")
+    parser.add_argument("--port", help="serial port of the bus")
+    parser.add_argument("--input", help="MIDI input port, defaults to the first one")
+    parser.add_argument("--list", action="store_true", help="list MIDI input ports")
+    parser.add_argument(
+        "--nodes", default="0-F", help="nodes to use, e.g. 0-7 or 0,3,5"
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=COALESCE_WINDOW * 1e3,
+        metavar="MS",
+        help="coalescing window",
+    )
+    parser.add_argument("--baudrate", type=int, default=hs.BAUDRATE)
+    parser.add_argument(
+        "--loopback", metavar="MIDI_FILE", help="play a file on a simulated bus"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="adapter latency of the simulated bus",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=5.0,
+        metavar="MS",
+        help="loopback fails if p99 latency at the nodes exceeds it",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+
+    if args.list:
+        for name in mido.get_input_names():
+            print(name)
+        return 0
+
+    node_ids = set()
+    for part in args.nodes.split(","):
+        first, _, last = part.partition("-")
+        node_ids.update(range(int(first, 16), int(last or first, 16) + 1))
+    node_ids = sorted(node_ids)
+    window = args.window / 1e3
+
+    if args.loopback:
+        player, node_latencies = loopback(
+            args.loopback, node_ids, args.baudrate, window=window, latency=args.latency
+        )
+        scheduler = player.scheduler
+        print(f"{scheduler.writes} writes, {scheduler.coalesced} events coalesced")
+        print(f"host:  {format_latencies(player.latencies)}")
+        print(f"nodes: {format_latencies(node_latencies)}")
+        p99 = percentile(sorted(node_latencies), 0.99) if node_latencies else 0.0
+        if p99 * 1e3 > args.budget:
+            print(f"p99 latency exceeds the budget of {args.budget} ms")
+            return 1
+        return 0
+
+    if not args.port:
+        parser.error("--port is required unless --list or --loopback is given")
+    ser = hs.open_serial_port(args.port, args.baudrate)
+    player = LivePlayer(ser, node_ids, window=window)
+    try:
+        play_live(player, args.input, lambda: True)
+    except KeyboardInterrupt:
+        pass
+    print(format_latencies(player.latencies))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
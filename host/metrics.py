@@ -0,0 +1,220 @@
+"""
+Telemetry counters and histograms for the host side of the RS485 bus.
+
+The layer is disabled by default. Every recording function returns
+immediately while disabled, so instrumented code paths only pay for a
+single boolean check. Call `enable()` to start collecting, then export
+the collected values with `to_prometheus()` or `snapshot()`.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Iterator
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+# Help text of every metric exported by the host program
+METRIC_HELP = {
+    "stc_bytes_written_total": "Bytes written to the serial port",
+    "stc_bytes_read_total": "Bytes read from the serial port",
+    "stc_packets_sent_total": "Music data packets sent, per node",
+    "stc_upload_responses_total": "Upload results, per node and result",
+    "stc_ack_latency_seconds": "Time from the last byte of a packet to its response",
+    "stc_sync_requests_total": "Sync requests (0x70) received from node 0",
+    "stc_sync_turnaround_seconds": "Time from a sync request to the 0x80 reply",
+    "stc_parse_seconds": "Time spent parsing MIDI files into events",
+    "stc_encode_seconds": "Time spent encoding events into packets",
+    "stc_beacons_total": "Beacons (0xD2) sent in beacon sync mode",
+    "stc_live_events_total": "Live note events sent, per node",
+    "stc_live_latency_seconds": "Time from a live MIDI message to its event on the bus",
+    "stc_mixer_latency_seconds": "Time from a mixer action to its commands on the bus",
+}
+
+_enabled = False
+_lock = threading.Lock()
+_counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_histograms: dict[tuple[str, tuple[tuple[str, str], ...]], "_Histogram"] = {}
+_NULL_TIMER = nullcontext()
+
+
+class _Histogram:
+    """Cumulative histogram with fixed bucket bounds"""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+def enable(enabled: bool = True):
+    """Enable or disable metric collection. Collected values are kept."""
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    """Drop every collected value."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _key(name: str, labels: dict[str, object]):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def inc(name: str, amount: float = 1, **labels):
+    """Increase a counter.
+
+    Args:
+        name (str): Metric name, should end with `_total`.
+        amount (float): Value to add. Defaults to 1.
+        **labels: Label values of the series.
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels):
+    """Record a value (in seconds) into a histogram.
+
+    Args:
+        name (str): Metric name, should end with `_seconds`.
+        value (float): Observed value.
+        **labels: Label values of the series.
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram()
+        histogram.observe(value)
+
+
+@contextmanager
+def _timer(name: str, labels: dict[str, object]) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timer(name: str, **labels):
+    """Context manager observing the time spent in its body.
+
+    A shared no-op context is returned while metrics are disabled.
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _timer(name, labels)
+
+
+def snapshot() -> dict:
+    """Return all collected values as a JSON-serialisable dictionary."""
+    with _lock:
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(_counters.items())
+        ]
+        histograms = [
+            {
+                "name": name,
+                "labels": dict(labels),
+                "buckets": dict(zip(map(str, h.buckets), h.counts)),
+                "count": h.count,
+                "sum": h.sum,
+            }
+            for (name, labels), h in sorted(_histograms.items())
+        ]
+    return {
+        "timestamp": time.time(),
+        "counters": counters,
+        "histograms": histograms,
+    }
+
+
+def _format_labels(labels: dict[str, str], extra: dict[str, str] | None = None) -> str:
+    merged = {**labels, **(extra or {})}
+    if not merged:
+        return ""
+    body = ",".join(f'{k}="{v}"' for k, v in merged.items())
+    return "{" + body + "}"
+
+
+def to_prometheus() -> str:
+    """Format all collected values in the Prometheus text exposition format."""
+    data = snapshot()
+    lines: list[str] = []
+    declared: set[str] = set()
+
+    def declare(name: str, kind: str):
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for counter in data["counters"]:
+        declare(counter["name"], "counter")
+        lines.append(
+            f"{counter['name']}{_format_labels(counter['labels'])} {counter['value']:g}"
+        )
+    for histogram in data["histograms"]:
+        name, labels = histogram["name"], histogram["labels"]
+        declare(name, "histogram")
+        for bound, count in histogram["buckets"].items():
+            lines.append(
+                f"{name}_bucket{_format_labels(labels, {'le': bound})} {count}"
+            )
+        lines.append(
+            f"{name}_bucket{_format_labels(labels, {'le': '+Inf'})} {histogram['count']}"
+        )
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str):
+    """Write the Prometheus text file (e.g. for node_exporter's textfile collector)."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(to_prometheus())
+
+
+def write_json(path: str):
+    """Write a JSON snapshot of all collected values."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(snapshot(), f, indent=2)
@@ -0,0 +1,235 @@
+"""
+Orchestration of several RS485 buses from one host.
+
+Every bus has its own USB-RS485 adapter and up to 16 nodes. Tracks are
+assigned to (bus, node) pairs, uploads run on all buses in parallel and
+playback control bytes are written to all adapters back to back, so the
+buses start and resume together.
+
+Sync works per bus as before: node 0 of every bus that has a track sends
+0x70 at each marker. The controller waits until every such bus reached
+the marker, waits `sync_waiting_time` and then releases all buses with
+0x80 at once.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable
+
+import host_serial as hs
+import metrics
+
+if TYPE_CHECKING:
+    import serial
+
+
+@dataclass(frozen=True)
+class Target:
+    """Destination of a track"""
+
+    bus: int
+    node: int
+
+    def __str__(self) -> str:
+        return f"{self.bus}:{self.node:X}"
+
+    @classmethod
+    def parse(cls, text: str) -> "Target":
+        """Parse `bus:node` with a hexadecimal node, e.g. `1:A`."""
+        bus, node = text.split(":")
+        target = cls(int(bus), int(node, 16))
+        if not 0 <= target.node <= 0x0F or target.bus < 0:
+            raise ValueError(f"Invalid target {text}")
+        return target
+
+
+def default_assignments(track_count: int, bus_count: int) -> dict[int, Target]:
+    """Fill bus 0 with tracks 0-F, bus 1 with tracks 10-1F and so on."""
+    return {i: Target(i // 16, i % 16) for i in range(min(track_count, 16 * bus_count))}
+
+
+class MultiBusController:
+    """Drive several buses as one ensemble.
+
+    Args:
+        buses (list[serial.Serial]): Opened ports, the list index is the bus number.
+    """
+
+    def __init__(self, buses: list[serial.Serial]):
+        self.buses = buses
+        self.sync_buses: set[int] = set()  # Buses whose node 0 holds a track
+        self.last_start_skew = 0.0  # Seconds between first and last 0x30
+        self.last_resume_skew = 0.0  # Seconds between first and last 0x80
+
+    def upload(
+        self, byte_list: list[bytes], assignments: dict[int, Target]
+    ) -> dict[int, bool]:
+        """Upload tracks to all buses in parallel, one thread per bus.
+
+        Args:
+            byte_list (list[bytes]): Packets of all tracks.
+            assignments (dict[int, Target]): Track index to target, tracks
+                missing here are skipped.
+
+        Returns:
+            dict[int, bool]: Whether each assigned track was acknowledged.
+        """
+        per_bus: dict[int, list[tuple[int, Target]]] = {}
+        for track_index, target in sorted(assignments.items()):
+            if target.bus >= len(self.buses):
+                raise ValueError(f"Track {track_index} assigned to missing bus")
+            per_bus.setdefault(target.bus, []).append((track_index, target))
+
+        results: dict[int, bool] = {}
+
+        def worker(bus: int, tracks: list[tuple[int, Target]]):
+            ser = self.buses[bus]
+            for track_index, target in tracks:
+                logging.info(f"Start transmitting track {track_index} to {target}...")
+                results[track_index] = hs.send_track_data(
+                    ser, target.node, byte_list[track_index]
+                )
+
+        threads = [
+            threading.Thread(target=worker, args=item, name=f"upload-bus{item[0]}")
+            for item in per_bus.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.sync_buses = {
+            t.bus for i, t in assignments.items() if t.node == 0 and results.get(i)
+        }
+        return results
+
+    def broadcast(self, command: int | bytes) -> float:
+        """Write a command to every bus with minimal skew.
+
+        All bytes are queued to the adapters first and flushed afterwards,
+        so the skew is a few system calls rather than a full flush per bus.
+
+        Returns:
+            float: Seconds between the first and the last write.
+        """
+        data = bytes([command]) if isinstance(command, int) else command
+        stamps = []
+        for ser in self.buses:
+            ser.write(data)
+            stamps.append(time.perf_counter())
+        for ser in self.buses:
+            ser.flush()
+        metrics.inc("stc_bytes_written_total", len(data) * len(self.buses))
+        logging.info(f"Command 0x{data.hex()} sent to {len(self.buses)} buses")
+        return stamps[-1] - stamps[0]
+
+    def start(self, start_marker: int = 0, loop_end: int = 0) -> float:
+        """Start playback on all buses. Returns the inter-bus skew.
+
+        Args:
+            start_marker (int): Sync marker to start after, see
+                `host_serial.start_command`. Defaults to 0, the beginning.
+            loop_end (int): Sync marker to loop back at. Defaults to 0, none.
+        """
+        command = hs.start_command(start_marker, loop_end)
+        self.last_start_skew = self.broadcast(command)
+        return self.last_start_skew
+
+    def modify(self, tempo: float = 1.0, transpose: int = 0) -> float:
+        """Change the tempo and key on all buses, see `host_serial.modifier_command`.
+
+        Returns:
+            float: Seconds between the first and the last write.
+        """
+        return self.broadcast(hs.modifier_command(tempo, transpose))
+
+    def stop(self):
+        """Stop playback on all buses (0x40)."""
+        self.broadcast(0x40)
+
+    def serve_sync_requests(
+        self,
+        sync_waiting_time: float | Callable[[int], float],
+        keep_running: Callable[[], bool],
+        *,
+        sync_timeout: float = 2.0,
+        poll_interval: float = 0.001,
+        sleep: Callable[[float], None] = time.sleep,
+        clock: Callable[[], float] = time.perf_counter,
+    ) -> bool:
+        """Answer sync requests of all buses until the music ends everywhere.
+
+        Args:
+            sync_waiting_time (float | Callable[[int], float]): Delay after the
+                last bus reached a marker, or a function of the index of the
+                marker returning it, e.g. `SyncTuner.wait`.
+            keep_running (Callable[[], bool]): Polled regularly, control returns
+                as soon as it reports False.
+            sync_timeout (float): Buses that have not reached a marker this long
+                after the first one are released anyway. Defaults to 2.0. A bus
+                reaching it later is released on its own at once.
+            poll_interval (float): Seconds between two polls of the buses.
+            sleep, clock: Time functions, replaceable for simulated buses.
+
+        Returns:
+            bool: True if node 0 of every sync bus reported the end of the music.
+        """
+        if not self.sync_buses:
+            logging.warning("No bus has a track on node 0, sync requests disabled")
+        waiting: dict[int, float] = {}  # Bus -> time its sync request arrived
+        requests = dict.fromkeys(self.sync_buses, 0)  # Bus -> markers reached
+        finished: set[int] = set()
+        marker = 0  # Markers released
+
+        while keep_running():
+            for bus in self.sync_buses - finished:
+                ser = self.buses[bus]
+                pending = ser.in_waiting
+                if not pending:
+                    continue
+                metrics.inc("stc_bytes_read_total", pending)
+                for dt in ser.read(pending):
+                    if dt == 0x70:
+                        metrics.inc("stc_sync_requests_total", bus=bus)
+                        requests[bus] += 1
+                        if requests[bus] <= marker:
+                            # Its node missed the release, it waits at a marker
+                            # the others have passed
+                            logging.warning(
+                                f"Bus {bus} reached sync point {requests[bus]} "
+                                f"late, releasing it alone"
+                            )
+                            hs.send_command(ser, bytes([0x80]))
+                        else:
+                            waiting[bus] = clock()
+                    elif dt == 0x20:
+                        finished.add(bus)
+
+            if finished >= self.sync_buses:
+                return bool(self.sync_buses)
+
+            active = self.sync_buses - finished
+            if waiting and (
+                active <= waiting.keys()
+                or clock() - min(waiting.values()) > sync_timeout
+            ):
+                late = active - waiting.keys()
+                if late:
+                    logging.warning(f"Buses {sorted(late)} missed a sync point")
+                first = min(waiting.values())
+                if callable(sync_waiting_time):
+                    sleep(sync_waiting_time(marker))
+                else:
+                    sleep(sync_waiting_time)
+                marker += 1
+                self.last_resume_skew = self.broadcast(0x80)
+                metrics.observe("stc_sync_turnaround_seconds", clock() - first)
+                waiting.clear()
+                continue
+            sleep(poll_interval)
+        return False
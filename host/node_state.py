@@ -0,0 +1,195 @@
+"""
+Model of what every node holds, to audition tracks without re-uploading them.
+
+Previewing a track (0x5_) needs the node to hold the unsynced variant of
+the track, it would wait at the first sync marker otherwise. Uploading it
+before every preview makes auditioning slow and keeps the bus busy.
+`NodeStateModel` knows the payload every node acknowledged from the
+`DeltaUploader` cache, names it by its hash as a track and variant of the
+loaded song, and uploads a node only when it holds something else. Solo
+and mute are then single command bytes (0x5_ and 0x6_) whose latency is
+measured like that of live notes.
+
+The model has the blind spots of `delta_upload.DeltaUploader`: forget
+the uploader's cache whenever a node may have changed behind its back.
+Nodes reaching the end of their track stop on their own and are still
+reported as playing until they are muted or stopped.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable
+
+import host_serial as hs
+import metrics
+from delta_upload import DeltaUploader, entries_of
+
+if TYPE_CHECKING:
+    import serial
+
+DIGEST_SIZE = 8  # Bytes of the payload hashes
+
+
+def payload_digest(entries: bytes) -> bytes:
+    """Hash of the entries of a track, see `delta_upload.entries_of`."""
+    return hashlib.blake2b(entries, digest_size=DIGEST_SIZE).digest()
+
+
+@dataclass(frozen=True)
+class NodeState:
+    """What a node holds as far as the host knows"""
+
+    digest: bytes  # Hash of the entries the node acknowledged
+    track: int | None  # Track of the loaded song it holds, None for other data
+    synced: bool  # Whether that is the variant with sync markers
+    playing: bool  # Started by the model and not stopped since
+
+
+@dataclass(frozen=True)
+class MixResult:
+    """Outcome of a solo, preview or mute"""
+
+    uploaded: list[int]  # Nodes that had to be uploaded first
+    upload_seconds: float
+    requested: float  # Clock time the action was requested
+    sent: float  # Clock time its commands had left the host
+
+    @property
+    def latency(self) -> float:
+        return self.sent - self.requested
+
+
+class NodeStateModel:
+    """Tracks the payload and playback of every node and solos or mutes them.
+
+    Calls are serialized, the model is safe to use from worker threads.
+
+    Args:
+        uploader (DeltaUploader): Cache of the acknowledged payloads, shared
+            with the regular uploads so both see the same node contents.
+        clock (Callable[[], float]): Time source of the latency readout.
+            Defaults to time.perf_counter.
+    """
+
+    def __init__(
+        self,
+        uploader: DeltaUploader,
+        *,
+        clock: Callable[[], float] = time.perf_counter,
+    ):
+        self.uploader = uploader
+        self.clock = clock
+        self.playing: set[int] = set()  # Nodes started by the model
+        self._variants: dict[bytes, tuple[int, bool]] = {}  # Digest -> track, synced
+        self._lock = threading.Lock()
+
+    def set_song(self, byte_list: list[bytes], unsynced_list: list[bytes]):
+        """Name the payloads of the loaded song in `state`."""
+        variants = {}
+        # Tracks without markers are the same in both, they count as unsynced
+        for synced, packets in ((False, unsynced_list), (True, byte_list)):
+            for track_index, packet in enumerate(packets):
+                digest = payload_digest(entries_of(packet))
+                variants.setdefault(digest, (track_index, synced))
+        self._variants = variants
+
+    def state(self, node_id: int) -> NodeState | None:
+        """What `node_id` holds, None if the host does not know."""
+        entries = self.uploader.acked.get(node_id)
+        if entries is None:
+            return None
+        digest = payload_digest(entries)
+        track_index, synced = self._variants.get(digest, (None, False))
+        return NodeState(digest, track_index, synced, node_id in self.playing)
+
+    def holds(self, node_id: int, packet: bytes) -> bool:
+        """Whether `node_id` holds the entries of a track data packet."""
+        entries = self.uploader.acked.get(node_id)
+        return entries is not None and payload_digest(entries) == payload_digest(
+            entries_of(packet)
+        )
+
+    def preview(
+        self, ser: serial.Serial, parts: dict[int, bytes], *, solo: bool = False
+    ) -> MixResult:
+        """Play tracks on their nodes from the beginning, all at once.
+
+        Nodes holding a different payload are uploaded first. The start
+        commands (0x5_) are written together, so the nodes start within a
+        few byte times of each other.
+
+        Args:
+            ser (serial.Serial): Serial port object.
+            parts (dict[int, bytes]): Node ID -> unsynced track data packet.
+            solo (bool): Stop all other playing nodes. Defaults to False.
+
+        Raises:
+            RuntimeError: If uploading a track fails.
+
+        Returns:
+            MixResult: Uploads and latency of the action.
+        """
+        requested = self.clock()
+        with self._lock:
+            stale = [n for n, packet in parts.items() if not self.holds(n, packet)]
+            # Playing nodes ignore uploads, and a solo silences the others
+            stop = {n for n in stale if n in self.playing}
+            if solo:
+                stop |= self.playing - parts.keys()
+            if stop:
+                self._send(ser, 0x60, sorted(stop))
+
+            upload_start = self.clock()
+            for node_id in stale:
+                if not self.uploader.send_track_data(ser, node_id, parts[node_id]):
+                    raise RuntimeError(f"Failed to send track to node {node_id:X}.")
+            upload_seconds = self.clock() - upload_start if stale else 0.0
+
+            self._send(ser, 0x50, sorted(parts))
+            result = MixResult(stale, upload_seconds, requested, self.clock())
+        self._record(result)
+        return result
+
+    def mute(self, ser: serial.Serial, node_ids) -> MixResult:
+        """Stop nodes (0x6_), the others keep playing."""
+        requested = self.clock()
+        with self._lock:
+            self._send(ser, 0x60, sorted(node_ids))
+            result = MixResult([], 0.0, requested, self.clock())
+        self._record(result)
+        return result
+
+    def stop_all(self, ser: serial.Serial) -> MixResult:
+        """Stop all nodes (0x40)."""
+        requested = self.clock()
+        with self._lock:
+            hs.send_command(ser, bytes([0x40]))
+            self.playing.clear()
+            result = MixResult([], 0.0, requested, self.clock())
+        self._record(result)
+        return result
+
+    def clear_playing(self):
+        """Forget which nodes play, e.g. after playback was started or stopped."""
+        with self._lock:
+            self.playing.clear()
+
+    def _send(self, ser: serial.Serial, event: int, node_ids: list[int]):
+        # One write, every node reacts as soon as its byte has arrived
+        hs.send_command(ser, bytes(event | n for n in node_ids))
+        if event == 0x50:
+            self.playing.update(node_ids)
+        else:
+            self.playing.difference_update(node_ids)
+
+    def _record(self, result: MixResult):
+        metrics.observe("stc_mixer_latency_seconds", result.latency)
+        logging.info(
+            f"Mixer command sent after {result.latency * 1000:.2f} ms, "
+            f"uploaded nodes {result.uploaded}"
+        )
@@ -1,12 +1,18 @@
 import logging
-from dataclasses import dataclass
-from typing import List, Tuple
+from dataclasses import dataclass, replace
+from typing import Callable, Iterator, List, Protocol, Tuple
 
-import mido
-from mido import MidiFile
+import metrics
+import profiling
 
 # Maximum duration in ms that can be represented in 2 bytes
 DURATION_MAX = (1 << 16) - 1
+ENTRY_SIZE = 3  # Note, duration high byte, duration low byte
+MAX_NOTES = 596  # Entries a node holds, same as firmware/inc/globals.h
+# Symbols in the note byte besides MIDI notes 0-127
+NOTE_MARKER = 253
+NOTE_END = 254
+NOTE_REST = 255
 
 
 @dataclass
@@ -14,26 +20,57 @@ class MidiConfig:
     """Configuration class for MIDI parsing"""
 
     enable_sync: bool = True
-    rest_symbol: int = 255
-    marker_symbol: int = 253
+    rest_symbol: int = NOTE_REST
+    marker_symbol: int = NOTE_MARKER
     default_tempo: int = 500000  # μs per beat
     min_rest_ms: int = 5  # rest under this will be ignored
 
 
+class ParseCancelled(Exception):
+    """Raised when parsing is cancelled through its `cancel` flag"""
+
+
+class CancelFlag(Protocol):
+    """Anything with `is_set()`, e.g. `threading.Event`"""
+
+    def is_set(self) -> bool: ...
+
+
+# Called after every MIDI track with (track index, track count, track events)
+TrackCallback = Callable[[int, int, List[Tuple[int, int, int]]], None]
+
+
+def _check_cancelled(cancel: CancelFlag | None):
+    if cancel is not None and cancel.is_set():
+        raise ParseCancelled()
+
+
 def parse_midi_to_events(
-    midi_file: str, config: MidiConfig
+    midi_file: str,
+    config: MidiConfig,
+    *,
+    on_track: TrackCallback | None = None,
+    cancel: CancelFlag | None = None,
 ) -> List[List[Tuple[int, int, int]]]:
     """
     Parse MIDIFile and return event list
 
     Args:
         config: MIDI configuration object
+        on_track: Progress callback, called after each MIDI track is walked with
+            the track's events before sync markers are merged
+        cancel: Checked between tracks, `ParseCancelled` is raised once it is set
 
     Returns:
         event_list: Event list for every track, in the format of [(start_time, note/rest_symbol, duration_ms), ...]
     """
+    # mido is imported on first use to keep the GUI start fast
+    from mido import MidiFile
+
     # Load Midi file
-    mid = MidiFile(midi_file)
+    _check_cancelled(cancel)
+    with profiling.span("mido decode"):
+        mid = MidiFile(midi_file)
     ticks_per_beat = mid.ticks_per_beat
     tempo = config.default_tempo
 
@@ -42,62 +79,103 @@ def parse_midi_to_events(
     marker_list = []
 
     # Extract events from each track
-    for track in mid.tracks:
-        abs_time = 0  # Current time in absolute ticks
-        last_note_time = 0  # Last time a note was released
-        # Event for the current track: (start_time, note/rest_symbol, duration_ms)
-        current_track_events: list[tuple[int, int, int]] = []
-        marker_time = None
-
-        for msg in track:
-            abs_time += msg.time
-            if marker_time and abs_time > marker_time:
-                if config.enable_sync:
-                    marker_list.append(marker_time)
-                marker_time = None
-            if msg.type == "set_tempo":
-                tempo = msg.tempo
-            elif msg.type == "note_on" and msg.velocity > 0:
-                note_stack[msg.note] = abs_time
-                rest_ticks = abs_time - last_note_time
-                rest_ms = int((rest_ticks * tempo) / (ticks_per_beat * 1000))
-                if rest_ms >= config.min_rest_ms:
-                    if rest_ms >= DURATION_MAX:
-                        rest_ms = DURATION_MAX
-                        logging.warning(
-                            f"Rest duration too long, clipped to {DURATION_MAX} ms"
-                        )
-                    current_track_events.append(
-                        (last_note_time, config.rest_symbol, rest_ms)
+    for track_index, track in enumerate(mid.tracks):
+        _check_cancelled(cancel)
+        with profiling.span(f"track {track_index}"):
+            current_track_events, tempo, markers = walk_track(
+                track, ticks_per_beat, tempo, note_stack, config
+            )
+            marker_list += markers
+            if len(current_track_events) > 0:
+                event_list.append(current_track_events)
+        if on_track is not None:
+            on_track(track_index, len(mid.tracks), current_track_events)
+
+    with profiling.span("marker merge"):
+        merge_markers(event_list, marker_list, config)
+    return event_list
+
+
+def walk_track(
+    track,
+    ticks_per_beat: int,
+    tempo: int,
+    note_stack: dict[int, int],
+    config: MidiConfig,
+) -> tuple[List[Tuple[int, int, int]], int, list[int]]:
+    """
+    Convert the messages of one MIDI track into events
+
+    Tracks are walked in file order and share their state: the tempo and the
+    notes still held at the end of a track carry over into the next one.
+
+    Args:
+        track: mido track, or any iterable of its messages
+        ticks_per_beat: Resolution of the MIDI file
+        tempo: Tempo in μs per beat at the start of the track
+        note_stack: Start tick of every held note, updated in place
+        config: MIDI configuration object
+
+    Returns:
+        tuple: Events of the track, tempo at its end and the ticks of its sync markers
+    """
+    abs_time = 0  # Current time in absolute ticks
+    last_note_time = 0  # Last time a note was released
+    # Event for the current track: (start_time, note/rest_symbol, duration_ms)
+    current_track_events: list[tuple[int, int, int]] = []
+    marker_list = []
+    marker_time = None
+
+    for msg in track:
+        abs_time += msg.time
+        if marker_time and abs_time > marker_time:
+            if config.enable_sync:
+                marker_list.append(marker_time)
+            marker_time = None
+        if msg.type == "set_tempo":
+            tempo = msg.tempo
+        elif msg.type == "note_on" and msg.velocity > 0:
+            note_stack[msg.note] = abs_time
+            rest_ticks = abs_time - last_note_time
+            rest_ms = int((rest_ticks * tempo) / (ticks_per_beat * 1000))
+            if rest_ms >= config.min_rest_ms:
+                if rest_ms >= DURATION_MAX:
+                    rest_ms = DURATION_MAX
+                    logging.warning(
+                        f"Rest duration too long, clipped to {DURATION_MAX} ms"
                     )
-            elif msg.type == "note_off" or (
-                msg.type == "note_on" and msg.velocity == 0
-            ):
-                if msg.note in note_stack:
-                    start_time = note_stack[msg.note]
-                    duration_ticks = abs_time - start_time
-                    duration_ms = int(
-                        (duration_ticks * tempo) / (ticks_per_beat * 1000)
+                current_track_events.append(
+                    (last_note_time, config.rest_symbol, rest_ms)
+                )
+        elif msg.type == "note_off" or (msg.type == "note_on" and msg.velocity == 0):
+            if msg.note in note_stack:
+                start_time = note_stack[msg.note]
+                duration_ticks = abs_time - start_time
+                duration_ms = int((duration_ticks * tempo) / (ticks_per_beat * 1000))
+                if duration_ms >= DURATION_MAX:
+                    duration_ms = DURATION_MAX
+                    logging.warning(
+                        f"Note duration too long, clipped to {DURATION_MAX} ms"
                     )
-                    if duration_ms >= DURATION_MAX:
-                        duration_ms = DURATION_MAX
-                        logging.warning(
-                            f"Note duration too long, clipped to {DURATION_MAX} ms"
-                        )
-                    current_track_events.append((start_time, msg.note, duration_ms))
-                    del note_stack[msg.note]
-                    last_note_time = abs_time
-            elif msg.type == "marker":
-                marker_time = abs_time
-
-        if len(current_track_events) > 0:
-            event_list.append(current_track_events)
+                current_track_events.append((start_time, msg.note, duration_ms))
+                del note_stack[msg.note]
+                last_note_time = abs_time
+        elif msg.type == "marker":
+            marker_time = abs_time
+
+    return current_track_events, tempo, marker_list
+
 
+def merge_markers(
+    event_list: List[List[Tuple[int, int, int]]],
+    marker_list: list[int],
+    config: MidiConfig,
+):
+    """Add the sync markers of all tracks to every track, in place"""
     for track in event_list:
         for marker_time in marker_list:
             track.append((marker_time, config.marker_symbol, 0))
         track.sort(key=lambda event: (event[0], event[1] != config.marker_symbol))
-    return event_list
 
 
 def events_to_binary(track: List[Tuple[int, int, int]]) -> bytes:
@@ -122,12 +200,63 @@ def events_to_binary(track: List[Tuple[int, int, int]]) -> bytes:
     return ret
 
 
+def iter_entries(packet: bytes) -> Iterator[tuple[int, int]]:
+    """Note and duration in ms of every entry of a track data packet."""
+    data = packet[3:-1]
+    for pos in range(0, len(data) - ENTRY_SIZE + 1, ENTRY_SIZE):
+        yield data[pos], data[pos + 1] << 8 | data[pos + 2]
+
+
 def midi_to_binary_list(midi_file: str, config: MidiConfig) -> list[bytes]:
-    event_list = parse_midi_to_events(midi_file, config)
-    binary_list = [events_to_binary(track) for track in event_list]
+    with metrics.timer("stc_parse_seconds"), profiling.span("parse"):
+        event_list = parse_midi_to_events(midi_file, config)
+    with metrics.timer("stc_encode_seconds"), profiling.span("encode"):
+        binary_list = []
+        for track_index, track in enumerate(event_list):
+            with profiling.span(f"track {track_index}"):
+                binary_list.append(events_to_binary(track))
     return binary_list
 
 
+def midi_to_binary_lists(
+    midi_file: str,
+    config: MidiConfig,
+    *,
+    on_track: TrackCallback | None = None,
+    cancel: CancelFlag | None = None,
+) -> tuple[list[bytes], list[bytes]]:
+    """Convert a MIDI file into synced and unsynced packets with a single parse.
+
+    The unsynced variant equals the result of `midi_to_binary_list` with
+    `enable_sync=False`: sync markers are the only difference between both.
+
+    Args:
+        midi_file (str): Path of the MIDI file.
+        config (MidiConfig): Configuration, `enable_sync` is ignored.
+        on_track: See `parse_midi_to_events`.
+        cancel: See `parse_midi_to_events`. Also checked between encoded tracks.
+
+    Returns:
+        tuple[list[bytes], list[bytes]]: Synced and unsynced packets per track.
+    """
+    synced_config = replace(config, enable_sync=True)
+    with metrics.timer("stc_parse_seconds"), profiling.span("parse"):
+        event_list = parse_midi_to_events(
+            midi_file, synced_config, on_track=on_track, cancel=cancel
+        )
+    synced_list = []
+    unsynced_list = []
+    with metrics.timer("stc_encode_seconds"), profiling.span("encode"):
+        for track_index, track in enumerate(event_list):
+            _check_cancelled(cancel)
+            with profiling.span(f"track {track_index}"):
+                synced_list.append(events_to_binary(track))
+                unsynced_list.append(
+                    events_to_binary([e for e in track if e[1] != config.marker_symbol])
+                )
+    return synced_list, unsynced_list
+
+
 def events_to_c_arrays(event_list: List[List[Tuple[int, int, int]]]) -> Tuple[str, str]:
     """
     Convert event list to C-style arrays for notes and durations
@@ -202,11 +331,48 @@ def events_to_c_arrays(event_list: List[List[Tuple[int, int, int]]]) -> Tuple[st
 
 
 if __name__ == "__main__":
-    config = MidiConfig()
-    event_list = parse_midi_to_events("music/overworld.mid", config)
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Convert a MIDI file into C arrays for the built-in music."
+    )
+    parser.add_argument("midi_file", nargs="?", default="music/overworld.mid")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print a per-stage timing table to stderr",
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        action="store_true",
+        help="also record memory allocations with tracemalloc (implies --profile)",
+    )
+    parser.add_argument(
+        "--flamegraph",
+        metavar="PATH",
+        help="write collapsed stacks for flamegraph.pl/speedscope (implies --profile)",
+    )
+    args = parser.parse_args()
 
-    # Generate C-style arrays
-    notes_array, durations_array = events_to_c_arrays(event_list)
+    config = MidiConfig()
+    if args.profile or args.trace_allocations or args.flamegraph:
+        with profiling.profile(args.trace_allocations) as profiler:
+            with profiling.span("parse"):
+                event_list = parse_midi_to_events(args.midi_file, config)
+            with profiling.span("encode"):
+                for track_index, track in enumerate(event_list):
+                    with profiling.span(f"track {track_index}"):
+                        events_to_binary(track)
+            with profiling.span("c arrays"):
+                notes_array, durations_array = events_to_c_arrays(event_list)
+        print(profiler.summary_table(), file=sys.stderr)
+        if args.flamegraph:
+            profiler.write_collapsed(args.flamegraph)
+    else:
+        event_list = parse_midi_to_events(args.midi_file, config)
+        # Generate C-style arrays
+        notes_array, durations_array = events_to_c_arrays(event_list)
 
     print("// Notes array (replace content after // SONG 1):")
     print("{")
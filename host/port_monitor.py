@@ -0,0 +1,238 @@
+"""
+Background serial port discovery and hot-plug handling.
+
+`serial.tools.list_ports.comports()` can take seconds with many USB-serial
+devices attached, and opening a port can block as well. `PortMonitor`
+does both on its own threads: it keeps a cached port list, rescans it on
+a timer (or on udev events when `pyudev` is installed on Linux), reports
+changes through a callback and reopens the tracked adapter when it is
+plugged back in.
+
+Callbacks run on the monitor's threads. GUI code should hand them over to
+its own thread, e.g. with `root.after(0, ...)`.
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+import host_serial as hs
+
+
+@dataclass(frozen=True)
+class PortInfo:
+    """Cached description of a serial port"""
+
+    device: str
+    description: str
+    vid: int | None = None
+    pid: int | None = None
+    serial_number: str | None = None
+    location: str | None = None
+
+    @property
+    def identity(self) -> tuple:
+        """Key that stays the same when the adapter is plugged in again.
+
+        USB adapters may come back under another device name (e.g. ttyUSB1
+        instead of ttyUSB0), so they are matched by their USB attributes.
+        """
+        if self.vid is not None:
+            return (self.vid, self.pid, self.serial_number or self.location)
+        return (self.device,)
+
+    @property
+    def label(self) -> str:
+        """Text shown in port selection, same as `host_serial.get_serial_ports`"""
+        if self.description and self.description != "n/a":
+            return f"{self.device} - {self.description}"
+        return self.device
+
+
+def scan_ports() -> list[PortInfo]:
+    """Enumerate serial ports. This call may block for a long time."""
+    import serial.tools.list_ports
+
+    return [
+        PortInfo(
+            device=port.device,
+            description=port.description,
+            vid=port.vid,
+            pid=port.pid,
+            serial_number=port.serial_number,
+            location=port.location,
+        )
+        for port in serial.tools.list_ports.comports()
+    ]
+
+
+OpenCallback = Callable[[object | None, Exception | None], None]
+
+
+class PortMonitor:
+    """Watch serial ports in the background.
+
+    Args:
+        on_change: Called with the new port list whenever it changes,
+            including after the first scan.
+        interval (float): Seconds between two polls. Defaults to 1.0.
+        scan: Port enumeration function, replaceable for tests.
+    """
+
+    def __init__(
+        self,
+        on_change: Callable[[list[PortInfo]], None],
+        interval: float = 1.0,
+        scan: Callable[[], list[PortInfo]] = scan_ports,
+    ):
+        self.on_change = on_change
+        self.interval = interval
+        self.scan = scan
+        self.ports: list[PortInfo] = []
+        self.scanned = threading.Event()  # Set after the first scan
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._udev_observer = None
+
+        # Adapter to reopen when it comes back
+        self._tracked: PortInfo | None = None
+        self._tracked_present = False
+        self._reconnect: Callable[[PortInfo], None] | None = None
+        self._lost: Callable[[PortInfo], None] | None = None
+
+    def start(self):
+        """Start monitoring. The first scan runs right away in the background."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="port-monitor", daemon=True
+        )
+        self._thread.start()
+        self._start_udev()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._udev_observer is not None:
+            self._udev_observer.stop()
+
+    def refresh(self):
+        """Request an immediate rescan without waiting for it."""
+        self._wakeup.set()
+
+    def _start_udev(self):
+        """Rescan on tty hot-plug events instead of waiting for the next poll."""
+        try:
+            import pyudev
+        except ImportError:
+            return
+        try:
+            context = pyudev.Context()
+            udev_monitor = pyudev.Monitor.from_netlink(context)
+            udev_monitor.filter_by(subsystem="tty")
+            self._udev_observer = pyudev.MonitorObserver(
+                udev_monitor, callback=lambda device: self.refresh()
+            )
+            self._udev_observer.start()
+            logging.debug("Port monitor listening to udev events")
+        except Exception as e:
+            logging.debug(f"udev monitoring unavailable: {e}")
+            self._udev_observer = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                ports = self.scan()
+            except Exception as e:
+                logging.error(f"Error scanning serial ports: {e}")
+                ports = self.ports
+            self._update(ports)
+            self.scanned.set()
+            # Polling stays on as a fallback when udev is in use, just slower
+            interval = self.interval * (5 if self._udev_observer else 1)
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+
+    def _update(self, ports: list[PortInfo]):
+        with self._lock:
+            changed = ports != self.ports or not self.scanned.is_set()
+            self.ports = ports
+            tracked = self._tracked
+        if changed:
+            self.on_change(list(ports))
+        if tracked is None:
+            return
+
+        match = next((p for p in ports if p.identity == tracked.identity), None)
+        if match is None and self._tracked_present:
+            self._tracked_present = False
+            logging.warning(f"Serial adapter {tracked.device} unplugged")
+            if self._lost is not None:
+                self._lost(tracked)
+        elif match is not None and not self._tracked_present:
+            self._tracked_present = True
+            self._tracked = match
+            logging.info(f"Serial adapter is back as {match.device}")
+            if self._reconnect is not None:
+                self._reconnect(match)
+
+    def find(self, device: str) -> PortInfo | None:
+        with self._lock:
+            return next((p for p in self.ports if p.device == device), None)
+
+    def track(
+        self,
+        device: str | None,
+        on_lost: Callable[[PortInfo], None] | None = None,
+        on_reconnect: Callable[[PortInfo], None] | None = None,
+    ):
+        """Follow the adapter behind `device`, or stop following with None.
+
+        Args:
+            device (str | None): Device name of the port in use.
+            on_lost: Called when the adapter disappears.
+            on_reconnect: Called with the new port info when it comes back.
+        """
+        info = self.find(device) if device else None
+        with self._lock:
+            self._tracked = info
+            self._tracked_present = info is not None
+            self._lost = on_lost
+            self._reconnect = on_reconnect
+
+    def open_async(
+        self,
+        device: str,
+        baudrate: int,
+        on_done: OpenCallback,
+        *,
+        close: object | None = None,
+        settle: float = 0.0,
+    ):
+        """Open a port on a worker thread.
+
+        Args:
+            device (str): Port to open.
+            baudrate (int): Baud rate of the connection.
+            on_done: Called with (serial object, None) or (None, exception).
+            close: Serial object to close first, e.g. when reconnecting.
+            settle (float): Seconds to wait between closing and opening.
+        """
+
+        def worker():
+            try:
+                if close is not None:
+                    close.close()
+                    time.sleep(settle)
+                ser = hs.open_serial_port(device, baudrate)
+            except Exception as e:
+                logging.error(f"Error opening {device}: {e}")
+                on_done(None, e)
+            else:
+                on_done(ser, None)
+
+        threading.Thread(target=worker, name=f"open-{device}", daemon=True).start()
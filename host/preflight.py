@@ -0,0 +1,105 @@
+"""
+Checks and estimates of an upload, computed before a single byte is sent.
+
+For every track and its assigned node, `analyze` reports the number of
+entries against the node's capacity, the bytes on the wire, the expected
+transfer time at a baud rate, the playing time and the number of sync
+points. Tracks that would be answered with a size error (0xF1) can be
+rejected and slow uploads announced up front.
+"""
+
+from dataclasses import dataclass
+
+import host_serial as hs
+from delta_upload import TURNAROUND
+from parse_midi import ENTRY_SIZE, MAX_NOTES, NOTE_MARKER, NOTE_REST, iter_entries
+
+# Uploads taking longer than this many seconds ask for confirmation
+SLOW_UPLOAD_SECONDS = 10.0
+
+
+@dataclass(frozen=True)
+class TrackPreflight:
+    """Preflight result of one track"""
+
+    track_index: int
+    node: str  # Node ID in hex, or "不分配"
+    entries: int  # Notes, rests, markers and the end symbol
+    wire_bytes: int
+    upload_seconds: float  # Bytes on the wire plus the response turnaround
+    play_seconds: float
+    sync_points: int
+
+    @property
+    def assigned(self) -> bool:
+        return self.node != "不分配"
+
+    @property
+    def fits(self) -> bool:
+        """False if the node would reject the track with a size error"""
+        return self.entries <= MAX_NOTES
+
+
+def analyze_track(
+    track_index: int, packet: bytes, node: str, baudrate: int = hs.BAUDRATE
+) -> TrackPreflight:
+    """Compute the preflight result of a single track data packet."""
+    play_ms = 0
+    sync_points = 0
+    for note, duration in iter_entries(packet):
+        if note <= 127 or note == NOTE_REST:
+            play_ms += duration
+        elif note == NOTE_MARKER:
+            sync_points += 1
+
+    # 10 bits per byte on the wire, plus the one-byte response
+    byte_time = 10 / baudrate
+    return TrackPreflight(
+        track_index=track_index,
+        node=node,
+        entries=len(packet[3:-1]) // ENTRY_SIZE,
+        wire_bytes=len(packet),
+        upload_seconds=(len(packet) + 1) * byte_time + TURNAROUND,
+        play_seconds=play_ms / 1000,
+        sync_points=sync_points,
+    )
+
+
+def analyze(
+    byte_list: list[bytes],
+    track_assignments: dict[int, str],
+    baudrate: int = hs.BAUDRATE,
+) -> list[TrackPreflight]:
+    """Compute the preflight results of all tracks.
+
+    Args:
+        byte_list (list[bytes]): List of byte data for each track.
+        track_assignments (dict[int, str]): Mapping of track index to node ID,
+            as for `host_serial.send_music_data`.
+        baudrate (int): Baud rate of the bus. Defaults to BAUDRATE.
+
+    Returns:
+        list[TrackPreflight]: One result per track, in track order.
+    """
+    return [
+        analyze_track(
+            i,
+            packet,
+            track_assignments.get(i, hex(i).upper()[2:]),
+            baudrate,
+        )
+        for i, packet in enumerate(byte_list)
+    ]
+
+
+def upload_eta(reports: list[TrackPreflight]) -> float:
+    """Seconds to upload every assigned track one after another.
+
+    Bulk and multicast uploads are usually faster, so this is an upper bound.
+    """
+    return sum(r.upload_seconds for r in reports if r.assigned)
+
+
+def oversized(reports: list[TrackPreflight]) -> list[TrackPreflight]:
+    """Assigned tracks the nodes would reject with a size error."""
+    return [r for r in reports if r.assigned and not r.fits]
@@ -0,0 +1,264 @@
+"""
+Offline audio preview of encoded tracks.
+
+Decodes the track data packets sent to the nodes and renders the buzzer
+of every node as the square wave its timer produces, so an arrangement
+can be checked without uploading it. Sync pauses follow the bus: node 0
+stops at every marker, the host answers after `sync_waiting_time` and
+every node waiting at a marker resumes.
+
+Rendering needs NumPy, playing the result also needs sounddevice (both in
+the `preview` extra):
+
+    python preview_audio.py song.mid [-o song.wav] [--play] [--sync-wait 0.1]
+"""
+
+import argparse
+import bisect
+import logging
+import time
+import wave
+from dataclasses import dataclass
+
+import parse_midi as pm
+from generate_timer import square_wave_frequency, timer_values
+
+SAMPLE_RATE = 44100
+VOLUME = 0.5  # Peak of the mix, leaves headroom for the WAV encoder
+
+# Buzzer frequency of every MIDI note, as produced by th0_table/tl0_table
+NOTE_FREQUENCIES = [square_wave_frequency(*timer_values(n)) for n in range(128)]
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError(
+            "Audio preview needs NumPy, install it with `pip install numpy`"
+        ) from None
+    return numpy
+
+
+@dataclass(frozen=True)
+class Tone:
+    """A note played by one node, in seconds from the start of playback"""
+
+    start: float
+    end: float
+    frequency: float
+
+
+def decode_packet(packet: bytes) -> list[tuple[int, int]]:
+    """Decode a track data packet into (note, duration in ms) entries.
+
+    Entries after the end symbol are never played and left out.
+    """
+    entries = []
+    for note, duration in pm.iter_entries(packet):
+        entries.append((note, duration))
+        if note == pm.NOTE_END:
+            break
+    return entries
+
+
+def _play_until_marker(entries, index, t, tones):
+    """Play entries from `index` on like `play_music_note` in a loop.
+
+    Returns:
+        tuple[int | None, float]: Index of the marker the node stops at
+            (None at the end of the music) and the time it gets there.
+    """
+    while index < len(entries):
+        note, duration = entries[index]
+        if note <= 127:
+            tones.append(Tone(t, t + duration / 1000, NOTE_FREQUENCIES[note]))
+            t += duration / 1000
+        elif note == pm.NOTE_REST:
+            t += duration / 1000
+        elif note == pm.NOTE_MARKER:
+            return index, t
+        elif note == pm.NOTE_END:
+            return None, t
+        else:
+            # The firmware never advances past unknown symbols
+            logging.warning(f"Unknown symbol {note} stops playback")
+            return None, t
+        index += 1
+    return None, t
+
+
+def schedule(
+    tracks: dict[int, list[tuple[int, int]]], sync_waiting_time: float
+) -> dict[int, list[Tone]]:
+    """Compute when every node plays which tone.
+
+    Args:
+        tracks (dict[int, list[tuple[int, int]]]): Decoded entries per node ID.
+        sync_waiting_time (float): Delay of the host's reply to a sync request.
+
+    Returns:
+        dict[int, list[Tone]]: Tones per node ID.
+    """
+    # Times at which the host sends 0x80, driven by the sync requests of node 0
+    releases: list[float] = []
+    tones: dict[int, list[Tone]] = {node_id: [] for node_id in tracks}
+    if 0 in tracks:
+        index, t = 0, 0.0
+        while True:
+            index, t = _play_until_marker(tracks[0], index, t, tones[0])
+            if index is None:
+                break
+            t += sync_waiting_time
+            releases.append(t)
+            index += 1
+
+    for node_id, entries in tracks.items():
+        if node_id == 0:
+            continue
+        index, t = 0, 0.0
+        while True:
+            index, t = _play_until_marker(entries, index, t, tones[node_id])
+            if index is None:
+                break
+            # Resume on the first 0x80 sent after reaching the marker
+            release = bisect.bisect_left(releases, t)
+            if release == len(releases):
+                logging.warning(f"Node {node_id:X} waits for a sync that never comes")
+                break
+            t = releases[release]
+            index += 1
+    return tones
+
+
+def render(tones: dict[int, list[Tone]], sample_rate: int = SAMPLE_RATE):
+    """Mix the square waves of all nodes.
+
+    Returns:
+        numpy.ndarray: Mono float32 samples in [-VOLUME, VOLUME].
+    """
+    np = _numpy()
+    end = max((tone.end for node in tones.values() for tone in node), default=0.0)
+    mix = np.zeros(int(np.ceil(end * sample_rate)) + 1, dtype=np.float32)
+
+    for node in tones.values():
+        # Tones above the Nyquist frequency (e.g. the timer's rest value)
+        # would only alias, the buzzer is silent for them anyway
+        node = [t for t in node if t.frequency < sample_rate / 2]
+        if not node:
+            continue
+        starts = np.rint([t.start * sample_rate for t in node]).astype(np.int64)
+        ends = np.rint([t.end * sample_rate for t in node]).astype(np.int64)
+        frequencies = np.array([t.frequency for t in node])
+        lengths = np.maximum(ends - starts, 0)
+
+        # Sample offset within its tone for every sample of every tone
+        offsets = np.arange(lengths.sum()) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        positions = np.repeat(starts, lengths) + offsets
+        # The buzzer starts low and toggles every half period
+        half_periods = offsets * (2 * np.repeat(frequencies, lengths) / sample_rate)
+        mix[positions] += (half_periods.astype(np.int64) & 1) * 2.0 - 1.0
+
+    if tones:
+        mix *= VOLUME / len(tones)
+    return mix
+
+
+def write_wav(path: str, samples, sample_rate: int = SAMPLE_RATE):
+    """Save mono float samples as a 16-bit WAV file."""
+    np = _numpy()
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+
+
+def play(samples, sample_rate: int = SAMPLE_RATE):
+    """Play mono float samples on the default audio device."""
+    try:
+        import sounddevice
+    except ImportError:
+        raise RuntimeError(
+            "Playing the preview needs sounddevice, install it with "
+            "`pip install sounddevice` or write a WAV file instead"
+        ) from None
+    sounddevice.play(samples, sample_rate)
+    sounddevice.wait()
+
+
+def preview(
+    byte_list: list[bytes],
+    track_assignments: dict[int, str],
+    sync_waiting_time: float = 0.1,
+    sample_rate: int = SAMPLE_RATE,
+):
+    """Render the tracks as the nodes they are assigned to would play them.
+
+    Args:
+        byte_list (list[bytes]): List of byte data for each track.
+        track_assignments (dict[int, str]): Mapping of track index to node ID,
+            as for `host_serial.send_music_data`.
+        sync_waiting_time (float): Delay of the reply to a sync request.
+        sample_rate (int): Sample rate of the result. Defaults to SAMPLE_RATE.
+
+    Returns:
+        numpy.ndarray: Mono float32 samples.
+    """
+    tracks = {}
+    for track_index, packet in enumerate(byte_list):
+        node_id = track_assignments.get(track_index, hex(track_index).upper()[2:])
+        if node_id != "不分配":
+            # A later upload to the same node replaces the earlier one
+            tracks[int(node_id, 16)] = decode_packet(packet)
+    return render(schedule(tracks, sync_waiting_time), sample_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render an audio preview")
+    parser.add_argument("midi_file")
+    parser.add_argument("-o", "--output", help="WAV file, defaults to <midi>.wav")
+    parser.add_argument("--play", action="store_true", help="play instead of saving")
+    parser.add_argument("--no-sync", action="store_true", help="ignore sync markers")
+    parser.add_argument("--sync-wait", type=float, default=0.1, metavar="SECONDS")
+    parser.add_argument("--sample-rate", type=int, default=SAMPLE_RATE)
+    parser.add_argument(
+        "--assign",
+        action="append",
+        default=[],
+        metavar="TRACK=NODE",
+        help="hexadecimal track and node, e.g. 3=7, or 3=不分配",
+    )
+    args = parser.parse_args()
+
+    byte_list = pm.midi_to_binary_list(
+        args.midi_file, pm.MidiConfig(enable_sync=not args.no_sync)
+    )
+    # Like the GUI, tracks beyond F are unassigned unless stated otherwise
+    assignments = {i: "不分配" for i in range(16, len(byte_list))}
+    for item in args.assign:
+        track, node = item.split("=")
+        assignments[int(track, 16)] = node.upper() if node != "不分配" else node
+
+    start = time.perf_counter()
+    samples = preview(byte_list, assignments, args.sync_wait, args.sample_rate)
+    elapsed = time.perf_counter() - start
+    duration = len(samples) / args.sample_rate
+    print(
+        f"rendered {duration:.1f} s in {elapsed:.2f} s "
+        f"({duration / max(elapsed, 1e-9):.0f}x real time)"
+    )
+
+    if args.play:
+        play(samples, args.sample_rate)
+    else:
+        output = args.output or args.midi_file.rsplit(".", 1)[0] + ".wav"
+        write_wav(output, samples, args.sample_rate)
+        print(f"saved {output}")
+
+
+if __name__ == "__main__":
+    main()
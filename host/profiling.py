@@ -0,0 +1,180 @@
+"""
+Opt-in stage profiler for the MIDI conversion pipeline.
+
+Wrap a region in `profile()` to collect `perf_counter_ns` spans. Code
+under test marks its stages with `span(name)`; spans nest, so a stage
+opened inside another one is recorded under the outer stage's path.
+While no profiler is active, `span()` returns a shared no-op context.
+
+Example:
+    with profiling.profile(trace_allocations=True) as prof:
+        pm.midi_to_binary_list("song.mid", pm.MidiConfig())
+    print(prof.summary_table())
+    prof.write_collapsed("song.folded")  # input for flamegraph.pl / speedscope
+"""
+
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Iterator
+
+_NULL_SPAN = nullcontext()
+_active: "Profiler | None" = None
+
+
+@dataclass
+class Span:
+    """A finished span"""
+
+    path: tuple[str, ...]  # Names from the outermost span to this one
+    start_ns: int
+    duration_ns: int
+    alloc_blocks: int = 0  # Net number of allocated memory blocks
+    alloc_bytes: int = 0  # Net traced memory, only with trace_allocations
+    peak_bytes: int = 0  # Traced memory peak above the start level
+
+
+@dataclass
+class _Frame:
+    name: str
+    start_ns: int
+    start_blocks: int
+    start_traced: int = 0
+    peak_seen: int = 0
+    child_ns: int = 0
+
+
+@dataclass
+class Profiler:
+    """Collector of nested spans"""
+
+    trace_allocations: bool = False
+    spans: list[Span] = field(default_factory=list)
+    _stack: list[_Frame] = field(default_factory=list, repr=False)
+    # Exclusive time of every path, used for flame graphs
+    _self_ns: dict[tuple[str, ...], int] = field(default_factory=dict, repr=False)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        if self.trace_allocations:
+            traced, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                parent = self._stack[-1]
+                parent.peak_seen = max(parent.peak_seen, peak)
+            tracemalloc.reset_peak()
+        else:
+            traced = 0
+        frame = _Frame(name, time.perf_counter_ns(), sys.getallocatedblocks(), traced)
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            end_ns = time.perf_counter_ns()
+            self._stack.pop()
+            record = Span(
+                path=tuple(f.name for f in self._stack) + (name,),
+                start_ns=frame.start_ns,
+                duration_ns=end_ns - frame.start_ns,
+                alloc_blocks=sys.getallocatedblocks() - frame.start_blocks,
+            )
+            if self.trace_allocations:
+                traced, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, frame.peak_seen)
+                record.alloc_bytes = traced - frame.start_traced
+                record.peak_bytes = peak - frame.start_traced
+                if self._stack:
+                    parent = self._stack[-1]
+                    parent.peak_seen = max(parent.peak_seen, peak)
+            if self._stack:
+                self._stack[-1].child_ns += record.duration_ns
+            self.spans.append(record)
+            self._self_ns[record.path] = (
+                self._self_ns.get(record.path, 0) + record.duration_ns - frame.child_ns
+            )
+
+    def summary_table(self, *, collapse_tracks: bool = False) -> str:
+        """Format a per-stage summary table.
+
+        Args:
+            collapse_tracks (bool): Merge `track N` spans into a single `track *`
+                row per stage. Defaults to False.
+        """
+        rows: dict[tuple[str, ...], list[int]] = {}
+        for s in sorted(self.spans, key=lambda s: s.start_ns):
+            path = s.path
+            if collapse_tracks:
+                path = tuple("track *" if p.startswith("track ") else p for p in path)
+            row = rows.setdefault(path, [0, 0, 0, 0, 0])
+            row[0] += 1
+            row[1] += s.duration_ns
+            row[2] += s.alloc_blocks
+            row[3] += s.alloc_bytes
+            row[4] = max(row[4], s.peak_bytes)
+
+        root_ns = sum(r[1] for p, r in rows.items() if len(p) == 1) or 1
+        header = f"{'stage':<40} {'calls':>6} {'total ms':>10} {'%':>6} {'blocks':>9}"
+        if self.trace_allocations:
+            header += f" {'alloc KiB':>10} {'peak KiB':>10}"
+        lines = [header, "-" * len(header)]
+        for path, (calls, total_ns, blocks, alloc, peak) in rows.items():
+            label = "  " * (len(path) - 1) + path[-1]
+            line = (
+                f"{label:<40.40} {calls:>6} {total_ns / 1e6:>10.3f} "
+                f"{100 * total_ns / root_ns:>6.1f} {blocks:>9}"
+            )
+            if self.trace_allocations:
+                line += f" {alloc / 1024:>10.1f} {peak / 1024:>10.1f}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def collapsed_stacks(self) -> str:
+        """Format spans as collapsed stacks (`a;b;c <self ns>` per line).
+
+        The output can be fed to flamegraph.pl, inferno or speedscope.
+        """
+        return (
+            "\n".join(
+                f"{';'.join(path)} {ns}" for path, ns in self._self_ns.items() if ns > 0
+            )
+            + "\n"
+        )
+
+    def write_collapsed(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.collapsed_stacks())
+
+
+def span(name: str):
+    """Mark a stage of the active profiler, or do nothing if profiling is off."""
+    if _active is None:
+        return _NULL_SPAN
+    return _active.span(name)
+
+
+def is_active() -> bool:
+    return _active is not None
+
+
+@contextmanager
+def profile(trace_allocations: bool = False) -> Iterator[Profiler]:
+    """Activate a profiler for the duration of the block.
+
+    Args:
+        trace_allocations (bool): Also record traced memory with `tracemalloc`.
+            This slows the profiled code down noticeably. Defaults to False.
+    """
+    global _active
+    previous = _active
+    profiler = Profiler(trace_allocations=trace_allocations)
+    started_tracing = trace_allocations and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _active = profiler
+    try:
+        yield profiler
+    finally:
+        _active = previous
+        if started_tracing:
+            tracemalloc.stop()
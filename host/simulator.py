@@ -0,0 +1,639 @@
+"""
+Software model of an RS485 bus populated with STC-Choir nodes.
+
+`SimulatedSerial` implements the subset of the `serial.Serial` interface
+used by `host_serial`, so the real host code can drive simulated nodes.
+Nothing sleeps: the bus runs on a virtual clock that advances by the
+wire time of every byte (10 bits per byte at the configured baud rate),
+the nodes' response delay and read timeouts. `SimulatedSerial.now`
+therefore tells how long an exchange would take on real hardware.
+
+`SimulatedNode` mirrors the receive state machine of `firmware/src/core.c`
+and the playback loop of `firmware/src/music.c`. `Faults` injects errors
+on the wire, see `soak.py`.
+"""
+
+import heapq
+import math
+import random
+from dataclasses import dataclass, field
+
+from parse_midi import MAX_NOTES, NOTE_END, NOTE_MARKER, NOTE_REST
+
+TEMPO_UNIT = 64  # Tempo scale of the original tempo, same as globals.h
+
+# Time from the last received byte to the start of a node's response, in
+# seconds. Responses are sent from the firmware main loop, not the ISR.
+RESPONSE_DELAY = 0.0002
+# Source of queued bytes that reach the host after the adapter latency
+_TO_HOST = -1
+# Spacing of the responses to a multicast upload, ACK_SLOT_MS in globals.h
+ACK_SLOT = 0.002
+
+
+@dataclass(frozen=True)
+class Faults:
+    """Errors injected on the simulated wire"""
+
+    bit_error_rate: float = 0.0  # Probability of every data bit being flipped
+    drop_rate: float = 0.0  # Probability of a byte getting lost, e.g. framing
+    ack_loss_rate: float = 0.0  # Probability of a node's response being lost
+    jitter: float = 0.0  # Extra delay of a node's response, up to this many s
+    seed: int | None = None  # Seed of the random generator, for reproducible runs
+
+
+@dataclass
+class SimulatedNode:
+    """State of one node, following the firmware's global variables"""
+
+    node_id: int
+    clock_error_ppm: float = 0.0  # Positive values make playback slower
+    note: list[int] = field(default_factory=lambda: [NOTE_END] * MAX_NOTES)
+    duration: list[int] = field(default_factory=lambda: [0] * MAX_NOTES)
+
+    # UART receive state
+    event: int = 0
+    param: int = 0
+    size: int = 0
+    size_h: bool = False
+    size_l: bool = False
+    uart_pos: int = 0
+    note_pos: int = 0
+    checksum: int = 0
+    data_ready: bool = False
+    upload_target: bool = False
+    mask_pos: int = 0
+    node_mask: int = 0
+    response_slot: int = 0  # Responses are delayed by this many ACK_SLOTs
+    offset_pos: int = 0
+    note_offset: int = 0  # First entry written by the music data
+    bulk_count: int = 0
+    bulk_table_pos: int = 0
+    bulk_node: int = 0
+    bulk_size: int = 0
+    bulk_start: int = 0  # Position of the segment of this node
+    bulk_end: int = 0  # Total size of all segments
+    bulk_pos: int = 0
+    bulk_responses: list[int] = field(default_factory=list)
+
+    # Playback state
+    is_playing: bool = False
+    is_waiting_for_sync: bool = False
+    pos: int = 0
+    event_start: float = 0.0  # Virtual time the entry at `pos` started
+    pending_responses: list[int] = field(default_factory=list)
+    # (marker reached, playback resumed) times of every sync, for analysis
+    sync_log: list[tuple[float, float]] = field(default_factory=list)
+    # Beacon sync state (event 0xD2)
+    marker_count: int = 0  # Markers reached since the start of playback
+    beacon_mode: bool = False
+    # (time, seconds of music skipped) of every catch-up with a beacon
+    cut_log: list[tuple[float, float]] = field(default_factory=list)
+    # Seek and loop state (event 0xD3)
+    seek_pos: int = 0
+    loop_start: int = 0  # Marker playback starts after, 0 for the beginning
+    loop_end: int = 0  # Marker to jump back to loop_start at, 0 for none
+    # Tempo and key modifier (event 0xD4), kept across playbacks
+    modifier_pos: int = 0
+    tempo_scale: int = TEMPO_UNIT  # Duration multiplier in 1/TEMPO_UNIT
+    transpose: int = 0  # Semitones added to every note
+    # Live note state (event 0xC_)
+    live_note: int | None = None  # Note the buzzer sounds, None when silent
+    live_log: list[tuple[float, int]] = field(default_factory=list)  # (time, note)
+
+    def receive(self, dt: int, now: float) -> list[int]:
+        """Process a byte seen on the bus, like `fetchData` does.
+
+        Returns:
+            list[int]: Bytes this node answers with.
+        """
+        if not self.event:
+            self.event = dt >> 4
+            self.param = dt & 0x0F
+            responses = []
+            match self.event:
+                case 1:
+                    self._reset_upload()
+                    self.data_ready = False
+                    self.upload_target = self.param == self.node_id
+                    self.response_slot = 0
+                case 3:
+                    self._start(now)
+                case 4:
+                    self.is_playing = self.is_waiting_for_sync = False
+                    self.live_note = None
+                case 5:
+                    if self.param == self.node_id:
+                        self._start(now)
+                case 6:
+                    if self.param == self.node_id:
+                        self.is_playing = self.is_waiting_for_sync = False
+                case 8:
+                    if self.is_waiting_for_sync:
+                        self._resume(now)
+                case 0xB:
+                    if self.param == self.node_id:
+                        self.response_slot = 0
+                        responses.append(0xE1)
+                case 0xA:
+                    self._reset_upload()
+                    self.offset_pos = 0
+                    self.upload_target = self.param == self.node_id
+                    self.response_slot = 0
+                case 0xD if self.param == 0:
+                    self._reset_upload()
+                    self.mask_pos = self.node_mask = 0
+                    self.upload_target = False
+                case 0xD if self.param == 1:
+                    self._reset_upload()
+                    self.bulk_table_pos = self.bulk_end = self.bulk_pos = 0
+                    self.bulk_responses = []
+                    self.upload_target = False
+                    self.response_slot = 0
+                case 0xD if self.param == 3:
+                    self.seek_pos = 0
+                case 0xD if self.param == 4:
+                    self.modifier_pos = 0
+            multi_byte = self.event in (1, 0xA, 0xC, 0xD)
+            if not multi_byte or (self.event, self.param) > (0xD, 4):
+                self.event = self.param = 0
+            return self._respond(responses)
+        if self.event == 1:
+            return self._event1(dt)
+        if self.event == 0xA:
+            return self._event_a(dt)
+        if self.event == 0xC:
+            return self._event_c(dt, now)
+        if self.event == 0xD and self.param == 0:
+            return self._event_d0(dt)
+        if self.event == 0xD and self.param == 1:
+            return self._event_d1(dt)
+        if self.event == 0xD and self.param == 2:
+            return self._event_d2(dt, now)
+        if self.event == 0xD and self.param == 3:
+            return self._event_d3(dt, now)
+        if self.event == 0xD:
+            return self._event_d4(dt)
+        return []
+
+    def _reset_upload(self):
+        self.size_h = self.size_l = False
+        self.uart_pos = self.note_pos = self.checksum = 0
+        self.note_offset = 0
+
+    def _event_a(self, dt: int) -> list[int]:
+        if self.offset_pos < 2:
+            self.note_offset = (self.note_offset << 8 | dt) & 0xFFFF
+            self.offset_pos += 1
+            self.checksum ^= dt
+            self.note_pos = self.note_offset
+            return []
+        return self._event1(dt)
+
+    def _event_d0(self, dt: int) -> list[int]:
+        if self.mask_pos == 0:
+            self.node_mask = dt << 8
+            self.mask_pos = 1
+            return []
+        if self.mask_pos == 1:
+            self.node_mask |= dt
+            self.mask_pos = 2
+            self.upload_target = bool(self.node_mask >> self.node_id & 1)
+            if self.upload_target:
+                self.data_ready = False
+                lower = self.node_mask & ((1 << self.node_id) - 1)
+                self.response_slot = lower.bit_count()
+            return []
+        return self._event1(dt)
+
+    def _event_c(self, dt: int, now: float) -> list[int]:
+        if self.param == self.node_id and not self.is_playing:
+            self.live_note = dt if dt <= 127 else None
+            self.live_log.append((now, dt))
+        self.event = self.param = 0
+        return []
+
+    def _event_d2(self, dt: int, now: float) -> list[int]:
+        self.event = self.param = 0
+        if not self.is_playing:
+            return []
+        self.beacon_mode = True
+        behind = (dt - self.marker_count) & 0xFF
+        if behind < 128:
+            if self.is_waiting_for_sync:
+                self._resume(now)
+            self._catch_up(dt, now)
+        elif behind == 0xFF and self.is_waiting_for_sync:
+            self._resume(now)
+        return []
+
+    def _resume(self, now: float):
+        self.is_waiting_for_sync = False
+        self.sync_log.append((self.event_start, now))
+        self.event_start = now
+
+    def _skip_past(self, target: int) -> float:
+        """Skip the music up to and including marker `target`, like `catchUp`.
+
+        Returns:
+            float: Seconds of music skipped.
+        """
+        skipped = 0.0
+        while True:
+            note = self.note[self.pos]
+            if note <= 127 or note == NOTE_REST:
+                skipped += self._entry_seconds(self.pos)
+                self.pos += 1
+            elif note == NOTE_MARKER:
+                self.marker_count += 1
+                self.pos += 1
+                if (self.marker_count - 1) & 0xFF == target:
+                    break
+            else:
+                break  # The end of the music is left to advance()
+        return skipped
+
+    def _catch_up(self, target: int, now: float):
+        """Cut the current entry at `now` and skip past marker `target`."""
+        # Where the skipped entries would have ended
+        t = self.event_start + self._skip_past(target)
+        self.cut_log.append((now, max(t - now, 0.0)))
+        self.event_start = now
+
+    def _event_d3(self, dt: int, now: float) -> list[int]:
+        if self.seek_pos == 0:
+            self.loop_start = dt
+            self.seek_pos = 1
+            return []
+        self.event = self.param = 0
+        loop_start = self.loop_start
+        self._start(now)
+        self.loop_start = loop_start
+        self.loop_end = dt if dt > loop_start else 0
+        if loop_start:
+            self._skip_past(loop_start - 1)
+        return []
+
+    def _event_d4(self, dt: int) -> list[int]:
+        if self.modifier_pos == 0:
+            self.modifier_pos = 1
+            if dt:
+                self._set_tempo_scale(dt)
+            return []
+        self.event = self.param = 0
+        self.transpose = dt if dt < 128 else dt - 256
+        return []
+
+    def _set_tempo_scale(self, scale: int):
+        note = self.note[self.pos]
+        playing = self.is_playing and not self.is_waiting_for_sync
+        if playing and (note <= 127 or note == NOTE_REST):
+            # The entry being played keeps the duration it started with
+            end = self.event_start + self._entry_seconds(self.pos)
+            self.tempo_scale = scale
+            self.event_start = end - self._entry_seconds(self.pos)
+        else:
+            self.tempo_scale = scale
+
+    def _start(self, now: float):
+        self.pos = 0
+        self.live_note = None
+        self.marker_count = 0
+        self.beacon_mode = False
+        self.loop_start = self.loop_end = 0
+        self.is_playing = True
+        self.is_waiting_for_sync = False
+        self.event_start = now
+
+    def _event_d1(self, dt: int) -> list[int]:
+        if self.bulk_table_pos == 0:
+            self.bulk_count = dt
+            self.bulk_table_pos = 1
+            if dt == 0:
+                self.event = self.param = 0
+            return []
+        if self.bulk_table_pos <= self.bulk_count * 3:
+            match (self.bulk_table_pos - 1) % 3:
+                case 0:
+                    self.bulk_node = dt
+                case 1:
+                    self.bulk_size = dt << 8
+                case 2:
+                    self.bulk_size |= dt
+                    if self.bulk_node == self.node_id:
+                        self.upload_target = True
+                        self.data_ready = False
+                        self.bulk_start = self.bulk_end
+                        self.size = self.bulk_size
+                        self.size_h = self.size_l = True
+                    elif self.bulk_node < self.node_id:
+                        self.response_slot += 1
+                    self.bulk_end += self.bulk_size + 1  # Data and check byte
+            self.bulk_table_pos += 1
+            return []
+
+        segment = self.bulk_start <= self.bulk_pos <= self.bulk_start + self.size
+        if self.upload_target and segment:
+            # Responses wait for the end of the frame
+            self.bulk_responses += self._event1(dt)
+            self.event, self.param = 0xD, 1
+        self.bulk_pos += 1
+        if self.bulk_pos >= self.bulk_end:
+            self.event = self.param = 0
+            responses, self.bulk_responses = self.bulk_responses, []
+            return responses
+        return []
+
+    def _event1(self, dt: int) -> list[int]:
+        if not self.size_h:
+            self.size = dt << 8
+            self.size_h = True
+            return []
+        if not self.size_l:
+            self.size |= dt
+            self.size_l = True
+            return []
+
+        responses = []
+        oversized = self.size // 3 + self.note_offset > MAX_NOTES
+        if self.upload_target:
+            if oversized:
+                self.uart_pos += 1
+            elif self.uart_pos < self.size:
+                match self.uart_pos % 3:
+                    case 0:
+                        self.note[self.note_pos] = dt
+                    case 1:
+                        self.duration[self.note_pos] = dt << 8
+                    case 2:
+                        self.duration[self.note_pos] |= dt
+                        self.note_pos += 1
+                self.uart_pos += 1
+                self.checksum ^= dt
+            elif self.uart_pos == self.size:
+                self.data_ready = dt == self.checksum
+                responses.append(0xE0 if self.data_ready else 0xF0)
+                self.uart_pos += 1
+            if self.uart_pos > self.size:
+                self.event = self.param = 0
+                if oversized:
+                    self.data_ready = False
+                    responses.append(0xF1)
+        else:
+            if self.uart_pos <= self.size:
+                self.uart_pos += 1
+            if self.uart_pos > self.size:
+                self.event = self.param = 0
+        return self._respond(responses)
+
+    def _respond(self, responses: list[int]) -> list[int]:
+        if self.is_playing:
+            # The main loop only sends responses while it is not playing
+            self.pending_responses += responses
+            return []
+        return responses
+
+    def _entry_seconds(self, index: int) -> float:
+        duration = self.duration[index]
+        if self.tempo_scale != TEMPO_UNIT:
+            # Same integer arithmetic as scale_duration in music.c
+            duration = min(duration * self.tempo_scale // TEMPO_UNIT, 0xFFFF)
+        return duration / 1000 * (1 + self.clock_error_ppm / 1e6)
+
+    def next_playback_event(self) -> float | None:
+        """Virtual time of the next marker or end of music, if any."""
+        if not self.is_playing or self.is_waiting_for_sync:
+            return None
+        t = self.event_start
+        for i in range(self.pos, MAX_NOTES):
+            note = self.note[i]
+            if note <= 127 or note == NOTE_REST:
+                t += self._entry_seconds(i)
+            elif note in (NOTE_END, NOTE_MARKER):
+                return t
+            else:
+                # The firmware never advances past unknown symbols
+                return None
+        return None
+
+    def advance(self, until: float) -> list[tuple[float, int]]:
+        """Play until `until`, like `play_music_note` called in a loop.
+
+        Returns:
+            list[tuple[float, int]]: (time, byte) pairs the node sends.
+        """
+        sent = []
+        while self.is_playing and not self.is_waiting_for_sync:
+            note = self.note[self.pos]
+            if note <= 127 or note == NOTE_REST:
+                end = self.event_start + self._entry_seconds(self.pos)
+                if end > until:
+                    break
+                self.pos += 1
+                self.event_start = end
+            elif note == NOTE_END:
+                if self.event_start > until:
+                    break
+                self.pos = 0
+                self.is_playing = False
+                if self.node_id == 0:
+                    sent.append((self.event_start, 0x20))
+            elif note == NOTE_MARKER:
+                if self.event_start > until:
+                    break
+                if self.node_id == 0 and not self.beacon_mode:
+                    sent.append((self.event_start, 0x70))
+                self.is_waiting_for_sync = True
+                self.marker_count += 1
+                self.pos += 1
+                if self.marker_count == self.loop_end:
+                    # Back to the loop start once released
+                    self.pos = self.marker_count = 0
+                    if self.loop_start:
+                        self._skip_past(self.loop_start - 1)
+            else:
+                break
+        if not self.is_playing and self.pending_responses:
+            sent += [(until, dt) for dt in self.pending_responses]
+            self.pending_responses.clear()
+        return sent
+
+
+class SimulatedSerial:
+    """Host end of a simulated RS485 bus, usable in place of `serial.Serial`.
+
+    Args:
+        node_ids: Addresses of the nodes attached to the bus. Defaults to all 16.
+        baudrate (int): Baud rate used for wire time. Defaults to 115200.
+        timeout (None | float): Read timeout, as in `serial.Serial`.
+        latency (float): Seconds between a byte on the bus and the host
+            reading it, e.g. the latency timer of a USB adapter. Defaults to 0.
+        faults (Faults | None): Errors to inject on the wire. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        node_ids=range(16),
+        baudrate: int = 115200,
+        *,
+        timeout: None | float = 2.0,
+        name: str = "sim",
+        latency: float = 0.0,
+        faults: Faults | None = None,
+    ):
+        self.nodes = {i: SimulatedNode(i) for i in node_ids}
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.name = name
+        self.latency = latency
+        self.port = name
+        self.is_open = True
+        self.now = 0.0  # Virtual time in seconds
+        self.bytes_written = 0
+        self._bus_free_at = 0.0
+        self._rx: list[int] = []
+        self._queue: list[tuple[float, int, int | None, int]] = []
+        self._seq = 0
+        self.faults = faults
+        self.fault_counts = {"bits_flipped": 0, "bytes_dropped": 0, "acks_lost": 0}
+        self._random = random.Random(faults.seed if faults else None)
+        self._bits_to_error = self._next_bit_error()
+
+    @property
+    def byte_time(self) -> float:
+        return 10 / self.baudrate
+
+    def _next_bit_error(self) -> float:
+        """Number of correct bits before the next flipped one."""
+        rate = self.faults.bit_error_rate if self.faults else 0.0
+        if rate <= 0.0:
+            return math.inf
+        if rate >= 1.0:
+            return 0
+        # Geometric distribution, so error-free bits cost no random numbers
+        return int(math.log(1.0 - self._random.random()) / math.log(1.0 - rate))
+
+    def _corrupt(self, dt: int) -> int | None:
+        """Apply the injected faults to a byte on the wire, None if it is lost."""
+        if self._random.random() < self.faults.drop_rate:
+            self.fault_counts["bytes_dropped"] += 1
+            return None
+        bit = self._bits_to_error
+        while bit < 8:
+            dt ^= 1 << int(bit)
+            self.fault_counts["bits_flipped"] += 1
+            bit += 1 + self._next_bit_error()
+        self._bits_to_error = bit - 8
+        return dt
+
+    def _transmit(self, source: int | None, data, start: float) -> float:
+        """Queue bytes sent by `source` (None for the host) starting at `start`.
+
+        Returns:
+            float: Time the last byte has been received.
+        """
+        t = max(start, self._bus_free_at)
+        for dt in data:
+            t += self.byte_time
+            if self.faults is not None:
+                dt = self._corrupt(dt)
+                if dt is None:
+                    continue
+            self._seq += 1
+            heapq.heappush(self._queue, (t, self._seq, source, dt))
+        self._bus_free_at = t
+        return t
+
+    def _respond(self, node_id: int, responses: list[int], start: float):
+        """Send the responses of a node, unless the injected faults lose them."""
+        if self.faults is not None:
+            if self._random.random() < self.faults.ack_loss_rate:
+                self.fault_counts["acks_lost"] += len(responses)
+                return
+            start += self._random.uniform(0.0, self.faults.jitter)
+        self._transmit(node_id, responses, start)
+
+    def _next_event(self) -> float | None:
+        times = [self._queue[0][0]] if self._queue else []
+        for node in self.nodes.values():
+            t = node.next_playback_event()
+            if t is not None:
+                times.append(t)
+        return min(times, default=None)
+
+    def _run_until(self, until: float):
+        while True:
+            t = self._next_event()
+            if t is None or t > until:
+                break
+            t = max(t, self.now)
+            for node in self.nodes.values():
+                for sent_at, dt in node.advance(t):
+                    self._transmit(node.node_id, [dt], sent_at)
+            while self._queue and self._queue[0][0] <= t:
+                arrival, _, source, dt = heapq.heappop(self._queue)
+                if source == _TO_HOST:
+                    self._rx.append(dt)
+                    continue
+                if source is not None and self.latency:
+                    self._seq += 1
+                    heapq.heappush(
+                        self._queue, (arrival + self.latency, self._seq, _TO_HOST, dt)
+                    )
+                elif source is not None:
+                    self._rx.append(dt)
+                for node in self.nodes.values():
+                    if node.node_id == source:
+                        continue
+                    responses = node.receive(dt, arrival)
+                    if responses:
+                        delay = RESPONSE_DELAY + node.response_slot * ACK_SLOT
+                        self._respond(node.node_id, responses, arrival + delay)
+            self.now = t
+        self.now = max(self.now, until)
+        for node in self.nodes.values():
+            for sent_at, dt in node.advance(self.now):
+                self._transmit(node.node_id, [dt], sent_at)
+
+    def write(self, data) -> int:
+        """Send bytes and advance the clock until they left the wire."""
+        end = self._transmit(None, bytes(data), self.now)
+        self._run_until(end)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self, size: int = 1) -> bytes:
+        """Read up to `size` bytes, advancing the clock by at most `timeout`."""
+        deadline = None if self.timeout is None else self.now + self.timeout
+        while len(self._rx) < size:
+            t = self._next_event()
+            if t is None or (deadline is not None and t > deadline):
+                if deadline is not None:
+                    self._run_until(deadline)
+                break
+            self._run_until(t)
+        data, self._rx = self._rx[:size], self._rx[size:]
+        return bytes(data)
+
+    def read_all(self) -> bytes:
+        self._run_until(self.now)
+        data, self._rx = self._rx, []
+        return bytes(data)
+
+    @property
+    def in_waiting(self) -> int:
+        self._run_until(self.now)
+        return len(self._rx)
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def sleep(self, seconds: float):
+        """Let virtual time pass, e.g. in place of `time.sleep`."""
+        self._run_until(self.now + seconds)
+
+    def close(self):
+        self.is_open = False
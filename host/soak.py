@@ -0,0 +1,295 @@
+"""
+Soak test of the host code on a simulated bus with injected faults.
+
+Runs upload, play and sync sessions through the real `host_serial` code on
+one `SimulatedSerial` with `Faults`, so nodes left in a broken receive
+state by one session carry it into the next, as on a real bus. After
+every upload the data the nodes actually hold is compared with the
+tracks. The report contains
+
+- goodput: music bytes that reached the nodes intact per second of bus time,
+- retries and failed uploads with the given retry policy,
+- undetected corruption: uploads acknowledged although the node holds
+  other data. The XOR checksum misses an even number of flips in the same
+  bit position, and a single flip turns a 0xF0 response into 0xE0,
+- response latencies as seen by the host, to size read timeouts,
+- sync latency: how long the nodes wait at a marker, missed syncs and
+  sessions whose end was never reported.
+
+Example:
+    python soak.py song.mid --sessions 100 --ber 1e-5 --drop 1e-6 --ack-loss 0.01
+"""
+
+import argparse
+import io
+import logging
+from dataclasses import dataclass, field
+
+import capture
+import host_serial as hs
+import metrics
+import parse_midi as pm
+import preflight
+from simulator import Faults, SimulatedNode, SimulatedSerial
+
+
+@dataclass
+class SoakReport:
+    """Results of a soak run"""
+
+    sessions: int = 0
+    uploads: int = 0  # Track uploads, without retries
+    retries: int = 0
+    failed: int = 0  # Uploads still failing after all retries
+    undetected: int = 0  # Acknowledged, but the node holds other data
+    payload_bytes: int = 0  # Music bytes that reached the nodes intact
+    upload_seconds: float = 0.0  # Bus time spent uploading, retries included
+    sync_latencies: list[float] = field(default_factory=list)
+    missed_syncs: int = 0  # Markers a node did not resume from
+    stalled: int = 0  # Sessions that never reported the end of the music
+    responses: dict[str, int] = field(default_factory=dict)  # Host's view
+    fault_counts: dict[str, int] = field(default_factory=dict)
+    traffic: list[capture.Event] = field(default_factory=list)
+
+    @property
+    def goodput(self) -> float:
+        """Intact music bytes per second of upload time"""
+        return self.payload_bytes / self.upload_seconds if self.upload_seconds else 0.0
+
+    def format(self) -> str:
+        lines = [
+            f"sessions            {self.sessions} ({self.stalled} stalled)",
+            f"uploads             {self.uploads}, {self.retries} retries, "
+            f"{self.failed} failed",
+            f"undetected errors   {self.undetected}"
+            f" ({self.undetected / max(self.uploads, 1):.2e} per upload)",
+            f"goodput             {self.goodput:.0f} B/s "
+            f"({self.payload_bytes} B in {self.upload_seconds:.2f} s)",
+            "host saw            "
+            + ", ".join(f"{k} {v}" for k, v in sorted(self.responses.items())),
+            "faults injected     "
+            + ", ".join(f"{k} {v}" for k, v in sorted(self.fault_counts.items())),
+        ]
+        if self.sync_latencies:
+            latencies = sorted(self.sync_latencies)
+            lines.append(
+                f"sync latency        {len(latencies)} syncs, "
+                + ", ".join(
+                    f"{name} {_percentile(latencies, q) * 1e3:.1f} ms"
+                    for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+                )
+                + f", max {latencies[-1] * 1e3:.1f} ms, {self.missed_syncs} missed"
+            )
+        lines += ["", "response latency", capture.format_summary(self.traffic)]
+        return "\n".join(lines)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def holds(node: SimulatedNode, packet: bytes) -> bool:
+    """Check whether a node holds the entries of a track data packet."""
+    data = packet[3:-1]
+    for i in range(len(data) // 3):
+        if node.note[i] != data[3 * i]:
+            return False
+        if node.duration[i] != data[3 * i + 1] << 8 | data[3 * i + 2]:
+            return False
+    return True
+
+
+def run_session(
+    sim: SimulatedSerial,
+    byte_list: list[bytes],
+    track_assignments: dict[int, str],
+    report: SoakReport,
+    *,
+    retries: int = 2,
+    upload_timeout: float = 0.1,
+    sync_waiting_time: float = 0.1,
+    single: bool = False,
+    ser=None,
+):
+    """Upload, verify and play once, adding the results to `report`.
+
+    Args:
+        sim (SimulatedSerial): The bus, kept across sessions.
+        byte_list (list[bytes]): List of byte data for each track.
+        track_assignments (dict[int, str]): Mapping of track index to node ID.
+        report (SoakReport): Collects the results.
+        retries (int): Uploads of a failed track alone. Defaults to 2.
+        upload_timeout (float): Read timeout while uploading. Defaults to 0.1.
+        sync_waiting_time (float): Delay before answering a sync request.
+        single (bool): Upload every track on its own, without multicast and
+            bulk frames. Defaults to False.
+        ser: Port object the host code uses, e.g. a capture of `sim`.
+            Defaults to `sim` itself.
+    """
+    ser = ser or sim
+    report.sessions += 1
+
+    results: dict[tuple[int, int], bool] = {}
+    start = sim.now
+    sim.timeout = upload_timeout
+    hs.send_music_data(
+        ser,
+        byte_list,
+        track_assignments,
+        fold_duplicates=not single,
+        bulk=not single,
+        on_result=lambda track, node_id, ok: results.__setitem__((track, node_id), ok),
+        clock=lambda: sim.now,
+    )
+    for (track, node_id), ok in results.items():
+        attempts = 0
+        while not ok and attempts < retries:
+            attempts += 1
+            ok = hs.send_track_data(ser, node_id, byte_list[track])
+        results[track, node_id] = ok
+        report.retries += attempts
+    report.upload_seconds += sim.now - start
+
+    markers: dict[int, int] = {}  # Node ID -> markers in its track
+    for (track, node_id), ok in results.items():
+        report.uploads += 1
+        packet = byte_list[track]
+        node = sim.nodes.get(node_id)
+        intact = node is not None and holds(node, packet)
+        if ok and intact:
+            report.payload_bytes += len(packet) - 4
+        elif ok:
+            report.undetected += 1
+        else:
+            report.failed += 1
+        if intact:
+            markers[node_id] = packet[3:-1:3].count(pm.NOTE_MARKER)
+
+    # Play at most twice as long as expected before calling it stalled
+    reports = preflight.analyze(byte_list, track_assignments, sim.baudrate)
+    expected = max((r.play_seconds for r in reports if r.assigned), default=0.0)
+    expected += max(markers.values(), default=0) * sync_waiting_time
+    limit = sim.now + 2 * expected + 1.0
+    for node in sim.nodes.values():
+        node.sync_log.clear()
+    sim.timeout = 0.1
+    hs.send_command(ser, bytes([0x30]))
+    ended = hs.serve_sync_requests(
+        ser, sync_waiting_time, lambda: sim.now < limit, sleep=sim.sleep
+    )
+    if not ended:
+        report.stalled += 1
+    hs.send_command(ser, bytes([0x40]))  # Stop nodes that are still waiting
+
+    for node_id, count in markers.items():
+        log = sim.nodes[node_id].sync_log
+        report.sync_latencies += [resumed - reached for reached, resumed in log]
+        report.missed_syncs += max(count - len(log), 0)
+
+
+def soak(
+    byte_list: list[bytes],
+    track_assignments: dict[int, str],
+    faults: Faults,
+    sessions: int = 10,
+    *,
+    baudrate: int = hs.BAUDRATE,
+    latency: float = 0.0,
+    **session_options,
+) -> SoakReport:
+    """Run soak sessions on a faulty simulated bus.
+
+    Args:
+        byte_list (list[bytes]): List of byte data for each track.
+        track_assignments (dict[int, str]): Mapping of track index to node ID.
+        faults (Faults): Errors to inject.
+        sessions (int): Number of upload and play sessions. Defaults to 10.
+        baudrate (int): Baud rate of the bus. Defaults to BAUDRATE.
+        latency (float): Adapter latency, see `SimulatedSerial`.
+        **session_options: Passed to `run_session`.
+
+    Returns:
+        SoakReport: Results of all sessions.
+    """
+    node_ids = sorted(
+        {
+            int(track_assignments.get(i, hex(i).upper()[2:]), 16)
+            for i in range(len(byte_list))
+            if track_assignments.get(i) != "不分配"
+        }
+    )
+    sim = SimulatedSerial(node_ids, baudrate, latency=latency, faults=faults)
+    traffic = io.BytesIO()
+    ser = capture.CapturingSerial(sim, traffic, clock=lambda: round(sim.now * 1e9))
+
+    was_enabled = metrics.is_enabled()
+    metrics.enable()
+    metrics.reset()
+    report = SoakReport()
+    try:
+        for _ in range(sessions):
+            run_session(
+                sim, byte_list, track_assignments, report, ser=ser, **session_options
+            )
+        for counter in metrics.snapshot()["counters"]:
+            if counter["name"] == "stc_upload_responses_total":
+                result = counter["labels"]["result"]
+                report.responses[result] = report.responses.get(result, 0) + int(
+                    counter["value"]
+                )
+    finally:
+        metrics.reset()
+        metrics.enable(was_enabled)
+    report.fault_counts = dict(sim.fault_counts)
+    report.traffic = capture.decode(capture.parse_capture(traffic.getvalue()))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test with injected faults")
+    parser.add_argument("midi_file")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--ber", type=float, default=0.0, help="bit error rate")
+    parser.add_argument("--drop", type=float, default=0.0, help="byte loss rate")
+    parser.add_argument("--ack-loss", type=float, default=0.0, help="response loss")
+    parser.add_argument("--jitter", type=float, default=0.0, metavar="SECONDS")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=0.1, metavar="SECONDS")
+    parser.add_argument("--sync-wait", type=float, default=0.1, metavar="SECONDS")
+    parser.add_argument("--baudrate", type=int, default=hs.BAUDRATE)
+    parser.add_argument("--latency", type=float, default=0.0, metavar="SECONDS")
+    parser.add_argument(
+        "--single", action="store_true", help="no multicast and bulk frames"
+    )
+    parser.add_argument("--no-sync", action="store_true", help="ignore sync markers")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.CRITICAL,
+        format="%(levelname)s %(message)s",
+    )
+
+    byte_list = pm.midi_to_binary_list(
+        args.midi_file, pm.MidiConfig(enable_sync=not args.no_sync)
+    )
+    assignments = {i: "不分配" for i in range(16, len(byte_list))}
+    faults = Faults(args.ber, args.drop, args.ack_loss, args.jitter, args.seed)
+    report = soak(
+        byte_list,
+        assignments,
+        faults,
+        args.sessions,
+        baudrate=args.baudrate,
+        latency=args.latency,
+        retries=args.retries,
+        upload_timeout=args.timeout,
+        sync_waiting_time=args.sync_wait,
+        single=args.single,
+    )
+    print(report.format())
+
+
+if __name__ == "__main__":
+    main()
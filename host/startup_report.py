@@ -0,0 +1,99 @@
+"""
+Measure how fast the GUI starts.
+
+Prints the slowest imports of `gui` (from `python -X importtime`) and the
+time from launching `gui.py` to its first drawn frame. Run it from the
+`host` directory after changing imports or start-up code:
+
+    python startup_report.py [--top 15] [--runs 3]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+def import_times(module: str) -> list[tuple[int, int, str]]:
+    """Import `module` in a fresh interpreter with `-X importtime`.
+
+    Returns:
+        list[tuple[int, int, str]]: (self us, cumulative us, name) per import.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return rows
+
+
+def time_to_first_frame() -> float:
+    """Launch the GUI and return the seconds until its first frame."""
+    start = time.time()
+    result = subprocess.run(
+        [sys.executable, "gui.py", "--measure-startup"],
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    for line in result.stdout.splitlines():
+        if line.startswith("first-frame "):
+            return float(line.split()[1]) - start
+    raise RuntimeError(f"GUI did not report its first frame: {result.stderr.strip()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--top", type=int, default=15, help="imports to list")
+    parser.add_argument("--runs", type=int, default=3, help="GUI launches to time")
+    args = parser.parse_args()
+    if args.runs < 1:
+        parser.error("--runs must be at least 1")
+
+    rows = import_times("gui")
+    total = next((cum for _, cum, name in rows if name.strip() == "gui"), 0)
+    print(f"import gui: {total / 1000:.1f} ms")
+    print(f"{'cumulative ms':>14} {'self ms':>8}  module")
+    for self_us, cumulative_us, name in sorted(rows, key=lambda r: -r[1])[: args.top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>8.1f}  {name}")
+
+    # Modules that should only be imported on first use
+    deferred = (
+        "beacon",
+        "bridge",
+        "library",
+        "mido",
+        "multiprocessing",
+        "serial",
+        "simulator",
+        "sqlite3",
+        "webbrowser",
+    )
+    loaded = sorted(
+        {name.strip() for _, _, name in rows if name.strip().split(".")[0] in deferred}
+    )
+    if loaded:
+        print(f"\nWARNING: imported at start-up: {', '.join(loaded)}")
+
+    try:
+        samples = [time_to_first_frame() for _ in range(args.runs)]
+    except (RuntimeError, subprocess.SubprocessError) as e:
+        print(f"\ntime to first frame: unavailable ({e})")
+        return
+    print(
+        f"\ntime to first frame: median {statistics.median(samples) * 1000:.0f} ms"
+        f" (min {min(samples) * 1000:.0f} ms over {len(samples)} runs)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Per-marker sync waits, learned from the sync requests of node 0.
+
+After node 0 asks for a sync (0x70) the host waits before releasing the
+nodes (0x80), long enough for the slowest node to reach the marker as well.
+How long that is differs per marker: the tracks reach it after differently
+rounded durations, and the nodes' clocks drift apart in proportion to the
+music played since the last release. One global wait is too long for most
+markers and too short for some.
+
+`SyncTuner` takes the time every assigned track needs to reach each marker
+from its packet and records when node 0's request for it arrives, counted
+from the release before. It waits until the latest node arrives, allowing
+every node a clock error of `clock_tolerance`, plus a margin for the jitter of
+that arrival. The margin is learned per marker from the run-to-run variation
+of the arrival, so steady markers wait less than SAFETY_MARGIN:
+
+    wait = max(track time) * (1 + clock_tolerance) - arrival
+           + max(3 standard deviations, MIN_MARGIN)
+
+Until a marker has been observed MIN_RUNS times, SAFETY_MARGIN stands in for
+the learned margin.
+
+The learned values are stored next to the MIDI file or bundle in a sidecar
+JSON file (`song.mid.sync.json`), one entry per song and assignment. Markers
+that have never been observed use the configured wait.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from parse_midi import NOTE_MARKER, NOTE_REST, iter_entries
+
+# Clock error of a node assumed for the other nodes, the internal RC
+# oscillator of the STC15 is trimmed to a few tenths of a percent
+CLOCK_TOLERANCE = 0.005
+# Seconds added to every wait for the host's own scheduling jitter, until
+# MIN_RUNS runs tell how large it is at a marker
+SAFETY_MARGIN = 0.01
+MIN_RUNS = 3
+MIN_MARGIN = 0.002  # Resolution of the host's sleep
+MIN_WAIT = 0.01
+MAX_WAIT = 1.0  # Same limits as the sync waiting time in the settings
+# Weight of the latest run once a marker has been observed this often, so the
+# tuner follows slowly changing hardware, e.g. warming oscillators
+RECENT_RUNS = 5
+SIDECAR_SUFFIX = ".sync.json"
+
+
+@dataclass
+class MarkerStats:
+    """Arrival of node 0's sync request at a marker, over several runs"""
+
+    runs: int = 0
+    mean: float = 0.0  # Seconds from the previous release to the request
+    variance: float = 0.0
+
+    def add(self, arrival: float):
+        """Add the arrival of one run, weighting recent runs more."""
+        self.runs += 1
+        alpha = max(1 / self.runs, 1 / RECENT_RUNS)
+        delta = arrival - self.mean
+        self.mean += alpha * delta
+        self.variance = (1 - alpha) * (self.variance + alpha * delta * delta)
+
+
+def marker_times(packet: bytes) -> list[float]:
+    """Seconds of music before every marker, counted from the one before."""
+    times = []
+    ms = 0
+    for note, duration in iter_entries(packet):
+        if note <= 127 or note == NOTE_REST:
+            ms += duration
+        elif note == NOTE_MARKER:
+            times.append(ms / 1000)
+            ms = 0
+    return times
+
+
+def assigned_packets(
+    byte_list: list[bytes], track_assignments: dict[int, str]
+) -> list[bytes]:
+    """Packets of the assigned tracks in node order, as for `send_music_data`."""
+    assigned = {}
+    for track_index, packet in enumerate(byte_list):
+        node_id = track_assignments.get(track_index, hex(track_index).upper()[2:])
+        if node_id != "不分配":
+            assigned[int(node_id, 16)] = packet
+    return [assigned[node_id] for node_id in sorted(assigned)]
+
+
+def sidecar_path(song_path: str) -> str:
+    """File the learned waits of a MIDI file or bundle are stored in."""
+    return song_path + SIDECAR_SUFFIX
+
+
+def fingerprint(packets: list[bytes]) -> str:
+    """Key of a song and assignment in the sidecar file."""
+    digest = hashlib.sha1()
+    for packet in packets:
+        digest.update(len(packet).to_bytes(4, "big"))
+        digest.update(packet)
+    return digest.hexdigest()
+
+
+class SyncTuner:
+    """Computes the wait of every marker and learns from each run.
+
+    Call `begin` right after sending the start command, pass `wait` as the
+    sync waiting time of the sync loop and call `finish` once it returns.
+
+    Args:
+        packets (list[bytes]): Packets of the assigned tracks, the one of
+            node 0 first. Their order is part of the key in the sidecar file.
+        fallback (float): Wait of markers without observations.
+        path (str | None): Sidecar file, see `sidecar_path`. Defaults to None,
+            which learns for the current session only.
+        clock_tolerance (float): Clock error allowed for every node.
+            Defaults to CLOCK_TOLERANCE.
+        clock (Callable[[], float]): Time source, replaceable for simulated
+            buses. Defaults to time.perf_counter.
+    """
+
+    def __init__(
+        self,
+        packets: list[bytes],
+        fallback: float,
+        path: str | None = None,
+        *,
+        clock_tolerance: float = CLOCK_TOLERANCE,
+        clock: Callable[[], float] = time.perf_counter,
+    ):
+        self.fallback = fallback
+        self.path = path
+        self.clock_tolerance = clock_tolerance
+        self.clock = clock
+        self.key = fingerprint(packets)
+        # Time the slowest track needs to reach each marker
+        self.track_times = [max(times) for times in zip(*map(marker_times, packets))]
+        self.markers = [MarkerStats() for _ in self.track_times]
+        self._observed: dict[int, float] = {}  # Arrivals of the current run
+        self._released = 0.0
+        self._load()
+
+    @classmethod
+    def for_assignments(
+        cls,
+        byte_list: list[bytes],
+        track_assignments: dict[int, str],
+        fallback: float,
+        path: str | None = None,
+        **options,
+    ) -> "SyncTuner":
+        """Create a tuner for tracks assigned as for `send_music_data`."""
+        packets = assigned_packets(byte_list, track_assignments)
+        return cls(packets, fallback, path, **options)
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                song = json.load(f)["songs"].get(self.key)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring sync waits in {self.path}: {e}")
+            return
+        if song is None:
+            return
+        for stats, saved in zip(self.markers, song["markers"]):
+            stats.runs = saved["runs"]
+            stats.mean = saved["mean"]
+            stats.variance = saved["variance"]
+        logging.info(f"Loaded sync waits of {len(self.markers)} markers")
+
+    def save(self):
+        """Write the learned values into the sidecar file."""
+        if self.path is None:
+            return
+        songs = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                songs = json.load(f)["songs"]
+        except (OSError, ValueError, KeyError):
+            pass  # Missing or broken, start over
+        songs[self.key] = {
+            "markers": [
+                {"runs": s.runs, "mean": s.mean, "variance": s.variance}
+                for s in self.markers
+            ]
+        }
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"songs": songs}, f, indent=1)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save sync waits to {self.path}: {e}")
+
+    def planned_wait(self, marker: int) -> float:
+        """Wait for a marker from its arrival in this run and what has been learned."""
+        if marker >= len(self.markers) or not self.markers[marker].runs:
+            return self.fallback
+        stats = self.markers[marker]
+        jitter = 3 * math.sqrt(stats.variance)
+        # Before node 0 has asked, expect it as early as it has been seen
+        arrival = self._observed.get(marker, stats.mean - jitter)
+        margin = SAFETY_MARGIN if stats.runs < MIN_RUNS else max(jitter, MIN_MARGIN)
+        latest = self.track_times[marker] * (1 + self.clock_tolerance)
+        return min(max(latest - arrival + margin, MIN_WAIT), MAX_WAIT)
+
+    def begin(self):
+        """Start a run, right after the start command has been sent."""
+        self._observed.clear()
+        self._released = self.clock()
+
+    def wait(self, marker: int) -> float:
+        """Record a sync request and return how long to wait before releasing.
+
+        Args:
+            marker (int): Index of the marker in the song, starting at 0.
+
+        Returns:
+            float: Seconds to wait.
+        """
+        now = self.clock()
+        self._observed[marker] = now - self._released
+        wait = self.planned_wait(marker)
+        self._released = now + wait
+        logging.debug(
+            f"Sync {marker}: request after {self._observed[marker]:.3f} s, "
+            f"waiting {wait:.3f} s"
+        )
+        return wait
+
+    def finish(self):
+        """Learn from the current run and save the result."""
+        if not self._observed:
+            return
+        for marker, arrival in self._observed.items():
+            if marker < len(self.markers):
+                self.markers[marker].add(arrival)
+        self._observed.clear()
+        self.save()
@@ -0,0 +1,389 @@
+"""
+Watch mode: reload a MIDI file whenever the DAW exports it again.
+
+`FileWatcher` notices a rewritten file through inotify on Linux and by
+polling its size and modification time elsewhere, and reports it once the
+file has stopped changing. `IncrementalParser` then converts only what the
+export changed: it keeps the events of every MIDI track together with the
+state the track started from (tempo and held notes carry over from the
+track before, see `parse_midi.walk_track`) and walks a track again only
+if its chunk bytes or that state differ. Packets are re-encoded only for
+tracks whose events changed, and `changed_tracks` tells which packets to
+upload again.
+
+Example:
+    python watch.py song.mid
+"""
+
+import argparse
+import ctypes
+import io
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import Callable
+
+import metrics
+import parse_midi as pm
+import profiling
+
+# Seconds a file must stay unchanged before it is reported, exporting
+# writes it in several steps
+SETTLE_TIME = 0.3
+POLL_INTERVAL = 0.5  # Seconds between two checks without inotify
+
+# inotify events of the watched directory, see inotify(7)
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_CHUNK = struct.Struct(">4sI")
+
+
+def split_chunks(data: bytes) -> tuple[bytes, list[bytes]]:
+    """Split a standard MIDI file into its header and track chunks.
+
+    Returns:
+        tuple[bytes, list[bytes]]: Header chunk and every MTrk chunk, each
+            including its type and length.
+    """
+    header = None
+    tracks = []
+    pos = 0
+    while pos + _CHUNK.size <= len(data):
+        kind, size = _CHUNK.unpack_from(data, pos)
+        chunk = data[pos : pos + _CHUNK.size + size]
+        if header is None:
+            if kind != b"MThd":
+                raise ValueError("Not a standard MIDI file")
+            header = chunk
+        elif kind == b"MTrk":
+            tracks.append(chunk)
+        pos += _CHUNK.size + size
+    if header is None:
+        raise ValueError("Not a standard MIDI file")
+    return header, tracks
+
+
+def _check_cancelled(cancel: pm.CancelFlag | None):
+    if cancel is not None and cancel.is_set():
+        raise pm.ParseCancelled()
+
+
+@dataclass(frozen=True)
+class _WalkedTrack:
+    """Result of walking a MIDI track, valid for the same chunk and start state"""
+
+    chunk: bytes
+    tempo: int  # Tempo at the start
+    notes: tuple  # Held notes at the start, sorted (note, tick) pairs
+    events: list
+    end_tempo: int
+    end_notes: dict
+    markers: list[int]
+
+
+class IncrementalParser:
+    """Converts a MIDI file again and again, walking changed tracks only.
+
+    The packets equal those of `parse_midi.midi_to_binary_lists`. The
+    parser is safe to use from several threads, calls are serialized.
+
+    Args:
+        config (pm.MidiConfig | None): Conversion settings, `enable_sync` is
+            ignored as both variants are returned. Defaults to MidiConfig().
+    """
+
+    def __init__(self, config: pm.MidiConfig | None = None):
+        self.config = replace(config or pm.MidiConfig(), enable_sync=True)
+        self.walked_tracks: list[int] = []  # MIDI tracks walked by the last call
+        self.changed_tracks: list[int] = []  # Packets that changed in the last call
+        self._header = b""
+        self._tracks: list[_WalkedTrack] = []
+        self._events: list[list] = []  # Merged events of the last result
+        self._synced: list[bytes] = []
+        self._unsynced: list[bytes] = []
+        self._lock = threading.Lock()
+
+    def forget(self):
+        """Drop everything, the next call converts the whole file."""
+        with self._lock:
+            self._header = b""
+            self._tracks = []
+            self._events = []
+            self._synced = []
+            self._unsynced = []
+
+    def parse(
+        self,
+        midi_file: str,
+        *,
+        on_track: pm.TrackCallback | None = None,
+        cancel: pm.CancelFlag | None = None,
+    ) -> tuple[list[bytes], list[bytes]]:
+        """Convert a MIDI file into synced and unsynced packets.
+
+        Args:
+            midi_file (str): Path of the MIDI file.
+            on_track: See `parse_midi.parse_midi_to_events`.
+            cancel: See `parse_midi.parse_midi_to_events`. A cancelled call
+                leaves the cached state unchanged.
+
+        Returns:
+            tuple[list[bytes], list[bytes]]: Synced and unsynced packets per track.
+        """
+        with self._lock:
+            return self._parse(midi_file, on_track, cancel)
+
+    def _parse(self, midi_file, on_track, cancel):
+        with open(midi_file, "rb") as f:
+            data = f.read()
+        header, chunks = split_chunks(data)
+        # Another resolution changes every duration
+        previous = self._tracks if header == self._header else []
+        ticks_per_beat = struct.unpack_from(">H", header, 12)[0]
+
+        tempo = self.config.default_tempo
+        note_stack: dict[int, int] = {}
+        tracks = []
+        walked = []
+        with metrics.timer("stc_parse_seconds"), profiling.span("parse"):
+            for track_index, chunk in enumerate(chunks):
+                _check_cancelled(cancel)
+                notes = tuple(sorted(note_stack.items()))
+                cached = previous[track_index] if track_index < len(previous) else None
+                if (
+                    cached is None
+                    or cached.chunk != chunk
+                    or cached.tempo != tempo
+                    or cached.notes != notes
+                ):
+                    with profiling.span(f"track {track_index}"):
+                        cached = self._walk(
+                            header, chunk, ticks_per_beat, tempo, note_stack
+                        )
+                    walked.append(track_index)
+                tracks.append(cached)
+                tempo = cached.end_tempo
+                note_stack = dict(cached.end_notes)
+                if on_track is not None:
+                    on_track(track_index, len(chunks), cached.events)
+
+            with profiling.span("marker merge"):
+                event_list = [list(t.events) for t in tracks if t.events]
+                markers = [m for t in tracks for m in t.markers]
+                pm.merge_markers(event_list, markers, self.config)
+
+        synced = []
+        unsynced = []
+        changed = []
+        with metrics.timer("stc_encode_seconds"), profiling.span("encode"):
+            for index, events in enumerate(event_list):
+                _check_cancelled(cancel)
+                if index < len(self._events) and self._events[index] == events:
+                    synced.append(self._synced[index])
+                    unsynced.append(self._unsynced[index])
+                    continue
+                with profiling.span(f"track {index}"):
+                    synced.append(pm.events_to_binary(events))
+                    unsynced.append(
+                        pm.events_to_binary(
+                            [e for e in events if e[1] != self.config.marker_symbol]
+                        )
+                    )
+                changed.append(index)
+        changed += range(len(event_list), len(self._events))  # Removed tracks
+
+        self._header = header
+        self._tracks = tracks
+        self._events = event_list
+        self._synced = synced
+        self._unsynced = unsynced
+        self.walked_tracks = walked
+        self.changed_tracks = changed
+        logging.info(
+            f"Parsed {midi_file}: walked {len(walked)} of {len(chunks)} MIDI "
+            f"tracks, {len(changed)} packets changed"
+        )
+        return list(synced), list(unsynced)
+
+    def _walk(
+        self,
+        header: bytes,
+        chunk: bytes,
+        ticks_per_beat: int,
+        tempo: int,
+        note_stack: dict[int, int],
+    ) -> _WalkedTrack:
+        # mido is imported on first use to keep the GUI start fast
+        from mido import MidiFile
+
+        notes = tuple(sorted(note_stack.items()))
+        # A file of this track alone, the header is copied for its resolution
+        single = header[:8] + struct.pack(">HH", 1, 1) + header[12:] + chunk
+        track = MidiFile(file=io.BytesIO(single)).tracks[0]
+        events, end_tempo, markers = pm.walk_track(
+            track, ticks_per_beat, tempo, note_stack, self.config
+        )
+        return _WalkedTrack(
+            chunk, tempo, notes, events, end_tempo, dict(note_stack), markers
+        )
+
+
+class FileWatcher:
+    """Report a file once it has been rewritten and stays unchanged.
+
+    Args:
+        path (str): File to watch. It may be replaced by renaming another
+            file over it, as many programs save.
+        on_change (Callable[[str], None]): Called on the watcher's thread
+            with `path` after every change.
+        settle (float): Seconds without further changes before reporting.
+            Defaults to SETTLE_TIME.
+        interval (float): Seconds between two checks when inotify is not
+            available. Defaults to POLL_INTERVAL.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        on_change: Callable[[str], None],
+        *,
+        settle: float = SETTLE_TIME,
+        interval: float = POLL_INTERVAL,
+    ):
+        self.path = path
+        self.on_change = on_change
+        self.settle = settle
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._inotify: int | None = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._inotify = self._open_inotify()
+        self._thread = threading.Thread(
+            target=self._run, name="file-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self._inotify is not None:
+            os.close(self._inotify)
+            self._inotify = None
+
+    def _open_inotify(self) -> int | None:
+        """Watch the file's directory, None where inotify is not available."""
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            directory = os.path.dirname(os.path.abspath(self.path))
+            mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except (AttributeError, OSError) as e:
+            logging.debug(f"inotify unavailable, polling {self.path}: {e}")
+            return None
+        logging.debug(f"Watching {self.path} with inotify")
+        return fd
+
+    def _signature(self) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None  # Between deleting and writing the new file
+        return (st.st_mtime_ns, st.st_size)
+
+    def _wait(self, timeout: float):
+        """Sleep until the directory changes, or for `timeout` seconds."""
+        if self._inotify is None:
+            self._stop.wait(timeout)
+            return
+        readable, _, _ = select.select([self._inotify], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self._inotify, 4096):
+                    pass  # Only whether something happened matters
+            except BlockingIOError:
+                pass
+
+    def _run(self):
+        reported = self._signature()
+        seen = reported
+        changed_at = 0.0
+        while not self._stop.is_set():
+            pending = seen != reported
+            if self._inotify is None:
+                self._wait(
+                    min(self.interval, self.settle) if pending else self.interval
+                )
+            else:
+                # inotify wakes up on changes, the timeout is a safety net
+                self._wait(self.settle if pending else 1.0)
+            if self._stop.is_set():
+                break
+            signature = self._signature()
+            now = time.monotonic()
+            if signature != seen:
+                seen = signature
+                changed_at = now
+            elif (
+                signature is not None
+                and signature != reported
+                and now - changed_at >= self.settle
+            ):
+                reported = signature
+                logging.info(f"{self.path} changed")
+                try:
+                    self.on_change(self.path)
+                except Exception as e:
+                    logging.error(f"Error handling change of {self.path}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show which tracks change whenever a MIDI file is exported"
+    )
+    parser.add_argument("midi_file")
+    args = parser.parse_args()
+
+    incremental = IncrementalParser()
+    start = time.perf_counter()
+    synced, _ = incremental.parse(args.midi_file)
+    print(f"{len(synced)} tracks, {time.perf_counter() - start:.3f} s")
+
+    def on_change(path):
+        start = time.perf_counter()
+        try:
+            incremental.parse(path)
+        except (OSError, ValueError, EOFError) as e:
+            print(f"cannot parse {path}: {e}")
+            return
+        print(
+            f"walked MIDI tracks {incremental.walked_tracks}, changed packets "
+            f"{incremental.changed_tracks}, {time.perf_counter() - start:.3f} s"
+        )
+
+    watcher = FileWatcher(args.midi_file, on_change)
+    watcher.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
+if __name__ == "__main__":
+    main()